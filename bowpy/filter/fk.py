@@ -18,8 +18,9 @@ from bowpy.util.fkutil import ls2ifft_prep,\
                               slope_distribution, makeMask,\
                               create_iFFT2mtx, pocs
 from bowpy.util.base import nextpow2, array2stream, stream2array,\
-                            line_cut, line_set_zero
+                            line_cut, line_set_zero, precision_dtypes
 from bowpy.util.picker import get_polygon
+from bowpy.util.gather import ArrayGather
 
 
 def fk_filter(st, inv=None, event=None, ftype='eliminate',
@@ -27,7 +28,7 @@ def fk_filter(st, inv=None, event=None, ftype='eliminate',
               normalize=True, stack=False, slopes=[-3, 3], deltaslope=0.05,
               slopepicking=False, smoothpicks=False, dist=0.5,
               maskshape=['boxcar', None], order=4., peakinput=False,
-              eval_mean=1, fs=25):
+              eval_mean=1, fs=25, precision=None):
     """
     Import stream, the function applies an 2D FFT, removes a certain window
     around the desired phase to surpress a slownessvalue corresponding to a
@@ -36,7 +37,7 @@ def fk_filter(st, inv=None, event=None, ftype='eliminate',
     interpolate the signals in the fk-domain is beeing build, also a method
     using a norm minimization method.
 
-    param st: Stream
+    param st: Stream or ArrayGather
     type st: obspy.core.stream.Stream
 
     param inv: inventory
@@ -95,7 +96,11 @@ def fk_filter(st, inv=None, event=None, ftype='eliminate',
     param eval_mean: number of linear events used to calculate the average of
                      the area in the fk domain.
 
-    returns:	stream_filtered, the filtered stream.
+    param precision: 'single' to filter in float32/complex64, default is set by
+                     bowpy.util.base.set_precision
+    type precision: string
+
+    returns:	stream_filtered, the filtered stream, an ArrayGather if st is an ArrayGather.
 
 
 
@@ -117,6 +122,11 @@ def fk_filter(st, inv=None, event=None, ftype='eliminate',
     # Convert format and prepare Variables.
 
     # Check for Data type of variables.
+    gather = None
+    if isinstance(st, ArrayGather):
+        gather = st
+        st = gather.to_stream()
+
     if not type(st) == Stream:
         print("Wrong input type of stream, must be obspy.core.stream.Stream")
         raise TypeError
@@ -124,8 +134,9 @@ def fk_filter(st, inv=None, event=None, ftype='eliminate',
     if len(fshape) == 1:
         fshape = [fshape[0], None, None]
 
+    real, cplx = precision_dtypes(precision)
     st_tmp = st.copy()
-    ArrayData = stream2array(st_tmp, normalize)
+    ArrayData = stream2array(st_tmp, normalize, dtype=real)
 
     ix = ArrayData.shape[0]
     iK = int(math.pow(2, nextpow2(ix)))
@@ -185,12 +196,12 @@ def fk_filter(st, inv=None, event=None, ftype='eliminate',
                 raise IOError(msg)
 
             st_al = alignon(st_tmp, inv, event, phase)
-            ArrayData = stream2array(st_al, normalize)
-            array_fk = np.fft.fft2(ArrayData, s=(iK,iF))
+            ArrayData = stream2array(st_al, normalize, dtype=real)
+            array_fk = np.fft.fft2(ArrayData, s=(iK,iF)).astype(cplx, copy=False)
             array_filtered_fk = line_set_zero(array_fk, shape=fshape)
 
         else:
-            array_fk = np.fft.fft2(ArrayData, s=(iK,iF))
+            array_fk = np.fft.fft2(ArrayData, s=(iK,iF)).astype(cplx, copy=False)
             array_filtered_fk = line_set_zero(array_fk, shape=fshape)
 
     elif ftype in ("extract"):
@@ -200,24 +211,24 @@ def fk_filter(st, inv=None, event=None, ftype='eliminate',
                 raise IOError(msg)
 
             st_al = alignon(st_tmp, inv, event, phase)
-            ArrayData = stream2array(st_al, normalize)
-            array_fk = np.fft.fft2(ArrayData, s=(iK,iF))
+            ArrayData = stream2array(st_al, normalize, dtype=real)
+            array_fk = np.fft.fft2(ArrayData, s=(iK,iF)).astype(cplx, copy=False)
             array_filtered_fk = line_cut(array_fk, shape=fshape)
 
         else:
-            array_fk = np.fft.fft2(ArrayData, s=(iK,iF))
+            array_fk = np.fft.fft2(ArrayData, s=(iK,iF)).astype(cplx, copy=False)
             array_filtered_fk = line_cut(array_fk, shape=fshape)
 
 
     elif ftype in ("eliminate-polygon"):
-        array_fk = np.fft.fft2(ArrayData, s=(iK,iF))
+        array_fk = np.fft.fft2(ArrayData, s=(iK,iF)).astype(cplx, copy=False)
         if phase:
             if not isinstance(event, Event) and not isinstance(inv, Inventory):
                 msg='For alignment on phase calculation inventory and event information is needed, not found.'
                 raise IOError(msg)
             st_al = alignon(st_tmp, inv, event, phase)
-            ArrayData = stream2array(st_al, normalize)
-            array_fk = np.fft.fft2(ArrayData, s=(iK,iF))
+            ArrayData = stream2array(st_al, normalize, dtype=real)
+            array_fk = np.fft.fft2(ArrayData, s=(iK,iF)).astype(cplx, copy=False)
             array_filtered_fk = _fk_eliminate_polygon(array_fk, polygon, ylabel=r'frequency domain f in Hz', \
                                                       yticks=f_axis, xlabel=r'wavenumber domain k in $\frac{1}{^{\circ}}$', xticks=k_axis, eval_mean=eval_mean, fs=fs)
 
@@ -227,15 +238,15 @@ def fk_filter(st, inv=None, event=None, ftype='eliminate',
 
 
     elif ftype in ("extract-polygon"):
-        array_fk = np.fft.fft2(ArrayData, s=(iK,iF))
+        array_fk = np.fft.fft2(ArrayData, s=(iK,iF)).astype(cplx, copy=False)
         if phase:
             if not isinstance(event, Event) and not isinstance(inv, Inventory):
                 msg='For alignment on phase calculation inventory and event information is needed, not found.'
                 raise IOError(msg)
 
             st_al = alignon(st_tmp, inv, event, phase)
-            ArrayData = stream2array(st_al, normalize)
-            array_fk = np.fft.fft2(ArrayData, s=(iK,iF))
+            ArrayData = stream2array(st_al, normalize, dtype=real)
+            array_fk = np.fft.fft2(ArrayData, s=(iK,iF)).astype(cplx, copy=False)
             array_filtered_fk = _fk_extract_polygon(array_fk, polygon, ylabel=r'frequency domain f in Hz', \
                                                 yticks=f_axis, xlabel=r'wavenumber domain k in $\frac{1}{^{\circ}}$', xticks=k_axis, eval_mean=eval_mean, fs=fs)
         else:
@@ -244,12 +255,14 @@ def fk_filter(st, inv=None, event=None, ftype='eliminate',
 
 
     elif ftype in ("mask"):
-        array_fk = np.fft.fft2(ArrayData)
+        array_fk = np.fft.fft2(ArrayData).astype(cplx, copy=False)
         M, prange, peaks = slope_distribution(array_fk, slopes, deltaslope, peakpick=None, mindist=dist, smoothing=smoothpicks, interactive=slopepicking)
         W = makeMask(array_fk, peaks[0], maskshape)
         array_filtered_fk =  array_fk * W
         array_filtered = np.fft.ifft2(array_filtered_fk)
-        stream_filtered = array2stream(array_filtered, st_original=st.copy())
+        stream_filtered = array2stream(array_filtered, st_original=st)
+        if gather:
+            return gather.copy(data=array_filtered), array_fk, W
         return stream_filtered, array_fk, W
 
 
@@ -260,13 +273,13 @@ def fk_filter(st, inv=None, event=None, ftype='eliminate',
                 raise IOError(msg)
 
             st_al = alignon(st_tmp, inv, event, phase)
-            ArrayData = stream2array(st_al, normalize)
-            array_fk = np.fft.fft2(ArrayData, s=(iK,iF))
+            ArrayData = stream2array(st_al, normalize, dtype=real)
+            array_fk = np.fft.fft2(ArrayData, s=(iK,iF)).astype(cplx, copy=False)
             ### BUILD DOUBLE TAPER ###
             #array_filtered_fk =
 
         else:
-            array_fk = np.fft.fft2(ArrayData, s=(iK,iF))
+            array_fk = np.fft.fft2(ArrayData, s=(iK,iF)).astype(cplx, copy=False)
             ### BUILD DOUBLE TAPER ###
             #array_filtered_fk =
 
@@ -275,14 +288,16 @@ def fk_filter(st, inv=None, event=None, ftype='eliminate',
         print("No type of filter specified")
         raise TypeError
 
-    array_filtered = np.fft.ifft2(array_filtered_fk, s=(iK,iF)).real
+    array_filtered = np.fft.ifft2(array_filtered_fk, s=(iK,iF)).real.astype(real, copy=False)
 
 
     # Convert to Stream object.
     array_filtered = array_filtered[0:ix, 0:it]
-    stream_filtered = array2stream(array_filtered, st_original=st.copy())
+    stream_filtered = array2stream(array_filtered, st_original=st)
     stream_filtered.normalize()
 
+    if gather:
+        return gather.copy(data=stream2array(stream_filtered, dtype=real, copy=False))
     return stream_filtered
 
 
@@ -626,7 +641,8 @@ def fk_reconstruct(st, slopes=[-10,10], deltaslope=0.05, slopepicking=False, smo
         return st_rec
 
 def pocs_recon(st, maxiter=None, alpha=None, dmethod='reconstruct', method='linear', beta=None, peaks=None, maskshape=None,
-               dt=None, p=None, flow=None, fhigh=None, slidingwindow=False, alpha_i_test=False, st_org=None, plotfeedback=False):
+               dt=None, p=None, flow=None, fhigh=None, slidingwindow=False, alpha_i_test=False, st_org=None, plotfeedback=False,
+               precision=None):
     """
     This functions reconstructs missing signals in the f-k domain, using the original data,
     including gaps, filled with zeros. It applies the projection onto convex sets (pocs) algorithm in
@@ -634,7 +650,8 @@ def pocs_recon(st, maxiter=None, alpha=None, dmethod='reconstruct', method='line
 
     Reference: 3D interpolation of irregular data with a POCS algorithm, Abma & Kabir, 2006
 
-    :param st:
+    :param st: Stream or ArrayGather, for an ArrayGather the dead traces are reconstructed
+               and an ArrayGather is returned.
     :type  st:
 
     :param maxiter:
@@ -643,6 +660,9 @@ def pocs_recon(st, maxiter=None, alpha=None, dmethod='reconstruct', method='line
     :param nol: Number of loops
     :type  nol:
 
+    :param precision: 'single' to reconstruct in float32/complex64, see fkutil.pocs
+    :type  precision: str
+
     returns:
 
     :param st_rec:
@@ -654,11 +674,19 @@ def pocs_recon(st, maxiter=None, alpha=None, dmethod='reconstruct', method='line
         raise IOError('For alpha_i_test an orignal stream is needed')
 
 
-    st_tmp 		= st.copy()
-    ArrayData 	= stream2array(st_tmp, normalize=True)
+    if isinstance(st, ArrayGather):
+        ArrayData 	= st.data / st.data.max()
+        st_tmp 		= []
+    else:
+        st_tmp 		= st.copy()
+        ArrayData 	= stream2array(st_tmp, normalize=True)
     recon_list 	= []
 
-    if dmethod in ('reconstruct'):
+    if dmethod in ('reconstruct') and isinstance(st, ArrayGather):
+        recon_list = list(np.flatnonzero(~st.live | (ArrayData.sum(axis=1) == 0.)))
+        noft = recon_list
+
+    elif dmethod in ('reconstruct'):
         for i, trace in enumerate(st_tmp):
             try:
                 if trace.stats.zerotrace in ['True']:
@@ -677,7 +705,10 @@ def pocs_recon(st, maxiter=None, alpha=None, dmethod='reconstruct', method='line
         noft = range(ArrayData.shape[0])
 
     if alpha_i_test:
-        ADref = stream2array(st_org)
+        if isinstance(st_org, ArrayGather):
+            ADref = st_org.data
+        else:
+            ADref = stream2array(st_org)
 
         if ADref.shape != ArrayData.shape:
             raise IOError('Shapes of reference stream and reconstructed stream differ!')
@@ -692,7 +723,8 @@ def pocs_recon(st, maxiter=None, alpha=None, dmethod='reconstruct', method='line
         Qmax = 0.
         for i in i_range:
             for a in alpha_range:
-                ADrec = pocs(ArrayData, i, noft, a, beta, method, dmethod, peaks, maskshape, dt, p, flow, fhigh, slidingwindow, plotfeedback=plotfeedback)
+                ADrec = pocs(ArrayData, i, noft, a, beta, method, dmethod, peaks, maskshape, dt, p, flow, fhigh, slidingwindow, plotfeedback=plotfeedback,
+                             precision=precision)
                 Q = 10.*np.log( np.linalg.norm(ADref,2)**2. / np.linalg.norm(ADref - ADrec,2)**2. )
 
                 if Q >= Qmax: # and maxiter > i:
@@ -705,13 +737,27 @@ def pocs_recon(st, maxiter=None, alpha=None, dmethod='reconstruct', method='line
                 print ('Progress of alpha-i test: %i %%, current Q: %f, current Qmax: %f' % ( int(progress),Q ,Qmax ), end='\r')
                 sys.stdout.flush()
 
-        ADfinal = pocs(ArrayData, maxiter, noft, alpha, beta, method, dmethod, peaks, maskshape, dt, p, flow, fhigh, slidingwindow)
+        ADfinal = pocs(ArrayData, maxiter, noft, alpha, beta, method, dmethod, peaks, maskshape, dt, p, flow, fhigh, slidingwindow,
+                       precision=precision)
 
     else:
-        ADfinal = pocs(ArrayData, maxiter, noft, alpha, beta, method, dmethod, peaks, maskshape, dt, p, flow, fhigh, slidingwindow, plotfeedback=plotfeedback)
+        ADfinal = pocs(ArrayData, maxiter, noft, alpha, beta, method, dmethod, peaks, maskshape, dt, p, flow, fhigh, slidingwindow, plotfeedback=plotfeedback,
+                       precision=precision)
 
     #datap = ADfinal.copy()
 
+    if isinstance(st, ArrayGather):
+        norm = abs(ADfinal).max(axis=1)
+        norm[norm == 0] = 1.
+        gather_rec = st.copy(data=ADfinal / norm[:, np.newaxis])
+        for i, stats in enumerate(gather_rec.stats):
+            stats.pocs = {'alpha': alpha, 'iteration': maxiter}
+            if alpha_i_test:
+                stats.pocs['Q'] = Qmax
+            if i in noft:
+                stats.recon = True
+        return gather_rec
+
     st_rec 	= array2stream(ADfinal, st)
     st_rec.normalize()
 
@@ -3,13 +3,16 @@ import numpy
 import numpy as np
 from numpy import dot
 import math
+from collections import OrderedDict
 from math import pi
 
 import scipy as sp
 from scipy import sparse
-from bowpy.util.base import nextpow2
+from bowpy.util.base import nextpow2, precision_dtypes
+from bowpy.util.traveltimes import get_model
 from bowpy.util.picker import get_polygon
 from bowpy.util.array_util import stream2array, attach_epidist2coords, epidist2nparray
+from bowpy.util.gather import ArrayGather
 
 from obspy import Stream, Inventory
 from obspy.core.event.event import Event
@@ -26,7 +29,22 @@ from obspy.core.event.event import Event
  GNU General Public License for more details: http://www.gnu.org/licenses/
 """
 
-def radon_filter(st, inv, event, p, weights, line_model, inversion_model, hyperparameters):
+# Moveout tables, keyed by distance set, reference distance, line model and
+# source depth bin. Each entry holds the two vectors g, c of the rank-1 table
+# Tshift = g * p + c, so the p axis itself does not blow up the cache. The
+# least recently used tables are removed beyond MOVEOUT_CACHE_SIZE.
+MOVEOUT_CACHE_SIZE = 64
+_MOVEOUT_CACHE = OrderedDict()
+
+# Diffracted phase, used beyond the distance range of the phase.
+_DIFFRACTED = {'P': 'Pdiff', 'S': 'Sdiff'}
+
+# Number of complex matrix elements evaluated at once in the frequency engine.
+_RADON_BLOCKSIZE = 2**22
+
+
+def radon_filter(st, inv, event, p, weights, line_model, inversion_model, hyperparameters,
+				 phase='P', taup_model='ak135'):
 	"""
 	This function applies the radon_inverse, the user is now able to pick a polygon around the energy 
 	that should be extracted. It returns the dataset containing only the extracted energy.
@@ -44,7 +62,8 @@ def radon_filter(st, inv, event, p, weights, line_model, inversion_model, hyperp
 	st_input = st.copy()
 	
 	print('Starting inverse Radon-Transformation')
-	R, t, epi = radon_inverse(st_input, inv, event, p, weights, line_model, inversion_model, hyperparameters)
+	R, t, epi = radon_inverse(st_input, inv, event, p, weights, line_model, inversion_model, hyperparameters,
+							  phase=phase, taup_model=taup_model)
 	indicies = get_polygon(R, no_of_vert=8, xlabel=r'$\tau$', ylabel='p')
 	Rpick=np.zeros(R.shape)
 	Rpick.conj().transpose().flat[ indicies ]=1
@@ -54,15 +73,21 @@ def radon_filter(st, inv, event, p, weights, line_model, inversion_model, hyperp
 	yticks = np.arange(int(math.ceil(min(Delta_resampled/10)))*10, int(math.ceil(max(Delta_resampled/10)))*10 + 10,10)[::-1]
 	xticks =  np.arange(int(math.ceil(min(t/100)))*100, int(math.ceil(max(t/100)))*100 + 100,100)[::2]
 
-	Mpick = radon_forward(t, p, Rpick, Delta_resampled, np.mean(epi), line_model)
+	if isinstance(event, Event):
+		depth = event.origins[0].depth / 1000.
+	else:
+		depth = st.depth
+	Mpick = radon_forward(t, p, Rpick, Delta_resampled, np.mean(epi), line_model, depth=depth, phase=phase,
+						  taup_model=taup_model)
 
 	return Mpick, xticks, yticks
 
 
-def radon_inverse(st, inv, event, p, weights, line_model, inversion_model, hyperparameters):
+def radon_inverse(st, inv, event, p, weights, line_model, inversion_model, hyperparameters,
+				  phase='P', taup_model='ak135', precision=None):
 	"""
 	This function inverts move-out data to the Radon domain given the inputs:
-	:param st:
+	:param st: Stream, or ArrayGather with distances, then inv and event are not needed.
 	
 	:param inv:
 
@@ -77,6 +102,10 @@ def radon_inverse(st, inv, event, p, weights, line_model, inversion_model, hyper
 	:param line_model: 	select one of the following options for path integration:
 	     				'linear'     - linear paths in the spatial domain (default)
 	     				'parabolic'  - parabolic paths in the spatial domain.
+	     				'hyperbolic' - linear paths plus the curvature of a hyperbola,
+	     				               fitted to time and slope of phase at the reference distance.
+	     				'taup'       - linear paths plus the curvature of the TauP
+	     				               traveltime curve of phase.
 	
 	:param inversion model:	 select one of the following options for regularization schema:
 								 'L2'       - Regularized on the L2 norm of the Radon domain (default)
@@ -85,6 +114,15 @@ def radon_inverse(st, inv, event, p, weights, line_model, inversion_model, hyper
 								 'Cauchy'   - Non-linear regularization see Sacchi & Ulrych 1995
 	
 	:param hyperparameters: trades-off between fitting the data and chosen damping.
+
+	:param phase: Reference phase for the 'hyperbolic' and 'taup' line models.
+	:type  phase: str
+
+	:param taup_model: model used by TauPyModel to calculate the curved moveout, default is ak135
+	:type  taup_model: str
+
+	:param precision: 'single' to solve in complex64, default see bowpy.util.base.set_precision
+	:type  precision: str
 	
 	returns: radon domain is ordered size(R)==[length(p),length(t)], time-axis and distance-axis.
 	
@@ -106,7 +144,8 @@ def radon_inverse(st, inv, event, p, weights, line_model, inversion_model, hyper
 
 	# Check for Data type of variables.
 
-	if not isinstance(st, Stream) or not isinstance(inv, Inventory) or not isinstance(event, Event):
+	isgather = isinstance(st, ArrayGather)
+	if not isgather and (not isinstance(st, Stream) or not isinstance(inv, Inventory) or not isinstance(event, Event)):
 		msg = "Wrong input type must be obspy Stream, Inventory and Event" 
 		raise TypeError
 
@@ -117,18 +156,30 @@ def radon_inverse(st, inv, event, p, weights, line_model, inversion_model, hyper
 
 
 	# Define some array/matrices lengths.
-	st_tmp = st.copy()
-	M = stream2array(st_tmp)
-	epi = epidist2nparray(attach_epidist2coords(inv, event, st_tmp))
-	delta = np.array([ epi.copy() ])
+	if isgather:
+		M = st.data
+		epi = st.distance.copy()
+		dt, npts = st.delta, st.npts
+		depth = st.depth
+		if isinstance(event, Event):
+			depth = event.origins[0].depth / 1000.
+	else:
+		st_tmp = st.copy()
+		M = stream2array(st_tmp)
+		epi = epidist2nparray(attach_epidist2coords(inv, event, st_tmp))
+		dt, npts = st_tmp[0].stats.delta, st_tmp[0].stats.npts
+		depth = event.origins[0].depth / 1000.
+	real, cplx = precision_dtypes(precision)
+	M = np.asarray(M, dtype=real)
+	delta = epi.copy()
 	ref_dist = np.mean(delta)
 
 	if not weights:
 		weights = np.ones(delta.size)
+	weights = np.asarray(weights, dtype=real)
 
-	t = np.linspace(0,st_tmp[0].stats.delta * st_tmp[0].stats.npts, st_tmp[0].stats.npts)
+	t = np.linspace(0, dt * npts, npts)
 	it=t.size
-	print(it)
 	iF=int(math.pow(2,nextpow2(it)+1)) # Double length
 
    
@@ -148,7 +199,7 @@ def radon_inverse(st, inv, event, p, weights, line_model, inversion_model, hyper
 
 	#Exit if improper hyperparameters are entered.
 	if inversion_model in ["L1", "Cauchy"]:
-		if not len(hyperparameters == 2):
+		if not len(hyperparameters) == 2:
 			print("Improper number of trade-off parameters\n")
 			R=0
 			return(R)
@@ -159,95 +210,212 @@ def radon_inverse(st, inv, event, p, weights, line_model, inversion_model, hyper
 			return(R)
 
 	#Preallocate space in memory.
-	R=np.zeros((ip,it)) 
-	Rfft=np.zeros((ip,iF)) + 0j
-	A=np.zeros((iDelta,ip)) + 0j
-	Tshift=np.zeros((iDelta,ip)) + 0j
-	AtA=np.zeros((ip,ip)) + 0j
-	AtM=np.zeros((ip,1)) + 0j
-	Ident=np.identity(ip)
+	Rfft=np.zeros((ip,iF), dtype=cplx)
+	Ident=np.identity(ip, dtype=real)
 
 	#Define some values
-	Dist_array=delta-ref_dist
 	dF=1./(t[0]-t[1])
-	Mfft=np.fft.fft(M,iF,1)
-	W=sparse.spdiags(weights.conj().transpose(), 0, iDelta, iDelta).A
-	dCOST=0.
-	COST_curv=0.
-	COST_prev=0.
-
-	#Populate ray parameter then distance data in time shift matrix.
-	for j in range(iDelta):
-		if line_model == "parabolic":
-			Tshift[j]=p
-		else: #Linear is default
-			Tshift[j]=p
+	Mfft=np.fft.fft(M,iF,1).astype(cplx, copy=False)
+
+	#Time shift matrix from the (cached) moveout table.
+	Tshift = moveout_table(delta, p, ref_dist, line_model, depth=depth, phase=phase, taup_model=taup_model)
 	
-	for k in range(ip):
-		if line_model == 'parabolic':
-			Tshift[:,k]=(2. * ref_dist * Tshift[:,k] * Dist_array.conj().transpose()) + (Tshift[:,k] * (Dist_array**2).conj().transpose())
-		else: #Linear is default
-			Tshift[:,k]=Tshift[:,k] * Dist_array[0].conj().transpose()
-
-	# Loop through each frequency.
-	for i in range( int(math.floor((iF+1)/2)) ):
-		print('Step %i of %i' % (i, int(math.floor((iF+1)/2))) )
-		# Make time-shift matrix, A.
-		f = ((float(i)/float(iF))*dF)
-		A = np.exp( (0.+1j)*2*pi*f * Tshift )
-
-		# M = A R ---> AtM = AtA R
-		# Solve the weighted, L2 least-squares problem for an initial solution.
-		AtA = dot( dot(A.conj().transpose(), W), A )
-		AtM = dot( A.conj().transpose(), dot( W, Mfft[:,i] ) )
-		mu = abs(np.trace(AtA)) * hyperparameters[0]
-		Rfft[:,i] = sp.linalg.solve((AtA + mu*Ident), AtM)
+	# Solve the weighted, L2 least-squares problem for all frequencies, block by block.
+	# M = A R ---> AtM = AtA R
+	nfreq = int(math.floor((iF+1)/2))
+	for iblock, A in _radon_operator_blocks(Tshift, nfreq, iF, dF, dtype=real):
+		AH = A.conj().transpose(0, 2, 1) * weights
+		AtA = np.matmul(AH, A)
+		AtM = np.matmul(AH, Mfft[:, iblock].transpose()[:, :, np.newaxis])
+		mu = abs(np.trace(AtA, axis1=1, axis2=2)) * hyperparameters[0]
+		Rfft[:, iblock] = np.linalg.solve(AtA + mu[:, np.newaxis, np.newaxis] * Ident, AtM)[:, :, 0].transpose()
 
 		#Non-linear methods use IRLS to solve, iterate until convergence to solution.
 		if inversion_model in ("Cauchy", "L1"):
+			for j, i in enumerate(iblock):
+				Rfft[:,i] = _radon_irls(A[j], AtA[j], AtM[j, :, 0], Mfft[:,i], Rfft[:,i], mu[j],
+										hyperparameters[1], inversion_model)
 			
-			#Initialize hyperparameters.
-			b=hyperparameters[1]
-			lam=mu*b
-
-			#Initialize cost functions.
-			dCOST = float("Inf")
-			if inversion_model == "Cauchy":
-				COST_prev = np.linalg.norm( Mfft[:,i] - dot(A,Rfft[:,i]), 2 ) + lam*sum( np.log( abs(Rfft[:,i]**2 + b) ) )
-			elif inversion_model == "L1":
-				COST_prev = np.linalg.norm( Mfft[:,i] - dot(A,Rfft[:,i]), 2 ) + lam*np.linalg.norm( abs(Rfft[:,i]+1), 1 )
-			itercount=1
-			
-			#Iterate until negligible change to cost function.
-			while dCost > 0.001 and itercount < 10:
-				
-				#Setup inverse problem.
-				if inversion_model == "Cauchy":
-					Q = sparse.spdiags( 1./( abs(Rfft[:,i]**2) + b), 0, ip, ip).A
-				elif inversion_model == "L1":
-					Q = sparse.spdiags( 1./( abs(Rfft[:,i]) + b), 0, ip, ip).A
-				Rfft[:,i]=sp.linalg.solve( ( lam * Q + AtA ), AtM )
-				
-				#Determine change to cost function.
-				if inversion_model == "Cauchy":
-					COST_cur = np.linalg.norm( Mfft[:,i]-A*Rfft[:,i], 2 ) + lam*sum( np.log( abs(Rfft[:,i]**2 + b )-np.log(b) ) )
-				elif inversion_model == "L1":
-					COST_cur = np.linalg.norm( Mfft[:,i]-A*Rfft[:,i], 2 ) + lam*np.linalg.norm( abs(Rfft[:,i]+1) + b, 1 )
-				dCOST = 2*abs(COST_cur - COST_prev)/(abs(COST_cur) + abs(COST_prev))
-				COST_prev = COST_cur
-				
-				itercount += 1
-
-			#Assuming Hermitian symmetry of the fft make negative frequencies the complex conjugate of current solution.
-		if i != 0:
-			Rfft[:,iF-i] = Rfft[:,i].conjugate()
+	#Assuming Hermitian symmetry of the fft make negative frequencies the complex conjugate of current solution.
+	ineg = np.arange(1, nfreq)
+	Rfft[:,iF-ineg] = Rfft[:,ineg].conjugate()
 
 	R = np.fft.ifft(Rfft, iF)
 	R = R[:,0:it]
 
 	return R, t, epi
 
-def radon_forward(t,p,R,delta,ref_dist,line_model):
+
+def _radon_irls(A, AtA, AtM, Mfft_i, Rfft_i, mu, b, inversion_model):
+	"""
+	Iterative reweighted least squares for a single frequency of radon_inverse,
+	starting from the L2 solution Rfft_i.
+	"""
+	ip = Rfft_i.size
+
+	#Initialize hyperparameters.
+	lam=mu*b
+
+	#Initialize cost functions.
+	dCOST = float("Inf")
+	if inversion_model == "Cauchy":
+		COST_prev = np.linalg.norm( Mfft_i - dot(A,Rfft_i), 2 ) + lam*sum( np.log( abs(Rfft_i**2 + b) ) )
+	elif inversion_model == "L1":
+		COST_prev = np.linalg.norm( Mfft_i - dot(A,Rfft_i), 2 ) + lam*np.linalg.norm( abs(Rfft_i+1), 1 )
+	itercount=1
+
+	#Iterate until negligible change to cost function.
+	while dCOST > 0.001 and itercount < 10:
+
+		#Setup inverse problem.
+		if inversion_model == "Cauchy":
+			Q = sparse.spdiags( 1./( abs(Rfft_i**2) + b), 0, ip, ip).toarray()
+		elif inversion_model == "L1":
+			Q = sparse.spdiags( 1./( abs(Rfft_i) + b), 0, ip, ip).toarray()
+		Rfft_i=sp.linalg.solve( ( lam * Q + AtA ), AtM )
+
+		#Determine change to cost function.
+		if inversion_model == "Cauchy":
+			COST_cur = np.linalg.norm( Mfft_i-dot(A,Rfft_i), 2 ) + lam*sum( np.log( abs(Rfft_i**2 + b )-np.log(b) ) )
+		elif inversion_model == "L1":
+			COST_cur = np.linalg.norm( Mfft_i-dot(A,Rfft_i), 2 ) + lam*np.linalg.norm( abs(Rfft_i+1) + b, 1 )
+		dCOST = 2*abs(COST_cur - COST_prev)/(abs(COST_cur) + abs(COST_prev))
+		COST_prev = COST_cur
+
+		itercount += 1
+
+	return Rfft_i
+
+
+def _radon_operator_blocks(Tshift, nfreq, iF, dF, dtype='float'):
+	"""
+	Generator over blocks of frequency indices and the matching time-shift operators
+	A = exp(i 2 pi f Tshift), stacked to shape (len(block), len(delta), len(p)).
+	The phase is calculated in double precision, A is returned in the complex type of dtype.
+	"""
+	cplx = np.result_type(dtype, np.complex64)
+	blocksize = max(1, int(_RADON_BLOCKSIZE / Tshift.size))
+	for i0 in range(0, nfreq, blocksize):
+		iblock = np.arange(i0, min(i0 + blocksize, nfreq))
+		f = (iblock / float(iF)) * dF
+		A = np.exp( (0.+1j)*2*pi*f[:, np.newaxis, np.newaxis] * Tshift ).astype(cplx, copy=False)
+		yield iblock, A
+
+
+def moveout_table(delta, p, ref_dist, line_model='linear', depth=None, phase='P', taup_model='ak135',
+				  depth_res=10.):
+	"""
+	Returns the time-shift matrix Tshift of shape (len(delta), len(p)) used by radon_inverse
+	and radon_forward. Every line model is written as Tshift = g * p + c, g and c only depend
+	on the distances, so they are computed once and cached for all following calls with the same
+	array and depth range.
+
+	:param delta: distance axis in degrees
+	:type  delta: numpy.ndarray
+
+	:param p: slowness axis
+
+	:param ref_dist: reference distance the path-function will shift about.
+	:type  ref_dist: float
+
+	:param line_model: 'linear' (default), 'parabolic', 'hyperbolic' or 'taup'
+	:type  line_model: str
+
+	:param depth: source depth in km, needed for 'hyperbolic' and 'taup'
+	:type  depth: float
+
+	:param phase: Reference phase for 'hyperbolic' and 'taup'
+	:type  phase: str
+
+	:param taup_model: model used by TauPyModel, default is ak135
+	:type  taup_model: str
+
+	:param depth_res: Depth bins in km, events inside the same bin share one table.
+	:type  depth_res: float
+
+	returns:
+	:param Tshift: time-shift matrix
+	:type  Tshift: numpy.ndarray
+	"""
+	delta = np.asarray(delta, dtype='float').ravel()
+	p = np.asarray(p, dtype='float').ravel()
+	line_model = str(line_model).lower()
+
+	if line_model in ('hyperbolic', 'taup'):
+		if depth is None:
+			msg = "Source depth is needed for line_model %s" % line_model
+			raise IOError(msg)
+		depth_key = round(float(depth) / depth_res) * depth_res
+	else:
+		depth_key = None
+		phase = None
+		taup_model = None
+
+	key = (line_model, tuple(np.round(delta, 6)), round(float(ref_dist), 6), depth_key, phase, taup_model)
+	if key in _MOVEOUT_CACHE:
+		_MOVEOUT_CACHE.move_to_end(key)
+	else:
+		_MOVEOUT_CACHE[key] = _moveout_vectors(delta, ref_dist, line_model, depth_key, phase, taup_model)
+		while len(_MOVEOUT_CACHE) > MOVEOUT_CACHE_SIZE:
+			_MOVEOUT_CACHE.popitem(last=False)
+	g, c = _MOVEOUT_CACHE[key]
+
+	return np.outer(g, p) + c[:, np.newaxis]
+
+
+def _moveout_vectors(delta, ref_dist, line_model, depth, phase, taup_model):
+	"""
+	Calculates the moveout vectors g, c of moveout_table.
+	"""
+	Dist_array = delta - ref_dist
+	c = np.zeros(delta.size)
+
+	if line_model == 'parabolic':
+		g = (2. * ref_dist * Dist_array) + Dist_array**2
+
+	elif line_model in ('hyperbolic', 'taup'):
+		g = Dist_array
+		m = get_model(taup_model)
+		arrival = _first_arrival(m, depth, ref_dist, phase)
+		t_ref = arrival.time
+		p_ref = arrival.ray_param_sec_degree
+
+		if line_model == 'hyperbolic':
+			# Hyperbola T(x)^2 = a^2 + b^2 x^2 with T(ref_dist) = t_ref and T'(ref_dist) = p_ref.
+			b2 = p_ref * t_ref / ref_dist
+			a2 = t_ref**2 - b2 * ref_dist**2
+			if a2 < 0:
+				msg = "No hyperbola fits %s at %g deg, use line_model 'taup'" % (phase, ref_dist)
+				raise IOError(msg)
+			t_curve = np.sqrt(a2 + b2 * delta**2)
+		else:
+			t_curve = np.zeros(delta.size)
+			for i, dist in enumerate(delta):
+				t_curve[i] = _first_arrival(m, depth, dist, phase).time
+
+		# Only the curvature is kept, the slope is spanned by the p axis.
+		c = t_curve - t_ref - p_ref * Dist_array
+
+	else: #Linear is default
+		g = Dist_array
+
+	return g, c
+
+
+def _first_arrival(m, depth, dist, phase):
+	"""
+	First arrival of phase, or of its diffracted phase beyond its distance range.
+	"""
+	arrivals = m.get_travel_times(depth, dist, phase_list=[phase])
+	if not arrivals and phase in _DIFFRACTED:
+		arrivals = m.get_travel_times(depth, dist, phase_list=[_DIFFRACTED[phase]])
+	if not arrivals:
+		msg = "No arrival of %s at %g deg for a source depth of %g km" % (phase, dist, depth)
+		raise IOError(msg)
+	return arrivals[0]
+
+
+def radon_forward(t,p,R,delta,ref_dist,line_model,depth=None,phase='P',taup_model='ak135'):
 	"""
 	This function applies the time-shift Radon operator A, to the Radon 
 	domain.  Will calculate the move-out data, given the inputs:
@@ -260,6 +428,11 @@ def radon_forward(t,p,R,delta,ref_dist,line_model):
 	 -line_model, select one of the following options for path integration:
 		 'linear'     - linear paths in the spatial domain (default)
 		 'parabolic'  - parabolic paths in the spatial domain.
+		 'hyperbolic' - linear paths plus curvature of a hyperbola, see radon_inverse
+		 'taup'       - linear paths plus curvature of the TauP traveltime curve, see radon_inverse
+
+	 -depth, phase, taup_model -- source depth in km, reference phase and model for
+	                              the 'hyperbolic' and 'taup' line models.
 
 	Output spatial domain is ordered size(M)==[length(delta),length(t)].
 
@@ -291,46 +464,28 @@ def radon_forward(t,p,R,delta,ref_dist,line_model):
 
 	#Exit if inconsistent data is input.
 	if R.shape != (ip, it):
-		print("Dimensions inconsistent!\nShape of M is not equal to (len(delta),len(t)) \nShape of M = (%i , %i)\n(len(delta),len(t)) = (%i, %i) \n" % (M.shape[0],  M.shape[1], iDelta, it) )
+		print("Dimensions inconsistent!\nShape of R is not equal to (len(p),len(t)) \nShape of R = (%i , %i)\n(len(p),len(t)) = (%i, %i) \n" % (R.shape[0],  R.shape[1], ip, it) )
 		M=0
 		return(M)
 
 	#Preallocate space in memory.
 	Mfft = np.zeros((iDelta, iF)) + 0j
-	A = np.zeros((iDelta, ip)) + 0j
-	Tshift = np.zeros((iDelta, ip)) + 0j
 
 	#Define some values.
-	Dist_array=delta-ref_dist
 	dF=1./(t[0]-t[1])
 	Rfft=np.fft.fft(R,iF,1)
 
-	#Populate ray parameter then distance data in time shift matrix.
-	for j in range(iDelta):
-		if line_model == "parabolic":
-			Tshift[j,:]=p
-		else: #Linear is default
-			Tshift[j,:]=p
+	#Time shift matrix from the (cached) moveout table.
+	Tshift = moveout_table(delta, p, ref_dist, line_model, depth=depth, phase=phase, taup_model=taup_model)
 	
-	for k in range(ip):
-		if line_model == 'parabolic':
-			Tshift[:,k]=(2. * ref_dist * Tshift[:,k] * Dist_array.conj().transpose()) + (Tshift[:,k] * (Dist_array**2).conj().transpose())
-		else: #Linear is default
-			Tshift[:,k]=Tshift[:,k] * Dist_array.conj().transpose()
-
-	# Loop through each frequency.
-	for i in range( int(math.floor((iF+1)/2))-1 ):
-
-		# Make time-shift matrix, A.
-		f = ((float(i)/float(iF))*dF)
-		A = np.exp( (0.+1j)*2*pi*f * Tshift )
-		
-		# Apply Radon operator.
-		Mfft[:,i]=dot(A, Rfft[:,i])
-
-		# Assuming Hermitian symmetry of the fft make negative frequencies the complex conjugate of current solution.
-		if i != 0:
-			Mfft[:,iF-i] = Mfft[:,i].conjugate()
+	# Apply Radon operator for all frequencies, block by block.
+	nfreq = int(math.floor((iF+1)/2))-1
+	for iblock, A in _radon_operator_blocks(Tshift, nfreq, iF, dF):
+		Mfft[:, iblock] = np.matmul(A, Rfft[:, iblock].transpose()[:, :, np.newaxis])[:, :, 0].transpose()
+
+	# Assuming Hermitian symmetry of the fft make negative frequencies the complex conjugate of current solution.
+	ineg = np.arange(1, nfreq)
+	Mfft[:,iF-ineg] = Mfft[:,ineg].conjugate()
 
 	M = np.fft.ifft(Mfft, iF)
 	M = M[:,0:it]		
@@ -5,7 +5,8 @@ from numpy import dot
 import math
 import scipy as sp
 from bowpy.util.fkutil import nextpow2
-from bowpy.util.base import stream2array, array2stream
+from bowpy.util.base import stream2array, array2stream, precision_dtypes
+from bowpy.util.gather import ArrayGather
 import sys
 
 def ssa_denoise_recon(st, p, flow, fhigh):
@@ -13,7 +14,7 @@ def ssa_denoise_recon(st, p, flow, fhigh):
 	SSA method, that de-noises the data given in stream by a rank reduction of the singular values of the
 	Hankel matrix, created from the data in st and the sampling interval of the traces, to p.
 
- 	:param st:     Stream of data
+	:param st:     Stream of data or ArrayGather, which is returned as such
 	:type  st:
 
 	:param dt:     sampling interval
@@ -38,6 +39,9 @@ def ssa_denoise_recon(st, p, flow, fhigh):
 
 	st_ssa = ssa_denoise_recon(st, dt, p, flow, fhigh)
 	"""
+	if isinstance(st, ArrayGather):
+		return st.copy(data=fx_ssa(st.data, st.delta, p, flow, fhigh))
+
 	st_tmp = st.copy()
 	
 	data = stream2array(st_tmp)
@@ -123,14 +127,15 @@ def ssa(d,nw,p,ssa_flag):
 	l = np.arange(0,nw,1)
 	R = np.zeros((nt,p))
 
- 	# Make Hankel Matrix.
-	M = np.zeros((N-1,N)).astype('complex')
-	Mp = np.zeros((N-1,N)).astype('complex')
+	# Make Hankel Matrix.
+	ctype = np.result_type(d.dtype, np.complex64)
+	M = np.zeros((N-1,N), dtype=ctype)
+	Mp = np.zeros((N-1,N), dtype=ctype)
 
 	for k in range(N):
 		M[:,k] = d[k+l]
 
- 	# Eigenimage decomposition
+	# Eigenimage decomposition
 
 	U,S,V = sp.linalg.svd(M)
 	
@@ -138,17 +143,17 @@ def ssa(d,nw,p,ssa_flag):
 
 	# Reconstruct with one oscillatory component at the time.
 	if not ssa_flag == 0:
-	 	for k in range(p):
-			u = np.zeros((N-1,2)).astype('complex')
-	 		u[:,0] = U[:,k]
-	 		Mp = dot( dot(u, u.conj().transpose()), M )
-	 		R[:,k] = average_anti_diag(Mp)
-	 	dp = sum(d)
+		for k in range(p):
+			u = np.zeros((N-1,2), dtype=ctype)
+			u[:,0] = U[:,k]
+			Mp = dot( dot(u, u.conj().transpose()), M )
+			R[:,k] = average_anti_diag(Mp)
+		dp = sum(d)
 
 	else:
 	 	
 		for k in range(p):
-			u = np.zeros((N-1,2)).astype('complex')
+			u = np.zeros((N-1,2), dtype=ctype)
 			u[:,0] = U[:,k]
 			Mp = Mp + dot( dot(u, u.conj().transpose()), M )
 
@@ -160,7 +165,7 @@ def ssa(d,nw,p,ssa_flag):
 
 	return(dp,sing,R)
 
-def fx_ssa(data,dt,p,flow,fhigh):
+def fx_ssa(data,dt,p,flow,fhigh,precision=None):
 	"""
 	FX_SSA: Singular Spectrum Analysis in the fx domain for snr enhancement
 	
@@ -172,6 +177,7 @@ def fx_ssa(data,dt,p,flow,fhigh):
 	       p:      number of singular values used to reconstuct the data
 	       flow:   min  freq. in the data in Hz
 	       fhigh:  max  freq. in the data in Hz
+	       precision: 'single' to filter in complex64, default see bowpy.util.base.set_precision
 	
 	
 	  OUT  data_f:  filtered data
@@ -216,8 +222,9 @@ def fx_ssa(data,dt,p,flow,fhigh):
 	if ihigh > math.floor(nf/2)+1:
 		ihigh = int(math.floor(nf/2)+1)
 	
-	data_FX = np.fft.fft(data, nf, axis=0)
-	data_FX_f = np.zeros(data_FX.shape).astype('complex')
+	real, cplx = precision_dtypes(precision)
+	data_FX = np.fft.fft(np.asarray(data, dtype=real), nf, axis=0).astype(cplx, copy=False)
+	data_FX_f = np.zeros(data_FX.shape, dtype=cplx)
 	
 	nw = int(math.floor(ntraces/2))
 
@@ -239,11 +246,11 @@ def fx_ssa(data,dt,p,flow,fhigh):
 		data_FX_f[k-1,:] = tmp_out
 		i+=1
 
-	for k in range(nf/2+2, nf):
+	for k in range(nf//2+2, nf):
 		data_FX_f[k-1,:] = data_FX_f[nf-k+1,:].conj()
 		
 	data_f = np.fft.ifft(data_FX_f, axis=0)
-	data_f = data_f[0:nt,:].real
+	data_f = data_f[0:nt,:].real.astype(real, copy=False)
 	
 	return data_f
 
@@ -283,15 +290,15 @@ def average_anti_diag(A):
 	 s(i,1) = s(i,1)/(b-a+1);
 
 	 end;
- 	"""
+	"""
 
- 	m,n = A.shape
+	m,n = A.shape
 
- 	N = m+n-1
+	N = m+n-1
 
- 	s = np.zeros(N).astype('complex')
+	s = np.zeros(N, dtype=np.result_type(A.dtype, np.complex64))
 
- 	for i in range(N):
+	for i in range(N):
 		a = max(1,(i+1)-m+1)
 		b = min(n,(i+1))
 		
@@ -299,8 +306,8 @@ def average_anti_diag(A):
 			k = a
 			s[i] = s[i] + A[i-k+1,k-1]
 		else:
-	 		for k in range(a,b+1):
-	 			s[i] = s[i] + A[i-k+1,k-1]
+			for k in range(a,b+1):
+				s[i] = s[i] + A[i-k+1,k-1]
 
 		s[i]= s[i]/(b-a+1)
  		
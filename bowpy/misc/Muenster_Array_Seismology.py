@@ -15,7 +15,9 @@ from obspy.taup import getTravelTimes
 import scipy.interpolate as spi
 import scipy as sp
 import matplotlib.cm as cm
-from obspy.signal.util import utlGeoKm,nextpow2
+from obspy.signal.util import nextpow2
+from bowpy.util.base import shift_data
+from bowpy.util.geodesy import geo_km
 import ctypes as C
 from obspy.core import Stream
 import math
@@ -154,12 +156,8 @@ def get_geometry(stream,coordsys='lonlat',return_center=False,verbose=False):
         center_lon = geometry[:, 0].mean()
         center_lat = geometry[:, 1].mean()
         center_h = geometry[:, 2].mean()
-        for i in np.arange(nstat):
-            x, y = utlGeoKm(center_lon, center_lat, geometry[i, 0],
-                               geometry[i, 1])
-            geometry[i, 0] = x
-            geometry[i, 1] = y
-            geometry[i, 2] -= center_h
+        geometry[:, 0], geometry[:, 1] = geo_km(center_lon, center_lat, geometry[:, 0], geometry[:, 1])
+        geometry[:, 2] -= center_h
     elif coordsys == 'xy':
         geometry[:, 0] -= geometry[:, 0].mean()
         geometry[:, 1] -= geometry[:, 1].mean()
@@ -1671,21 +1669,18 @@ def get_timeshift(geometry, sll_x, sll_y, sl_s, grdpts_x,
 
 def shifttrace_freq(stream, t_shift):
     if isinstance(stream, Stream):
+        # All traces are shifted at once, zero padded to the longest one.
+        ndat = max(tr.stats.npts for tr in stream)
+        data = np.zeros((len(stream), ndat))
+        shifts = np.zeros(len(stream))
         for i, tr in enumerate(stream):
-            ndat = tr.stats.npts
-            samp = tr.stats.sampling_rate
-            nfft = nextpow2(ndat)
-            nfft *= 2
-            tr1 = np.fft.rfft(tr.data, nfft)
-            for k in xrange(0, nfft / 2):
-                tr1[k] *= np.complex(
-                    np.cos((t_shift[i] * samp) * (k / float(nfft))
-                           * 2. * np.pi),
-                    -np.sin((t_shift[i] * samp) *
-                            (k / float(nfft)) * 2. * np.pi))
-
-            tr1 = np.fft.irfft(tr1, nfft)
-            tr.data = tr1[0:ndat]
+            data[i, :tr.stats.npts] = tr.data
+            shifts[i] = t_shift[i] * tr.stats.sampling_rate
+        nfft = nextpow2(ndat)
+        nfft *= 2
+        data = shift_data(data, shifts, nfft=nfft)
+        for i, tr in enumerate(stream):
+            tr.data = data[i, :tr.stats.npts]
 
 
 """
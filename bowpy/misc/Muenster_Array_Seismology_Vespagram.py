@@ -26,11 +26,14 @@ from obspy.signal.headers import clibsignal
 from obspy.signal.invsim import cosTaper
 from obspy.taup import TauPyModel
 from obspy.taup import getTravelTimes
+from bowpy.util.traveltimes import get_model, traveltimes
+from bowpy.util.base import shift_data
+from bowpy.util.geodesy import geo_km
 #from mpl_toolkits.basemap import Basemap
 
 KM_PER_DEG = 111.1949
 os.system('clear')  # clear screen
-model =  TauPyModel(model="ak135")
+model = get_model("ak135")
 
 def vespagram(stream, ev, inv, method, scale, nthroot=4,
               static3D=False, vel_corr=4.8, sl=(0.0, 10.0, 0.1),
@@ -560,8 +563,7 @@ def get_timeshift_baz(geometry, sll, slm, sls, baze, source_depth, distance, pha
     # time shift table is given by the number of staions and number of beam traces
     time_shift_tbl = np.empty((nstat, nbeams), dtype="float32")
 
-    arrivals = model.get_travel_times(source_depth, distance, phase_list = phase)
-    inc_ang = arrivals[0].incident_angle
+    inc_ang = traveltimes(source_depth, distance, phase, attribute='incident_angle')
     inc_ang_rad = inc_ang * np.pi/180
     print('The incidence angle is %.2f deg and %.2f rad') % (inc_ang, inc_ang_rad)
 
@@ -645,11 +647,8 @@ def get_geometry(stream,coordsys='lonlat',return_center=True,verbose=False):
         # print(center_lat)
         center_h = geometry[:, 2].mean()
         
-        for i in np.arange(nstat):
-            x, y = utlGeoKm(center_lon, center_lat, geometry[i, 0],geometry[i, 1])  # original: utlGeoKm
-            geometry[i, 0] = x
-            geometry[i, 1] = y
-            geometry[i, 2] -= center_h
+        geometry[:, 0], geometry[:, 1] = geo_km(center_lon, center_lat, geometry[:, 0], geometry[:, 1])
+        geometry[:, 2] -= center_h
     elif coordsys == 'xy':
         geometry[:, 0] -= geometry[:, 0].mean()
         geometry[:, 1] -= geometry[:, 1].mean()
@@ -669,7 +668,6 @@ def get_taupy_points(center_lat,center_lon,ev_lat,ev_lon,ev_depth,
   distance = locations2degrees(center_lat,center_lon,ev_lat,ev_lon)
   #print(distance)
 
-  model =  TauPyModel(model="ak135")
   arrivals = model.get_pierce_points(ev_depth,distance)
   #arrivals = earthmodel.get_pierce_points(ev_depth,distance,phase_list=('PP','P^410P'))  
 
@@ -886,21 +884,18 @@ def align_phases(stream, event, inventory, phase_name, method="simple"):
 
 def shifttrace_freq(stream, t_shift):
     if isinstance(stream, Stream):
+        # All traces are shifted at once, zero padded to the longest one.
+        ndat = max(tr.stats.npts for tr in stream)
+        data = np.zeros((len(stream), ndat))
+        shifts = np.zeros(len(stream))
         for i, tr in enumerate(stream):
-            ndat = tr.stats.npts
-            samp = tr.stats.sampling_rate
-            nfft = nextpow2(ndat)
-            nfft *= 2
-            tr1 = np.fft.rfft(tr.data, nfft)
-            for k in xrange(0, nfft / 2):
-                tr1[k] *= np.complex(
-                    np.cos((t_shift[i] * samp) * (k / float(nfft))
-                           * 2. * np.pi),
-                    -np.sin((t_shift[i] * samp) *
-                            (k / float(nfft)) * 2. * np.pi))
-
-            tr1 = np.fft.irfft(tr1, nfft)
-            tr.data = tr1[0:ndat]
+            data[i, :tr.stats.npts] = tr.data
+            shifts[i] = t_shift[i] * tr.stats.sampling_rate
+        nfft = nextpow2(ndat)
+        nfft *= 2
+        data = shift_data(data, shifts, nfft=nfft)
+        for i, tr in enumerate(stream):
+            tr.data = data[i, :tr.stats.npts]
 
 def attach_coordinates_to_traces(stream, inventory, event=None):
     """
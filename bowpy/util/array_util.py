@@ -2,8 +2,8 @@ from __future__ import absolute_import
 
 import numpy as np
 import math
-import fractions
-from scipy.signal import correlate
+from scipy.signal import correlate, hilbert
+from scipy.spatial import ConvexHull
 import obspy
 
 import matplotlib.pyplot as plt
@@ -14,12 +14,16 @@ from obspy import Stream, Inventory, Trace
 from obspy.core.event.event import Event
 from obspy.core.inventory.network import Network
 from obspy.core import AttribDict
-from obspy.geodetics.base import locations2degrees, gps2dist_azimuth, \
-    kilometer2degrees
-from obspy.taup import TauPyModel
+from obspy.geodetics.base import kilometer2degrees
 from obspy.taup.taup_geo import add_geo_to_arrivals
 
-from bowpy.util.base import nextpow2, stream2array, array2stream, array2trace
+from bowpy.util.geodesy import geodetic2enu, vincenty_inverse
+from bowpy.util.base import nextpow2, normalize_array, stream2array, array2stream, array2trace, shift_data, \
+    precision_dtypes
+from bowpy.util.gather import ArrayGather
+from bowpy.util.gather_store import GatherStore
+from bowpy.util.station_index import get_station_index
+from bowpy.util.traveltimes import get_model, traveltimes
 
 """
 Collection of useful functions for processing seismological array data
@@ -39,7 +43,7 @@ def __coordinate_values(inventory):
 
 
 def alignon(st, inv=None, event=None, phase=None, ref=0, maxtimewindow=0, xcorr=False, shiftmethod='normal',
-            taup_model='ak135', verbose=False):
+            taup_model='ak135', verbose=False, xcorr_iter=0):
     """
     Aligns traces on a given phase and truncates the starts to the latest beginning and the ends
     to the earliest end.
@@ -63,19 +67,32 @@ def alignon(st, inv=None, event=None, phase=None, ref=0, maxtimewindow=0, xcorr=
     :type maxtimewindow: int, float or string
 
     :param xcorr: Use cross correlation with the reference trace to align traces.
+                  The peaks are refined to sub-sample precision, see xcorr_shifts.
     :type  xcorr: bool
 
     :param taup_model: model used by TauPyModel to calculate arrivals, default is ak135
     :type taup_model: str
 
+    :param xcorr_iter: Maximum number of iterations, in which the traces are correlated with the
+                       stack of the aligned traces instead of the reference trace, default 0.
+    :type xcorr_iter: int
+
     returns:
-    :param st_align: Aligned and truncated stream on Phase
+    :param st_align: Aligned and truncated stream on Phase, ArrayGather if st is an ArrayGather.
     :type st_align:
 
     """
-    # Prepare Array of data.
-    st_tmp = st.copy()
-    data = stream2array(st_tmp)
+    if isinstance(st, ArrayGather):
+        st_align = alignon(st.to_stream(), inv, event, phase, ref, maxtimewindow, xcorr, shiftmethod, taup_model,
+                           verbose, xcorr_iter)
+        if st_align is None:
+            return
+        return ArrayGather.from_stream(st_align)
+
+    # Prepare Array of data. The data of st are copied once, st_tmp copies only the stats,
+    # its traces are views of data.
+    data = stream2array(st)
+    st_tmp = array2stream(data, st)
     shifttimes = np.zeros(data.shape[0])
 
     # Calculate depth and distance of receiver and event.
@@ -117,8 +134,6 @@ def alignon(st, inv=None, event=None, phase=None, ref=0, maxtimewindow=0, xcorr=
         except:
             isevent = False
 
-    m = TauPyModel(taup_model)
-
     if isevent:
         if isinstance(ref, int):
             ref_dist = st_tmp[ref].stats.distance
@@ -140,22 +155,17 @@ def alignon(st, inv=None, event=None, phase=None, ref=0, maxtimewindow=0, xcorr=
         elif isinstance(maxtimewindow, int):
             maxtimewindow = float(maxtimewindow)
 
-        # Calculating reference arriving time/index of phase.
-        ref_t = origin + m.get_travel_times(depth, ref_dist, phase_list=phase)[0].time - ref_start
-        ref_n = int(ref_t / delta)
+        # Arrivals of phase at all traces, from the shared traveltime tables.
+        phase_times = traveltimes(depth, np.array([trace.stats.distance for trace in st_tmp]), phase, taup_model)
 
-        if xcorr:
-            if isinstance(maxtimewindow, np.ndarray):
-                reftrace_tmp = cut(st_tmp[iref], ref_t - abs(maxtimewindow[0]), ref_t + maxtimewindow[1])
-                reftrace = reftrace_tmp.data
-
-            elif isinstance(maxtimewindow, float):
-                reftrace_tmp = cut(st_tmp[iref], ref_t - maxtimewindow, ref_t + maxtimewindow)
-                reftrace = reftrace_tmp.data
-
-            datashift_null, shift_index = shift2ref(data[iref, :], ref_n, ref_n, ref_array=reftrace,
-                                                    mtw=maxtimewindow / delta, method=shiftmethod, xcorr=xcorr)
+        # Calculating arriving time/index of phase.
+        phase_n = (np.array([origin - trace.stats.starttime for trace in st_tmp]) + phase_times) / delta
+        ref_n = phase_n[iref]
 
+        if xcorr:
+            shift_indices = xcorr_shifts(data, phase_n, maxtimewindow / delta, iref, xcorr_iter)
+            if shiftmethod.lower() == 'normal':
+                shift_indices = np.round(shift_indices)
 
         # First work on reference Trace:
         else:
@@ -164,36 +174,19 @@ def alignon(st, inv=None, event=None, phase=None, ref=0, maxtimewindow=0, xcorr=
                 datashift_null, shift_index = shift2ref(data[iref, :], ref_n, ref_n, mtw=maxtimewindow / delta,
                                                         method=shiftmethod)
 
-        ref_n = ref_n - shift_index
+            ref_n = ref_n - shift_index
 
-        data_tmp = data.copy()
-        for no_x, data_x in enumerate(data):
-            if no_x == iref:
-                continue
-
-            dist = st_tmp[no_x].stats.distance
-            t = m.get_travel_times(depth, dist, phase_list=phase)[0].time
+            shift_indices = np.zeros(data.shape[0])
+            for no_x, data_x in enumerate(data):
+                if no_x == iref:
+                    continue
 
-            # Calculate arrivals, and shift times/indicies.
-            phase_time = origin + t - st_tmp[no_x].stats.starttime
-            phase_n = int(phase_time / delta)
-            if not xcorr:
                 if isinstance(maxtimewindow, float) or isinstance(maxtimewindow, int) or isinstance(maxtimewindow,
                                                                                                     np.ndarray):
-                    datashift, shift_index = shift2ref(data_x, ref_n, phase_n, mtw=maxtimewindow / delta,
+                    shift_indices[no_x] = _shift_value(data_x, ref_n, phase_n[no_x], mtw=maxtimewindow / delta,
                                                        method=shiftmethod)
 
-            if xcorr:
-                datashift, shift_index = shift2ref(data_x, ref_n, phase_n, ref_array=reftrace,
-                                                   mtw=maxtimewindow / delta, method=shiftmethod, xcorr=xcorr)
-
-            shifttimes[no_x] = delta * shift_index
-            data_tmp[no_x, :] = datashift
-            if verbose:
-                print('Trace no %i was shifted by %f seconds' % (no_x, delta * shift_index))
-            # Positive shift_index indicates positive shift in time and vice versa.
-            if shift_index > 0 and shift_index > tmin: tmin = shift_index
-            if shift_index < 0 and shift_index < tmax: tmax = abs(shift_index)
+        data_tmp, shifttimes, tmin, tmax = _apply_shifts(data, shift_indices, iref, delta, shiftmethod, verbose)
 
     # Alignment of timewindow around
     elif timewindow:
@@ -211,21 +204,14 @@ def alignon(st, inv=None, event=None, phase=None, ref=0, maxtimewindow=0, xcorr=
                 iref = i
                 delta = float(trace.stats.delta)
 
-        ref_n = int(phase[0] / delta)
+        ref_n = phase[0] / delta
         maxtimewindow = np.array([0, phase[1] - phase[0]])
 
         if xcorr:
-            if isinstance(maxtimewindow, np.ndarray):
-                reftrace_tmp = cut(st_tmp[iref], ref_t - abs(maxtimewindow[0]), ref_t + maxtimewindow[1])
-                reftrace = reftrace_tmp.data
-
-            elif isinstance(maxtimewindow, float):
-                reftrace_tmp = cut(st_tmp[iref], ref_t - maxtimewindow, ref_t + maxtimewindow)
-                reftrace = reftrace_tmp.data
-
-            datashift_null, shift_index = shift2ref(data[iref, :], ref_n, ref_n, ref_array=reftrace,
-                                                    mtw=maxtimewindow / delta, method=shiftmethod, xcorr=xcorr)
-
+            shift_indices = xcorr_shifts(data, np.zeros(data.shape[0]) + ref_n, maxtimewindow / delta, iref,
+                                         xcorr_iter)
+            if shiftmethod.lower() == 'normal':
+                shift_indices = np.round(shift_indices)
 
         # First work on reference Trace:
         else:
@@ -234,36 +220,27 @@ def alignon(st, inv=None, event=None, phase=None, ref=0, maxtimewindow=0, xcorr=
                 datashift_null, shift_index = shift2ref(data[iref, :], ref_n, ref_n, mtw=maxtimewindow / delta,
                                                         method=shiftmethod)
 
-        ref_n = ref_n - shift_index
-        phase_n = int(phase[0] / delta)
-        data_tmp = data.copy()
-        for no_x, data_x in enumerate(data):
-            if no_x == iref:
-                continue
+            ref_n = ref_n - shift_index
+            phase_n = phase[0] / delta
+            shift_indices = np.zeros(data.shape[0])
+            for no_x, data_x in enumerate(data):
+                if no_x == iref:
+                    continue
 
-            if not xcorr:
                 if isinstance(maxtimewindow, float) or isinstance(maxtimewindow, int) or isinstance(maxtimewindow,
                                                                                                     np.ndarray):
-                    datashift, shift_index = shift2ref(data_x, ref_n, phase_n, mtw=maxtimewindow / delta,
+                    shift_indices[no_x] = _shift_value(data_x, ref_n, phase_n, mtw=maxtimewindow / delta,
                                                        method=shiftmethod)
 
-            else:
-                datashift, shift_index = shift2ref(data_x, ref_n, phase_n, ref_array=reftrace,
-                                                   mtw=maxtimewindow / delta, method=shiftmethod, xcorr=xcorr)
-
-            shifttimes[no_x] = delta * shift_index
-            data_tmp[no_x, :] = datashift
-            if verbose:
-                print('Trace no %i was shifted by %f seconds' % (no_x, delta * shift_index))
-            # Positive shift_index indicates positive shift in time and vice versa.
-            if shift_index > 0 and shift_index > tmin: tmin = shift_index
-            if shift_index < 0 and shift_index < tmax: tmax = abs(shift_index)
+        data_tmp, shifttimes, tmin, tmax = _apply_shifts(data, shift_indices, iref, delta, shiftmethod, verbose)
     else:
         print('No valid input defined, please use event-file or time-window defined in phases')
         return
 
-    data_trunc = truncate(data_tmp, tmin, tmax)
-    st_align = array2stream(data_trunc, st_tmp)
+    # st_tmp has private stats, the truncated rows are views of data_tmp.
+    st_align = st_tmp
+    for trace, row in zip(st_align, truncate(data_tmp, tmin, tmax, copy=False)):
+        trace.data = row
 
     # Change startime entry and add alignon entry.
     if not timewindow:
@@ -281,21 +258,49 @@ def alignon(st, inv=None, event=None, phase=None, ref=0, maxtimewindow=0, xcorr=
     return st_align
 
 
+def _apply_shifts(data, shift_indices, iref, delta, shiftmethod, verbose=False):
+    """
+    Shifts all traces of data except the reference at once, returns the shifted data,
+    the shifttimes and the number of samples to truncate on both sides.
+    """
+    others = np.arange(data.shape[0]) != iref
+    data_tmp = np.empty_like(data)
+    data_tmp[iref] = data[iref]
+    data_tmp[others] = shift_data(data[others], shift_indices[others], method=shiftmethod)
+    shifttimes = delta * shift_indices
+
+    if verbose:
+        for no_x in np.flatnonzero(others):
+            print('Trace no %i was shifted by %f seconds' % (no_x, shifttimes[no_x]))
+
+    # Positive shift_index indicates positive shift in time and vice versa.
+    tmin = int(math.ceil(max(shift_indices.max(), 0)))
+    tmax = int(math.ceil(abs(min(shift_indices.min(), 0))))
+
+    return data_tmp, shifttimes, tmin, tmax
+
+
 def aperture(inventory):
     """
     The aperture of the array in kilometers.
-    Method:find the maximum of the calculation of distance of every possible combination of stations
+    Method: the maximum distance of all combinations of the stations on the convex hull
+    of the array, in the local east-north plane around its center.
     """
-    lats, lngs, hgt = __coordinate_values(inventory)
-    distances = []
+    index = get_station_index(inventory)
+    lats, lngs = index.latitude, index.longitude
 
-    for i in range(len(lats)):
-        for j in range(len(lats)):
-            if lats[i] == lats[j]:
-                continue
-            distances.append(gps2dist_azimuth(lats[i], lngs[i],
-                                              lats[j], lngs[j])[0] / 1000.0)
-    return max(distances)
+    hull = np.arange(len(index))
+    if hull.size > 3:
+        east, north, up = geodetic2enu(lats, lngs, 0., lats.mean(), lngs.mean())
+        try:
+            hull = ConvexHull(np.column_stack((east, north))).vertices
+        except Exception:
+            # All stations on a line.
+            pass
+
+    distances = vincenty_inverse(lats[hull, np.newaxis], lngs[hull, np.newaxis],
+                                 lats[np.newaxis, hull], lngs[np.newaxis, hull])[0] / 1000.0
+    return distances.max()
 
 
 def attach_coordinates_to_traces(stream, inventory, event=None):
@@ -315,69 +320,21 @@ def attach_coordinates_to_traces(stream, inventory, event=None):
     :type event: :class:`obspy.core.event.Event`
     """
 
-    attach_network_to_traces(stream, inventory)
-    # Get the coordinates for all stations
-    coords = {}
-    for network in inventory:
-        for station in network:
-            coords["%s.%s" % (network.code, station.code)] = \
-                {"latitude": station.latitude,
-                 "longitude": station.longitude,
-                 "elevation": station.elevation}
+    # Station codes, coordinates, distances and back-azimuths are taken from the
+    # index of the inventory, which is built only once.
+    index = get_station_index(inventory)
 
-    # Calculate the event-station distances.
     if event:
         attach_event_origin_to_traces(stream, event)
-        event_lat = event.origins[0].latitude
-        event_lng = event.origins[0].longitude
-        event_dpt = event.origins[0].depth / 1000.
-        event_origin = event.origins[0].time
-        for value in coords.values():
-                value["distance"] = locations2degrees(value["latitude"],
-                                                      value["longitude"],
-                                                      event_lat, event_lng)
-                value["depth"] = event_dpt
-                value["origin"] = event_origin
-                value["back_azimuth"] = gps2dist_azimuth(value["latitude"],
-                                                         value["longitude"],
-                                                         event_lat,
-                                                         event_lng)[2]
     else:
         print("No Event information found, distance, origin and back-azmuth will NOT be set!")
 
     # Attach the information to the traces.
-    if isinstance(stream, Stream):
-        for trace in stream:
-            try:
-                station = ".".join(trace.id.split(".")[:2])
-                value = coords[station]
-                trace.stats.coordinates = AttribDict()
-                trace.stats.coordinates.latitude = value["latitude"]
-                trace.stats.coordinates.longitude = value["longitude"]
-                trace.stats.coordinates.elevation = value["elevation"]
-                if event:
-                    trace.stats.distance = value["distance"]
-                    trace.stats.depth = value["depth"]
-                    trace.stats.origin = value["origin"]
-                    trace.stats.back_azimuth = value["back_azimuth"]
-            except:
-                continue
-
-    elif isinstance(stream, Trace):
-        try:
-            station = ".".join(stream.id.split(".")[:2])
-            value = coords[station]
-            stream.stats.coordinates = AttribDict()
-            stream.stats.coordinates.latitude = value["latitude"]
-            stream.stats.coordinates.longitude = value["longitude"]
-            stream.stats.coordinates.elevation = value["elevation"]
-            if event:
-                stream.stats.distance = value["distance"]
-                stream.stats.depth = value["depth"]
-                stream.stats.origin = value["origin"]
-        except:
-            raise TypeError
+    if isinstance(stream, (Stream, Trace)):
+        index.attach(stream, event)
 
+    if isinstance(stream, Trace) and index.rows(stream)[0] < 0:
+        raise TypeError
 
 
 def attach_epidist2coords(inventory, event, stream=None):
@@ -410,15 +367,10 @@ def attach_epidist2coords(inventory, event, stream=None):
 
     except:
 
-        for network in inv:
-            for station in network:
-                scode = network.code + "." + station.code
-                lat1 = Array_Coords[scode]["latitude"]
-                lat2 = Array_Coords[scode]["longitude"]
-
-                # calculate epidist in km
-                # adds an epidist entry to the Array_coords dictionary
-                Array_Coords[scode]["epidist"] = locations2degrees(lat1, lat2, eventlat, eventlon)
+        # adds an epidist entry to the Array_coords dictionary
+        index = get_station_index(inv)
+        for scode, epidist in zip(index.codes, index.distances(event)):
+            Array_Coords[scode]["epidist"] = epidist
 
     return (Array_Coords)
 
@@ -427,20 +379,8 @@ def attach_network_to_traces(stream, inventory):
     """
     Attaches the network-code of the inventory to each trace of the stream
     """
-    if isinstance(stream, Stream):
-        for trace in stream:
-            for network in inventory:
-                for station in network:
-                    if station.code != trace.meta.station:
-                        continue
-                    trace.meta.network = network.code
-
-    elif isinstance(stream, Trace):
-        for network in inventory:
-            for station in network:
-                if station.code != stream.meta.station:
-                    continue
-                stream.meta.network = network.code
+    if isinstance(stream, (Stream, Trace)):
+        get_station_index(inventory).attach(stream, coordinates=False)
 
 def attach_event_origin_to_traces(stream, event):
     """
@@ -481,13 +421,9 @@ def corr_stat(stream, inv, phase):
 
     st = stream.copy()
     data = stream2array(st)
-    data_corr = np.zeros(data.shape)
     center = geometrical_center(inv)
     cstat = find_closest_station(inv, st, center['latitude'], center['longitude'])
 
-    tmin = 0
-    tmax = 0
-
     for trace in stream:
         if trace.stats.station != cstat:
             continue
@@ -495,60 +431,64 @@ def corr_stat(stream, inv, phase):
         distance = trace.stats.distance
         delta = trace.stats.delta
 
-    m = TauPyModel('ak135')
-    arrival = m.get_travel_times(depth, distance, phase_list=[phase])
-    slo = arrival[0].ray_param_sec_degree
-
-    for i, trace in enumerate(data):
-        shift = int(slo * (distance - st[i].stats.distance) / delta)
-        print(shift)
-        data_corr[i, :], shift_index = shift2ref(trace, 0, shift)
-        if shift_index > 0 and shift_index > tmin: tmin = shift_index
-        if shift_index < 0 and shift_index < tmax: tmax = abs(shift_index)
-    data_corr = truncate(data, tmin, tmax)
+    slo = traveltimes(depth, distance, phase, attribute='ray_param_sec_degree')
+
+    # Fractional shifts of all traces at once.
+    shifts = -slo * (distance - np.array([trace.stats.distance for trace in st])) / delta
+    data_corr = shift_data(data, shifts, method='fft')
+    tmin = int(math.ceil(max(shifts.max(), 0)))
+    tmax = int(math.ceil(abs(min(shifts.min(), 0))))
+    data_corr = truncate(data_corr, tmin, tmax, copy=False)
     stream_corr = array2stream(data_corr, st)
 
     return stream_corr
 
 
-def cut(st, tmin, tmax=0):
-    if isinstance(st, Stream):
-        istrace = False
-        st_tmp = st.copy()
-        delta = st_tmp[0].stats.delta
-        npts = st_tmp[0].stats.npts
-
-        # Check for equal samplingrates and correcting timeinfo.
-        for trace in st_tmp:
-            if trace.stats.delta != delta:
-                print('no equal sampling rate, abort')
-                return
-            else:
-                trace.stats.starttime += tmin
-        data = stream2array(st_tmp)
+def cut(st, tmin, tmax=0, copy=True):
+    """
+    Cuts the traces to the window from tmin to tmax in seconds after their starttime.
+
+    :param st: Stream or Trace
+
+    :param tmin: start of the window in seconds
+
+    :param tmax: end of the window in seconds, 0 keeps the traces to their end
 
+    :param copy: If False, the data of the returned traces are views of the input data,
+                 which saves the copy, if st is discarded. The stats are always copied.
+    :type copy: bool
+    """
     if isinstance(st, Trace):
         istrace = True
-        st_tmp = st.copy()
-        delta = st_tmp.stats.delta
-        npts = st_tmp.stats.npts
+        traces = [st]
+    else:
+        istrace = False
+        traces = st
 
-        # Check for equal samplingrates and correcting timeinfo.
-        st_tmp.stats.starttime += tmin
-        data = st_tmp.data
+    # Check for equal samplingrates.
+    delta = traces[0].stats.delta
+    for trace in traces:
+        if trace.stats.delta != delta:
+            print('no equal sampling rate, abort')
+            return
 
     imin = int(tmin / delta)
     imax = int(tmax / delta)
 
-    data_trunc = truncate(data, imin, imax, absolute=True)
+    cut_traces = []
+    for trace in traces:
+        stats = trace.stats.copy()
+        stats.starttime += tmin
+        if imax:
+            data = truncate(trace.data, imin, imax, absolute=True, copy=copy)
+        else:
+            data = truncate(trace.data, imin, 0, copy=copy)
+        stats.npts = data.size
+        cut_traces.append(Trace(data, stats))
 
     if istrace:
-        st_new = array2trace(data_trunc, st_tmp)
-        st_new.stats.npts = abs(imax - imin)
-    elif not istrace:
-        st_new = array2stream(data_trunc, st_tmp)
-
-    return st_new
+        return cut_traces[0]
+    return Stream(cut_traces)
 
 
 def epidist2list(Array_Coords):
@@ -591,34 +531,21 @@ def find_closest_station(inventory, stream, latitude, longitude,
     param absolute_height_in_km: altitude of interest in km
     type: float
     """
-    used_stations = []
-
-    for trace in stream:
-        used_stations.append(trace.stats.station)
-
-    min_distance = None
-    min_distance_station = None
-
-    lats, lngs, hgt = __coordinate_values(inventory)
-
-    x = latitude
-    y = longitude
-    z = absolute_height_in_km
-
-    for network in inventory:
-        for i, station in enumerate(network):
-            distance = np.sqrt(((gps2dist_azimuth(lats[i], lngs[i], x, y)[0]) / 1000.0) ** 2 + (
-            np.abs(np.abs(z) - np.abs(hgt[i]))) ** 2)
+    if isinstance(stream, ArrayGather):
+        used_stations = set(stream.stations)
+    else:
+        used_stations = set(trace.stats.station for trace in stream)
 
-            if min_distance is None or distance < min_distance:
-                if station.code in used_stations:
-                    min_distance = distance
-                    min_distance_station = station.code
+    index = get_station_index(inventory)
+    candidates = set(i for i, code in enumerate(index.stations) if code in used_stations)
+    row = index.nearest(latitude, longitude, absolute_height_in_km, candidates)
 
-    return min_distance_station
+    if row is None:
+        return None
+    return index.stations[row]
 
 
-def gaps_fill_zeros(stream, inv, event, decimal_res=1):
+def gaps_fill_zeros(stream, inv, event, decimal_res=1, returntype='stream'):
     """
     WARNING: Use this method only for synthetics, for real data prefer bowpy.util.fkutil.partial_stack
     Fills the gaps inbetween irregular distributed traces
@@ -632,6 +559,9 @@ def gaps_fill_zeros(stream, inv, event, decimal_res=1):
 
     :param d: Number of digits to round
 
+    :param returntype: 'stream' or 'array', for 'array' the gridded data and the
+                       distances of the grid are returned.
+
     :returns: equi_stream
     """
     st_tmp = stream.copy()
@@ -662,28 +592,27 @@ def gaps_fill_zeros(stream, inv, event, decimal_res=1):
     mind = int(round(np.diff(yinfo).min() * decimal_res))
     if mind == 0: mind = 1
     maxd = int(round(np.diff(yinfo).max() * decimal_res))
-    grd_delta = fractions.gcd(mind, maxd) / decimal_res
-    N = (grd_max - grd_min) / grd_delta + 1
+    grd_delta = np.gcd(mind, maxd) / decimal_res
+    N = int(round((grd_max - grd_min) / grd_delta + 1))
     grd = np.linspace(grd_min, grd_max, N)
 
-    equi_data = np.zeros((grd.size, star.shape[1]))
+    # Find nearest matching gridpoint for each trace and write the data in the new array.
+    equi_data, counts, source = regrid(star, grid_index(grd, yinfo), grd.size)
 
-    # Create new Array and new Trace-object
+    if returntype == 'array':
+        return equi_data, grd
+
+    # Create new Trace-objects, only now.
     traces = []
     for i, trace in enumerate(equi_data):
         newtrace = obspy.core.trace.Trace(trace)
+        if counts[i]:
+            newtrace.stats = st_tmp[source[i]].stats
+        else:
+            newtrace.stats.zerotrace = "True"
         newtrace.stats.distance = grd[i]
-        newtrace.stats.zerotrace = "True"
         traces.append(newtrace)
 
-    # Append data in Trace-Object
-    for i, trace in enumerate(star):
-        # Find nearest matching gridpoint for each trace.
-        new_index = np.abs(grd - yinfo[i]).argmin()
-        traces[new_index] = obspy.core.trace.Trace(trace)
-        traces[new_index].stats = st_tmp[i].stats
-        traces[new_index].stats.distance = grd[new_index]
-
     # Create new equidistant Stream-Object.
     equi_stream = Stream(traces)
 
@@ -766,6 +695,25 @@ def get_coords(inventory, returntype="dict"):
     return coords
 
 
+def grid_index(grid, values):
+    """
+    Index of the nearest point of the sorted grid for each value.
+
+    :param grid: sorted grid, e.g. distances in degree
+    :type grid: numpy.ndarray
+
+    :param values: values to be mapped on the grid
+    :type values: float or numpy.ndarray
+    """
+    values = np.asarray(values, dtype='float')
+    upper = np.clip(np.searchsorted(grid, values), 1, grid.size - 1)
+    lower = upper - 1
+    index = np.where(abs(values - grid[lower]) <= abs(grid[upper] - values), lower, upper)
+    if grid.size == 1:
+        index = np.zeros(values.shape, dtype='int')
+    return index
+
+
 def isuniform(inv, event, stream=None, tolerance=0.5):
     """
     Checks if the epicentral station distribution is uniform, in a given tolerance range.
@@ -840,7 +788,7 @@ def plot_map(inventory, event, stream=None, phases=['P^410P', 'P^660P'], savefig
     Documantation follows, still working on. What kind of information would be useful to plot?
     Have to add a legend.
     """
-    model = TauPyModel('ak135')
+    model = get_model('ak135')
     slat = event.origins[0].latitude
     slon = event.origins[0].longitude
     depth = event.origins[0].depth / 1000.
@@ -1021,7 +969,7 @@ def plot_vespa(data, st, inv=None, event=None, markphases=['ttall', 'P^410P', 'P
             origin = event.origins[0]['time']
             depth = event.origins[0]['depth'] / 1000.
 
-        m = TauPyModel('ak135')
+        m = get_model('ak135')
         dist = st[sref].stats.distance
         arrival = m.get_travel_times(depth, dist, phase_list=markphases)
 
@@ -1183,14 +1131,66 @@ def plot_vespa_stdout(data, st=None, inv=None, event=None, mp='P', savefig=False
     return
 
 
-def resample_distance(stream, inv=None, event=None, shiftmethod='fft', taup_model='ak135', stacking=False, refphase='PP'):
+def regrid(data, index, size, stacking=False, order=None):
+    """
+    Writes the traces of data into a preallocated array with size rows, trace i to row index[i].
+
+    :param data: traces
+    :type data: numpy.ndarray, 2D
+
+    :param index: row of each trace, see grid_index
+    :type index: numpy.ndarray
+
+    :param size: number of rows of the new array
+
+    :param stacking: If True, traces with the same index are stacked, otherwise the
+                     last one is used.
+    :type stacking: bool
+
+    :param order: Order of the Nth-root stack of the doublettes
+    :type order: float or int
+
+    returns:
+    :param grid_data: new array, zero for empty rows
+    :param counts: number of traces in each row
+    :param source: index of the (first, if stacking) trace in each row, -1 for empty rows
+    """
+    index = np.asarray(index, dtype='int')
+    grid_data = np.zeros((size, data.shape[1]))
+    counts = np.bincount(index, minlength=size)
+    source = np.zeros(size, dtype='int') - 1
+
+    if stacking:
+        rows, first = np.unique(index, return_index=True)
+        source[rows] = first
+        if order is not None and float(order) != 1.:
+            np.add.at(grid_data, index, np.sign(data) * abs(data) ** (1. / float(order)))
+        else:
+            np.add.at(grid_data, index, data)
+        filled = counts > 0
+        grid_data[filled] /= counts[filled, np.newaxis]
+        if order is not None and float(order) != 1.:
+            grid_data = np.sign(grid_data) * abs(grid_data) ** float(order)
+    else:
+        rows, last = np.unique(index[::-1], return_index=True)
+        last = index.size - 1 - last
+        source[rows] = last
+        grid_data[rows] = data[last]
+
+    return grid_data, counts, source
+
+
+def resample_distance(stream, inv=None, event=None, shiftmethod='fft', taup_model='ak135', stacking=False, refphase='PP',
+                      returntype='stream'):
     """
     Function reorganizes the traces in a equidistant manner.
+
+    :param returntype: 'stream' or 'array', for 'array' the resampled data and its
+                       distances are returned without creating a Stream.
+    :type returntype: str
     """
-    m = TauPyModel(taup_model)
     st_tmp = stream.copy()
     data = stream2array(st_tmp)
-    stream_resample = Stream()
     depth = stream[0].stats.depth
 
     try:
@@ -1214,77 +1214,160 @@ def resample_distance(stream, inv=None, event=None, shiftmethod='fft', taup_mode
     npts = data.shape[0]
 
     yresample = np.linspace(ymin, ymax, npts)
-    ilist = []
-    tstart_new_list = []
 
-    # Shifting takes place
-    for no, trace in enumerate(st_tmp):
+    distances = np.array([trace.stats.distance for trace in st_tmp])
+    if stacking:
+        index_resampled = grid_index(yresample, distances)
+    else:
+        index_resampled = np.arange(len(st_tmp))
+
+    starttimes = [trace.stats.starttime for trace in st_tmp]
+    if refphase:
+        tdeltas = traveltimes(depth, distances, refphase, taup_model) - \
+                  traveltimes(depth, yresample[index_resampled], refphase, taup_model)
+        # Shifting of all traces takes place at once.
+        data = shift_data(data, -tdeltas / np.array([trace.stats.delta for trace in st_tmp]), method=shiftmethod)
+        starttimes = [starttime + tdeltas[no] for no, starttime in enumerate(starttimes)]
+
+    # Doublettes are stacked
+    data_res, counts, source = regrid(data, index_resampled, yresample.size, stacking=stacking)
 
-        if stacking:
-            index_resampled = np.abs(yresample - trace.stats.distance).argmin()
+    if returntype == 'array':
+        return data_res, yresample
+
+    stream_res = Stream()
+    for j in range(yresample.size):
+        if counts[j]:
+            trace = st_tmp[source[j]]
+            trace.data = data_res[j]
+            trace.stats.starttime = starttimes[source[j]]
+            trace.stats.distance = yresample[j]
+            try:
+                trace.stats.processing.append(u'resampled: ')
+            except:
+                trace.stats.processing = u'resampled'
         else:
-            index_resampled = no
-        if refphase:
-            torg = m.get_travel_times(depth, trace.stats.distance, phase_list=[refphase])[0].time
-            tres = m.get_travel_times(depth, yresample[index_resampled], phase_list=[refphase])[0].time
-            tdelta = torg - tres
-            shiftvalue = int(tdelta / trace.stats.delta)
-            trace.data, shift_index = shift2ref(data[no], 0, shiftvalue, method=shiftmethod)
-            trace.stats.starttime = trace.stats.starttime + tdelta
-
-        tstart_new_list.append(trace.stats.starttime)
-
-        # Doublettes are stacked
-        if stacking:
-            if index_resampled in ilist:
-                stacks = [trace.data]
-                for i, stacktraces in enumerate(stream_resample):
-                    if stacktraces.stats.distance == yresample[index_resampled]:
-                        stacks.append(stacktraces.data)
-                stream_resample[i].data = stack(np.array(stacks))
-                continue
+            trace = obspy.core.trace.Trace(data_res[j])
+            trace.stats.network = stream[0].stats.network
+            trace.stats.station = "empty"
+            trace.stats.channel = stream[0].stats.channel
+            trace.stats.starttime = starttimes[j]
+            trace.stats.distance = yresample[j]
+            trace.stats.zerotrace = "True"
+            trace.stats.sampling_rate = stream[0].stats.sampling_rate
+        stream_res += trace
 
-        # If Distance is resonable, shift trace and correct time information.
-        # if np.abs(yresample - trace.stats.distance).min() <= ymeandiff:
+    return stream_res
 
-        trace.stats.distance = yresample[index_resampled]
-        try:
-            trace.stats.processing.append(u'resampled: ')
-        except:
-            trace.stats.processing = u'resampled'
-
-        stream_resample += trace
-        ilist.append(index_resampled)
-
-    # else:
-    #   print("Do something, difference is too big")
-
-    zero_traces = list(set(range(yresample.size)) - set(ilist))
-    if zero_traces:
-        for j in zero_traces:
-            newtrace = obspy.core.trace.Trace(np.zeros(st_tmp[0].data.size))
-            newtrace.stats.network = stream[0].stats.network
-            newtrace.stats.station = "empty"
-            newtrace.stats.channel = stream[0].stats.channel
-            newtrace.stats.starttime = tstart_new_list[j]
-            newtrace.stats.distance = yresample[j]
-            newtrace.stats.zerotrace = "True"
-            newtrace.stats.sampling_rate = stream[0].stats.sampling_rate
-            stream_resample += newtrace
 
-    # sort traces by distance
+class PartialStack(object):
+    """
+    Accumulates traces in (possibly overlapping) distance bins, used by
+    resample_partial_stack. Traces can be added all at once or one after another,
+    e.g. when the data arrives station by station.
+
+    :param bins: lower and upper border of each bin in degree, sorted by distance.
+                 A trace belongs to a bin if lower < distance <= upper, the first bin
+                 includes its lower border.
+    :type bins: list of tuples
 
-    yinfo_res = []
-    for index, trace in enumerate(stream_resample):
-        yinfo_res.append([trace.stats.distance, index])
-    yinfo_res.sort()
+    :param npts: number of samples of the traces
 
-    stream_res = Stream()
+    :param order: Order of Nth-root stacking, default None
+    :type order: float or int
 
-    for i in yinfo_res:
-        stream_res += stream_resample[i[1]]
+    :param shiftmethod: 'normal' or 'fft', see shift_data
 
-    return stream_res
+    :param mtw: Maximum nondimensional timewindow symmetrical around the arrival, in which
+                the maximum amplitude is picked, see shift2ref
+
+    :param bin_index: reference arrival index of each bin, if set, the traces are shifted
+                      from their arrival index to the one of the bin.
+    :type bin_index: numpy.ndarray
+
+    example:    binstack = PartialStack([(30., 31.), (31., 32.)], 2000, order=2)
+                for trace in stream:
+                    binstack.add(trace.data, trace.stats.distance)
+                bin_data = binstack.result()
+    """
+
+    def __init__(self, bins, npts, order=None, shiftmethod='normal', mtw=0, bin_index=None):
+        bins = np.asarray(bins, dtype='float').reshape(-1, 2)
+        self.lower = bins[:, 0]
+        self.upper = bins[:, 1]
+        self.npts = npts
+        self.order = order
+        self.shiftmethod = shiftmethod
+        self.mtw = mtw
+        self.bin_index = bin_index
+        self.sums = np.zeros((bins.shape[0], npts))
+        self.counts = np.zeros(bins.shape[0], dtype='int')
+
+    def assign(self, distances):
+        """
+        Returns the pairs (bin, trace) of all traces with the given distances.
+        """
+        distances = np.atleast_1d(np.asarray(distances, dtype='float'))
+        # First bin whose upper border is >= distance, last bin whose lower border is < distance.
+        first = np.searchsorted(self.upper, distances, side='left')
+        last = np.searchsorted(self.lower, distances, side='left') - 1
+        last[distances == self.lower[0]] = 0
+
+        nmember = np.clip(last - first + 1, 0, None)
+        itrace = np.repeat(np.arange(distances.size), nmember)
+        ibin = np.repeat(first, nmember) + np.arange(nmember.sum()) - np.repeat(np.cumsum(nmember) - nmember, nmember)
+
+        return ibin, itrace
+
+    def add(self, data, distances, arrival_index=None):
+        """
+        Adds the traces in data with the given distances to their bins.
+
+        :param data: traces, 1D for a single trace
+        :param distances: distance of each trace in degree
+        :param arrival_index: arrival index of the reference phase in each trace, needed
+                              if bin_index is set.
+        """
+        data = np.atleast_2d(data)
+        ibin, itrace = self.assign(distances)
+        if ibin.size == 0:
+            return
+
+        values = data[itrace]
+        if self.bin_index is not None:
+            tshift = np.atleast_1d(np.asarray(arrival_index, dtype='float'))[itrace]
+            if self.mtw:
+                tshift = self._pick(values, tshift)
+            values = shift_data(values, self.bin_index[ibin] - tshift, method=self.shiftmethod)
+
+        if self.order is not None and float(self.order) != 1.:
+            values = np.sign(values) * abs(values) ** (1. / float(self.order))
+
+        np.add.at(self.sums, ibin, values)
+        self.counts += np.bincount(ibin, minlength=self.counts.size)
+
+    def result(self):
+        """
+        Returns the stack of each bin, empty bins are zero.
+        """
+        bin_data = np.zeros(self.sums.shape)
+        filled = self.counts > 0
+        bin_data[filled] = self.sums[filled] / self.counts[filled, np.newaxis]
+        if self.order is not None and float(self.order) != 1.:
+            bin_data = np.sign(bin_data) * abs(bin_data) ** float(self.order)
+        return bin_data
+
+    def _pick(self, values, tshift):
+        # Index of the maximum (or minimum for negative mtw) around each arrival.
+        half = int(abs(self.mtw) / 2.)
+        index = np.round(tshift).astype('int')[:, np.newaxis] + np.arange(-half, half + 1)[np.newaxis, :]
+        index = np.clip(index, 0, values.shape[1] - 1)
+        window = values[np.arange(values.shape[0])[:, np.newaxis], index]
+        if self.mtw > 0:
+            ipick = window.argmax(axis=1)
+        else:
+            ipick = window.argmin(axis=1)
+        return index[np.arange(values.shape[0]), ipick].astype('float')
 
 
 def resample_partial_stack(st, bin_size=None, refphase='P', overlap=None,
@@ -1363,18 +1446,13 @@ def resample_partial_stack(st, bin_size=None, refphase='P', overlap=None,
                 break
 
     else:
-        no_of_bins = math.ceil( ( epidist.max()-epidist.min() ) / bin_size )
-        L = np.linspace(min(epidist), max(epidist), no_of_bins + 1)
-        L = zip(L, np.roll(L, -1))
-        L = L[0:len(L) - 1]
+        no_of_bins = int(math.ceil( ( epidist.max()-epidist.min() ) / bin_size ))
+        edges = np.linspace(min(epidist), max(epidist), no_of_bins + 1)
+        L = list(zip(edges[:-1], edges[1:]))
 
         # Resample the y-axis information to new, equally distributed ones.
-        y_resample = np.linspace(min(min(L)) + bin_size / 2., max(max(L)) - bin_size / 2., no_of_bins)
-        bin_distribution = np.zeros(len(y_resample))
+        y_resample = np.linspace(edges[0] + bin_size / 2., edges[-1] - bin_size / 2., no_of_bins)
 
-    # Preallocate some space in memory.
-    bin_data = np.zeros((len(y_resample), data.shape[1]))
-    m = TauPyModel(taup_model)
     depth = st_tmp[0].stats.depth
     delta = st_tmp[0].stats.delta
 
@@ -1397,61 +1475,24 @@ def resample_partial_stack(st, bin_size=None, refphase='P', overlap=None,
         mtw = 0.
 
     # Calculate theoretical arrivals of each bin.
-    yr_sampleindex = np.zeros(len(y_resample)).astype('int')
-    yi_sampleindex = np.zeros(len(epidist)).astype('int')
+    yr_sampleindex = np.zeros(len(y_resample))
+    yi_sampleindex = np.zeros(len(epidist))
 
     if refphase:
-        try:
-            for i, res_distance in enumerate(y_resample):
-                yr_sampleindex[i] = int(m.get_travel_times(depth, res_distance, phase_list=[refphase])[0].time / delta)
-
-            for i, epi_distance in enumerate(epidist):
-                yi_sampleindex[i] = int(m.get_travel_times(depth, epi_distance, phase_list=[refphase])[0].time / delta)
-        except:
-            for i, res_distance in enumerate(y_resample):
-                yr_sampleindex[i] = int(m.get_travel_times(depth, res_distance, phase_list=[refphase+'diff'])[0].time / delta)
-
-            for i, epi_distance in enumerate(epidist):
-                yi_sampleindex[i] = int(m.get_travel_times(depth, epi_distance, phase_list=[refphase+'diff'])[0].time / delta)
-
-    # Loop through all bins.
-    for i, bins in enumerate(L):
-
-        # Loop through all traces.
-        for j, trace in enumerate(data):
-
-            # First bin.
-            if i == 0:
-                if epidist[j] <= bins[1]:
-                    if refphase:
-                        trace_shift, shif_index = shift2ref(trace, yr_sampleindex[i], yi_sampleindex[j], mtw,
-                                                            method=shiftmethod)
-                    else:
-                        trace_shift = trace
-                    stack_arr = np.vstack([bin_data[i], trace_shift])
-                    bin_data[i] = stack(stack_arr, order)
-
-            # Check if current trace is inside bin-boundaries.
-            if epidist[j] > bins[0] and epidist[j] <= bins[1]:
-                if refphase:
-                    trace_shift, shif_index = shift2ref(trace, yr_sampleindex[i], yi_sampleindex[j], mtw,
-                                                        method=shiftmethod)
-                else:
-                    trace_shift = trace
-
-                stack_arr = np.vstack([bin_data[i], trace_shift])
-                bin_data[i] = stack(stack_arr, order)
-
-            if overlap:
-                if i == len(L):
-                    if refphase:
-                        trace_shift, shif_index = shift2ref(trace, yr_sampleindex[i], yi_sampleindex[j], mtw,
-                                                            method=shiftmethod)
-                    else:
-                        trace_shift = trace
-
-                    stack_arr = np.vstack([bin_data[i], trace_shift])
-                    bin_data[i] = stack(stack_arr, order)
+        yr_time = traveltimes(depth, y_resample, refphase, taup_model)
+        yi_time = traveltimes(depth, epidist, refphase, taup_model)
+        # Use the diffracted phase, if refphase does not exist at all distances.
+        if np.isnan(yr_time).any() or np.isnan(yi_time).any():
+            yr_time = traveltimes(depth, y_resample, refphase + 'diff', taup_model)
+            yi_time = traveltimes(depth, epidist, refphase + 'diff', taup_model)
+        yr_sampleindex = yr_time / delta
+        yi_sampleindex = yi_time / delta
+
+    # All traces are added to their bins in one pass.
+    binstack = PartialStack(L, data.shape[1], order=order, shiftmethod=shiftmethod, mtw=mtw,
+                            bin_index=yr_sampleindex if refphase else None)
+    binstack.add(data, epidist, yi_sampleindex if refphase else None)
+    bin_data = binstack.result()
 
     st_binned = array2stream(bin_data)
     st_binned.normalize()
@@ -1497,7 +1538,7 @@ def shift2ref(array, tref, tshift, ref_array=None, mtw=0, method='normal', xcorr
 
     :param tref: Reference index, to be shifted, if crosscorrelation is needed,
 
-    :param tshift: Nondimensional shift value
+    :param tshift: Nondimensional shift value, fractional values are possible with method 'fft'
 
     :param mtw: Maximum nondimensional timewindow symmetrical around tref,
                 in which to calculate the highest value of array
@@ -1506,15 +1547,26 @@ def shift2ref(array, tref, tshift, ref_array=None, mtw=0, method='normal', xcorr
     Source: Gubbins, D., 2004 Time series analysis and inverse theory for geophysicists
     """
     trace = array.copy()
+    shift_value = _shift_value(trace, tref, tshift, ref_array, mtw, method, xcorr)
+    shift_trace = shift_data(trace, shift_value, method=method)
+
+    return shift_trace, shift_value
+
+
+def _shift_value(trace, tref, tshift, ref_array=None, mtw=0, method='normal', xcorr=False):
+    """
+    Shift value of trace as used by shift2ref, rounded for method 'normal'.
+    """
     if isinstance(mtw, float) and mtw == 0: mtw = None
+    itshift = int(round(tshift))
 
     # if mtw is set
     if isinstance(mtw, float) and not xcorr:
         if mtw > 0:
-            tmin = tshift - int(abs(mtw) / 2.)
-            tmax = tshift + int(abs(mtw) / 2.)
-            stmax = trace[tshift]
-            mtw_index = tshift
+            tmin = itshift - int(abs(mtw) / 2.)
+            tmax = itshift + int(abs(mtw) / 2.)
+            stmax = trace[itshift]
+            mtw_index = itshift
             for k in range(tmin, tmax + 1):
                 if trace[k] > stmax:
                     stmax = trace[k]
@@ -1522,10 +1574,10 @@ def shift2ref(array, tref, tshift, ref_array=None, mtw=0, method='normal', xcorr
             shift_value = tref - mtw_index
 
         elif mtw < 0:
-            tmin = tshift - int(abs(mtw) / 2.)
-            tmax = tshift + int(abs(mtw) / 2.)
-            stmax = trace[tshift]
-            mtw_index = tshift
+            tmin = itshift - int(abs(mtw) / 2.)
+            tmax = itshift + int(abs(mtw) / 2.)
+            stmax = trace[itshift]
+            mtw_index = itshift
             for k in range(tmin, tmax + 1):
                 if trace[k] < stmax:
                     stmax = trace[k]
@@ -1536,10 +1588,10 @@ def shift2ref(array, tref, tshift, ref_array=None, mtw=0, method='normal', xcorr
 
     elif isinstance(mtw, np.ndarray) and not xcorr:
         if mtw[0] >= 0:
-            tmin = tshift - int(mtw[0])
-            tmax = tshift + int(mtw[1])
+            tmin = itshift - int(mtw[0])
+            tmax = itshift + int(mtw[1])
             stmax = trace[tmin]
-            mtw_index = tshift
+            mtw_index = itshift
             for k in np.arange(tmin, tmax + 1).astype('int'):
                 if trace[k] > stmax:
                     stmax = trace[k]
@@ -1547,10 +1599,10 @@ def shift2ref(array, tref, tshift, ref_array=None, mtw=0, method='normal', xcorr
             shift_value = tref - mtw_index
 
         elif mtw[0] < 0:
-            tmin = tshift - abs(int(mtw[0]))
-            tmax = tshift + abs(int(mtw[1]))
+            tmin = itshift - abs(int(mtw[0]))
+            tmax = itshift + abs(int(mtw[1]))
             stmax = trace[tmin]
-            mtw_index = tshift
+            mtw_index = itshift
             for k in np.arange(tmin, tmax + 1).astype('int'):
                 if trace[k] < stmax:
                     stmax = trace[k]
@@ -1559,14 +1611,14 @@ def shift2ref(array, tref, tshift, ref_array=None, mtw=0, method='normal', xcorr
 
     elif xcorr:
         if not isinstance(ref_array, np.ndarray):
-            msg('No reference Trace for X-Correlation found!')
+            msg = 'No reference Trace for X-Correlation found!'
             raise IOError(msg)
 
         if isinstance(mtw, float):
-            tw = truncate(trace, tshift - mtw, tshift + mtw, absolute=True)
+            tw = truncate(trace, int(itshift - mtw), int(itshift + mtw), absolute=True, copy=False)
 
         elif isinstance(mtw, np.ndarray):
-            tw = truncate(trace, tshift - mtw[0], tshift + mtw[1], absolute=True)
+            tw = truncate(trace, int(itshift - mtw[0]), int(itshift + mtw[1]), absolute=True, copy=False)
 
         shift_value = tref - tshift - (
         correlate(ref_array, tw).argmax() + 1 - tw.size)  # tref - (correlate(ref_array, tw).argmax()+1 - tw.size)
@@ -1574,63 +1626,72 @@ def shift2ref(array, tref, tshift, ref_array=None, mtw=0, method='normal', xcorr
     else:
         shift_value = tref - tshift
 
-    if method in ("normal", "Normal"):
-        shift_trace = np.roll(trace, shift_value)
-    if method in ("FFT", "fft", "Fft", "fFt", "ffT", "FfT"):
-        it = trace.size
-        iF = int(math.pow(2, nextpow2(it)))
-        dft = np.fft.fft(trace, iF)
-
-        arg = -2. * np.pi * shift_value / float(iF)
-        dft_shift = np.zeros(dft.size).astype('complex')
+    if method.lower() == 'normal':
+        shift_value = int(round(shift_value))
 
-        for i, ampl in enumerate(dft):
-            dft_shift[i] = ampl * np.complex(np.cos(i * arg), np.sin(i * arg))
+    return shift_value
 
-        shift_trace = np.fft.ifft(dft_shift, iF)
-        shift_trace = shift_trace[0:it].real
-
-    return shift_trace, shift_value
 
-
-def stack(data, order=None):
+def stack(data, order=None, weights=None, phase_weight=None, axis=-2):
     """
+    Stacks the traces in data, all kernels are vectorized over the remaining axes,
+    e.g. a block of (slowness, trace, time) is stacked over the traces in one call.
+
     :param data: Array of data, that should be stacked.
-                   Stacking is performed over axis = 1
+                 Stacking is performed over axis, default are the traces in axis -2,
+                 the samples are expected in the last axis.
     :type data: array_like
 
-    :param order: Order of the stack
+    :param order: Order of the Nth-root stack, None or 1 for a linear stack.
     :type order: int
 
+    :param weights: Weight of each trace for a weighted stack, along axis.
+    :type weights: array_like
+
+    :param phase_weight: Power of the phase-weighted stack, the stack is multiplied with the
+                         coherence of the instantaneous phases of the traces to this power.
+    :type phase_weight: float
+
+    :param axis: Axis of the traces.
+    :type axis: int
+
     Author: S. Schneider, 2016
     Reference: Rost, S. & Thomas, C. (2002). Array seismology: Methods and Applications
+               Schimmel, M. & Paulssen, H. (1997). Noise reduction and detection of weak, coherent
+               signals through phase-weighted stacks, GJI, 130, 497-505
     """
+    data = np.asarray(data)
+    if data.dtype != np.float32:
+        data = data.astype('float', copy=False)
+    if weights is None:
+        def mean(x):
+            return x.mean(axis=axis)
+    else:
+        shape = [1] * data.ndim
+        shape[axis] = data.shape[axis]
+        weights = np.asarray(weights, dtype=data.dtype).reshape(shape)
 
-    vNth = 0
-    v = 0
-    # if order is not None
-    try:
-        order = float(order)
-
-        datasgn = np.sign(data)
-        dataNth = abs(data) ** (1. / order)
-
-        for i, trNth in enumerate(dataNth):
-            vNth = vNth + datasgn[i] * trNth
+        def mean(x):
+            return (x * weights).sum(axis=axis) / weights.sum()
 
-        vNth = vNth / data.shape[0]
-        vsgn = np.sign(vNth)
-        v = vsgn * abs(vNth) ** order
+    if order is None or float(order) == 1.:
+        v = mean(data)
+    else:
+        order = float(order)
+        vNth = mean(np.sign(data) * abs(data) ** (1. / order))
+        v = np.sign(vNth) * abs(vNth) ** order
 
-    except TypeError:
-        for trace in data:
-            v = v + trace
-        v = v / data.shape[0]
+    if phase_weight:
+        analytic = hilbert(data, axis=-1)
+        magnitude = abs(analytic)
+        magnitude[magnitude == 0] = 1.
+        coherence = abs(mean(analytic / magnitude))
+        v = v * coherence ** phase_weight
 
     return v
 
 
-def truncate(data, tmin, tmax, absolute=False):
+def truncate(data, tmin, tmax, absolute=False, copy=True):
     """
     Truncates the data array on the left to tmin, on the right to right-end  - tmax.
 
@@ -1639,49 +1700,32 @@ def truncate(data, tmin, tmax, absolute=False):
     :param tmin: new start index
 
     :param tmax: difference of the ending indicies
-    """
-    if absolute:
-        if data.ndim > 1:
-            trunc_n = tmax - tmin
-            trunc_data = np.zeros((data.shape[0], trunc_n))
 
-            for i, trace in enumerate(data):
-                trunc_data[i, :] = trace[tmin:tmax]
-
-        else:
-            trunc_n = tmax - tmin
-            trunc_data = np.array(trunc_n)
-
-            for x in data:
-                trunc_data = data[tmin:tmax]
+    :param absolute: If True, tmax is the new end index.
 
+    :param copy: If False, a view of data is returned, which shares the memory of data.
+    :type copy: bool
+    """
+    data = np.asarray(data)
+    if absolute:
+        trunc_data = data[..., tmin:tmax]
     else:
-        if data.ndim > 1:
-            trunc_n = data.shape[1] - tmin - tmax
-            trunc_data = np.zeros((data.shape[0], trunc_n))
-
-            for i, trace in enumerate(data):
-                trunc_data[i, :] = trace[tmin:trace.size - tmax]
-
-        else:
-            trunc_n = data.size - tmin - tmax
-            trunc_data = np.array(trunc_n)
-
-            for x in data:
-                trunc_data = data[tmin:data.size - tmax]
+        trunc_data = data[..., tmin:data.shape[-1] - tmax]
 
+    if copy:
+        return trunc_data.copy()
     return trunc_data
 
 
 def vespagram(stream, slomin=-5, slomax=5, slostep=0.1, inv=None, event=None,
               power=4, plot=False, cmap='seismic',
               markphases=None, method='fft',
-              tw=None, zoom=1, savefig=False, dpi=400, fs=25):
+              tw=None, zoom=1, savefig=False, dpi=400, fs=25, max_memory=256., workers=1, precision=None):
     """
     Creates a vespagram for the given slownessrange and slownessstepsize. Returns the vespagram as numpy array
     and if set a plot.
 
-    :param st: Stream
+    :param st: Stream, ArrayGather or GatherStore, the latter is processed in chunks of traces
     :type st: obspy.core.stream.Stream
 
     :param inv: inventory
@@ -1712,6 +1756,16 @@ def vespagram(stream, slomin=-5, slomax=5, slostep=0.1, inv=None, event=None,
     :param method: Shift method, to be used 'FFT' or 'normal'
     :type  method: string
 
+    :param max_memory: Upper limit of the memory in MB, used for the shifted traces of
+                       a block of slownesses in method 'fft'.
+    :type  max_memory: float
+
+    :param workers: Number of processes, the slowness range is split into. The data is
+                    shared with the processes, max_memory is divided between them.
+    :type  workers: int
+
+    :param precision: 'single' to calculate in float32/complex64, default see base.set_precision
+    :type  precision: str
 
     returns:
 
@@ -1731,111 +1785,296 @@ def vespagram(stream, slomin=-5, slomax=5, slostep=0.1, inv=None, event=None,
     """
 
     # Prepare and convert objects.
-    # Find geometrical center station of array. If fails, the first trace is used.
-    st = stream.copy()
-    data = stream2array(st, normalize=True)
+    if isinstance(stream, GatherStore):
+        gather = stream.meta
+    elif isinstance(stream, ArrayGather):
+        gather = stream
+    else:
+        gather = ArrayGather.from_stream(stream, inv, event)
+    real, cplx = precision_dtypes(precision)
+    if not isinstance(stream, GatherStore):
+        data = normalize_array(gather.data).astype(real, copy=False)
 
+    # Find geometrical center station of array. If fails, the first trace is used.
     if isinstance(inv, Inventory):
-        attach_network_to_traces(st, inv)
-        attach_coordinates_to_traces(st, inv, event)
-
         center = geometrical_center(inv)
-        cstat = find_closest_station(inv, st, center['latitude'], center['longitude'])
+        cstat = find_closest_station(inv, gather, center['latitude'], center['longitude'])
 
-        for i, trace in enumerate(st):
-            if not trace.stats.station in [cstat]:
+        for i, station in enumerate(gather.stations):
+            if not station in [cstat]:
                 continue
             else:
                 sref = i
+    elif isinstance(stream, (ArrayGather, GatherStore)):
+        sref = gather.center_index()
     else:
         sref = 0
 
-    epidist = np.zeros(data.shape[0])
-    for i, trace in enumerate(st):
-        epidist[i] = trace.stats.distance
-    # epidist.sort()
+    epidist = gather.distance
+    if np.isnan(epidist).any():
+        msg = 'No distance information found, add Inventory and Event'
+        raise IOError(msg)
 
     dx = (epidist.max() - epidist.min() + 1) / epidist.size
-    dsample = st[0].stats.delta
-    Nsample = st[0].stats.npts
+    dsample = gather.delta
+    if isinstance(stream, GatherStore):
+        Nsample = stream.npts
+    else:
+        Nsample = gather.npts
 
     # Prepare slownessrange, and allocate space in memory.
     uN = int((slomax - slomin) / slostep + 1)
     urange = np.linspace(slomin, slomax, uN)
+    vespa = np.zeros((uN, Nsample), dtype=real)
+    taxis = np.arange(Nsample) * dsample
+
+    # Delay of each trace per slowness unit, in samples.
+    delays = (-(epidist - epidist[sref]) / dsample).astype(real)
+    urange = urange.astype(real)
+    if isinstance(stream, GatherStore):
+        _vespagram_store(stream, delays, urange, power, method, max_memory, vespa)
+    elif workers and workers > 1:
+        _vespagram_parallel(data, delays, urange, power, method, max_memory, vespa, workers)
+    else:
+        _vespagram_rows(data, delays, urange, power, method, max_memory, vespa)
+
+    vespa = vespa / abs(vespa).max()
+
+    # Plotting routine
+    if plot:
+        plot_vespa(data=(vespa, taxis, urange), st=gather.to_stream(), inv=inv, event=event, markphases=markphases, plot=plot, \
+                   cmap=cmap, tw=tw, savefig=savefig, dpi=dpi, fs=fs, power=power, zoom=zoom)
+
+    return vespa, taxis, urange
+
+
+def _vespagram_rows(data, delays, urange, power, method, max_memory, vespa):
+    """
+    Fills the rows of vespa with the stacks of data for the slownesses in urange.
+    delays are the shifts of each trace in samples per slowness unit. float32 data
+    are processed in single precision.
+
+    With method 'fft' the spectrum of data is calculated once and the phase ramps are
+    built for blocks of slownesses, which fit into max_memory MB. Linear stacks are
+    summed in the frequency domain, Nth-root stacks after the inverse fft of the block.
+    """
     it = data.shape[1]
-    iF = int(math.pow(2, nextpow2(it)))
-    dft = np.fft.fft(data, iF, axis=1)
-    vespa = np.zeros((uN, data.shape[1]))
-    taxis = np.arange(data.shape[1]) * dsample
-
-    if method in ("fft"):
-        # Calculate timeshift-table as a tensor, see shift2ref method "fft" as guide.
-        timeshift_table = np.zeros((data.shape[0], urange.size, dft.shape[1])).astype('complex')
-
-        # Slowness-Loop
-        for j, slo in enumerate(urange):
-
-            # Station-Loop
-            for i in range(timeshift_table.shape[0]):
-                sshift = int(abs(epidist[sref] - epidist[i]) * slo / dsample)
-                if epidist[i] > epidist[sref]:
-                    timeshift_table[i][j] = np.exp(
-                        (0. + 1j) * (2. * np.pi * sshift / float(iF)) * np.arange(dft.shape[1]))
-                elif epidist[i] < epidist[sref]:
-                    timeshift_table[i][j] = np.exp(
-                        (0. + 1j) * (-2. * np.pi * sshift / float(iF)) * np.arange(dft.shape[1]))
-                elif epidist[i] == epidist[sref]:
-                    timeshift_table[i][j] = 1.  # np.exp((0.+ 1j) * 0) = 1.
-
-        # Transpose the tensor in right
-        tst = timeshift_table.transpose(1, 0, 2)
-
-        # Slownesses
-        for i, shifttable in enumerate(tst):
-            dftshift = np.zeros(dft.shape).astype('complex')
-            dftshift = dft * shifttable
-
-            shiftdata = np.fft.ifft(dftshift, iF)
-            vespatrace = shiftdata.real.copy()
-
-            # Put it in the right size again.
-            vespatrace = np.delete(vespatrace, np.s_[it:], 1)
-
-            vespa[i] = stack(vespatrace, power)
-
-    if method in ("normal"):
-        shift_data_tmp = np.zeros(data.shape)
-
-        tmin = 0
-        tmax = 0
+    if method.lower() == 'fft':
+        iF = int(math.pow(2, nextpow2(it)))
+        real = np.float32 if data.dtype == np.float32 else np.float64
+        spectrum = np.fft.rfft(data, iF, axis=1).astype(np.result_type(real, np.complex64), copy=False)
+        freqs = np.fft.rfftfreq(iF).astype(real)
+        linear = power in (None, 1, 1.)
+
+        # Bytes per slowness: complex ramp and spectrum, real shifted traces.
+        itemsize = np.dtype(real).itemsize
+        nbytes = data.shape[0] * (2 * 2 * itemsize * freqs.size + itemsize * iF)
+        if linear:
+            nbytes = data.shape[0] * 2 * itemsize * freqs.size
+        blocksize = int(max(1, max_memory * 1024. ** 2 // nbytes))
+
+        for j0 in range(0, urange.size, blocksize):
+            ublock = urange[j0:j0 + blocksize]
+            ramp = np.exp(-2j * np.pi * (ublock[:, np.newaxis, np.newaxis] * delays[np.newaxis, :, np.newaxis]) *
+                          freqs[np.newaxis, np.newaxis, :])
+            if linear:
+                beams = np.einsum('if,bif->bf', spectrum, ramp) / data.shape[0]
+                vespa[j0:j0 + ublock.size] = np.fft.irfft(beams, iF, axis=1)[:, :it]
+            else:
+                ramp *= spectrum[np.newaxis, :, :]
+                shifted = np.fft.irfft(ramp, iF, axis=2)[:, :, :it]
+                del ramp
+                vespa[j0:j0 + ublock.size] = stack(shifted, power)
+
+    elif method.lower() == 'normal':
         # Loop over all slownesses.
         for i, u in enumerate(urange):
-            for j, trace in enumerate(data):
-                sshift = int(abs(epidist[sref] - epidist[j]) * u / dsample)
-                if epidist[j] > epidist[sref]:
-                    shift_data_tmp[j, :], shift_index = shift2ref(trace, 0, sshift, method="normal")
+            vespa[i, :] = stack(shift_data(data, u * delays, method='normal'), order=power)
 
-                elif epidist[j] < epidist[sref]:
-                    shift_data_tmp[j, :], shift_index = shift2ref(trace, 0, -sshift, method="normal")
+    return vespa
 
-                elif epidist[j] == epidist[sref]:
-                    shift_data_tmp[j, :] = trace
-                # Positive shift_index indicates positive shift in time and vice versa.
-                # if shift_index > 0 and shift_index > tmin: tmin = shift_index
-                # if shift_index < 0 and shift_index < tmax: tmax = abs(shift_index)
 
-            vespa[i, :] = stack(shift_data_tmp, order=power)
+def _vespagram_store(store, delays, urange, power, method, max_memory, vespa):
+    """
+    Vespagram of the traces in a GatherStore, one chunk of traces after the other. The stacks of
+    the chunks are combined to the stack of all traces, Nth-root stacks by their Nth-roots.
+    """
+    norm = store.max()
+    linear = power in (None, 1, 1.)
+    total = np.zeros(vespa.shape, dtype=vespa.dtype)
+    part = np.zeros(vespa.shape, dtype=vespa.dtype)
 
-        # vespa = truncate(vespa, tmin, tmax)
+    for t0, chunk in store.trace_chunks(dtype=vespa.dtype):
+        n = chunk.shape[0]
+        _vespagram_rows(chunk / norm, delays[t0:t0 + n], urange, power, method, max_memory, part)
+        if not linear:
+            part = np.sign(part) * abs(part) ** (1. / power)
+        total += n * part
 
-    vespa = vespa / abs(vespa).max()
+    total /= store.ntraces
+    if not linear:
+        total = np.sign(total) * abs(total) ** power
+    vespa[:] = total
 
-    # Plotting routine
-    if plot:
-        plot_vespa(data=(vespa, taxis, urange), st=st, inv=inv, event=event, markphases=markphases, plot=plot, \
-                   cmap=cmap, tw=tw, savefig=savefig, dpi=dpi, fs=fs, power=power, zoom=zoom)
+    return vespa
 
-    return vespa, taxis, urange
+
+def _vespagram_parallel(data, delays, urange, power, method, max_memory, vespa, workers):
+    """
+    Runs _vespagram_rows for parts of urange in a pool of workers processes. Input data and
+    the vespagram are placed in shared memory, each process writes its rows in place.
+    """
+    from multiprocessing import Pool, shared_memory
+
+    data = np.ascontiguousarray(data)
+    shm_data = shared_memory.SharedMemory(create=True, size=data.nbytes)
+    shm_vespa = shared_memory.SharedMemory(create=True, size=vespa.nbytes)
+    try:
+        np.ndarray(data.shape, dtype=data.dtype, buffer=shm_data.buf)[:] = data
+
+        # Some more parts than workers, to balance the load.
+        bounds = np.linspace(0, urange.size, min(urange.size, 4 * workers) + 1).astype('int')
+        jobs = [(shm_data.name, data.shape, data.dtype.str, shm_vespa.name, vespa.shape, vespa.dtype.str, delays,
+                 urange, j0, j1, power, method, max_memory / float(workers))
+                for j0, j1 in zip(bounds[:-1], bounds[1:]) if j1 > j0]
+
+        pool = Pool(workers)
+        try:
+            pool.map(_vespagram_job, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+        vespa[:] = np.ndarray(vespa.shape, dtype=vespa.dtype, buffer=shm_vespa.buf)
+    finally:
+        shm_data.close()
+        shm_data.unlink()
+        shm_vespa.close()
+        shm_vespa.unlink()
+
+    return vespa
+
+
+def _vespagram_job(job):
+    from multiprocessing import shared_memory
+
+    (data_name, data_shape, data_dtype, vespa_name, vespa_shape, vespa_dtype, delays, urange, j0, j1, power, method,
+     max_memory) = job
+    shm_data = shared_memory.SharedMemory(name=data_name)
+    shm_vespa = shared_memory.SharedMemory(name=vespa_name)
+    data = np.ndarray(data_shape, dtype=data_dtype, buffer=shm_data.buf)
+    vespa = np.ndarray(vespa_shape, dtype=vespa_dtype, buffer=shm_vespa.buf)
+    try:
+        _vespagram_rows(data, delays, urange[j0:j1], power, method, max_memory, vespa[j0:j1])
+    finally:
+        # The views have to be released, before the shared memory is closed.
+        del data, vespa
+        shm_data.close()
+        shm_vespa.close()
+
+
+def xcorr_lags(windows, reference):
+    """
+    Cross correlates all windows with the reference in the frequency domain, the reference
+    spectrum is calculated once and all windows are transformed in one fft.
+    The maximum of each correlation is refined by a parabola through the peak and its neighbours.
+
+    :param windows: data windows, one per row
+    :type  windows: numpy.ndarray, 2D
+
+    :param reference: reference window
+    :type  reference: numpy.ndarray, 1D
+
+    returns:
+    :param lags: fractional lag in samples for each window, positive values mean, that
+                 the signal in the window arrives later in the reference
+    :param coeffs: normalized correlation coefficient at the maximum
+    """
+    windows = np.atleast_2d(windows)
+    nw = windows.shape[1]
+    nr = reference.size
+    nfft = int(math.pow(2, nextpow2(nw + nr - 1)))
+
+    spec = np.fft.rfft(windows, nfft, axis=1) * np.conj(np.fft.rfft(reference, nfft))[np.newaxis, :]
+    cc = np.fft.irfft(spec, nfft, axis=1)
+    # Reorder to lags from -(nr - 1) to nw - 1.
+    cc = np.hstack((cc[:, nfft - nr + 1:], cc[:, :nw]))
+
+    rows = np.arange(cc.shape[0])
+    imax = cc.argmax(axis=1)
+    inner = (imax > 0) & (imax < cc.shape[1] - 1)
+    y0 = cc[rows, np.clip(imax - 1, 0, None)]
+    y1 = cc[rows, imax]
+    y2 = cc[rows, np.clip(imax + 1, None, cc.shape[1] - 1)]
+    curvature = y0 - 2. * y1 + y2
+    refine = inner & (curvature < 0)
+    offset = np.zeros(cc.shape[0])
+    offset[refine] = 0.5 * (y0[refine] - y2[refine]) / curvature[refine]
+
+    lags = (nr - 1) - imax - offset
+
+    norm = np.sqrt((windows ** 2).sum(axis=1) * (reference ** 2).sum())
+    norm[norm == 0] = 1.
+    coeffs = y1 / norm
+
+    return lags, coeffs
+
+
+def xcorr_shifts(data, phase_n, mtw, iref=0, iterations=0, tolerance=0.05):
+    """
+    Shift values to align the traces in data on the reference trace by cross correlation of
+    the windows around the theoretical arrivals. With iterations > 0 the traces are
+    correlated with the stack of the aligned windows afterwards, until the shifts
+    change less than tolerance samples.
+
+    :param data: array of traces
+    :type  data: numpy.ndarray, 2D
+
+    :param phase_n: theoretical arrival index of each trace
+    :type  phase_n: numpy.ndarray
+
+    :param mtw: Nondimensional timewindow symmetrical around the arrival, or
+                array with the samples before and after the arrival
+    :type  mtw: float or numpy.ndarray
+
+    :param iref: index of the reference trace
+    :type  iref: int
+
+    :param iterations: maximum number of iterations with the stack as reference
+    :type  iterations: int
+
+    :param tolerance: convergence criterium of the iterations in samples
+    :type  tolerance: float
+
+    returns:
+    :param shift_indices: fractional shift values for each trace, 0 for the reference trace
+    """
+    if isinstance(mtw, np.ndarray):
+        before = int(abs(mtw[0]))
+        after = int(abs(mtw[1]))
+    else:
+        before = int(abs(mtw))
+        after = int(abs(mtw))
+
+    npts = data.shape[1]
+    start = np.round(phase_n).astype('int') - before
+    index = start[:, np.newaxis] + np.arange(before + after + 1)[np.newaxis, :]
+    inside = (index >= 0) & (index < npts)
+    windows = np.where(inside, data[np.arange(data.shape[0])[:, np.newaxis], np.clip(index, 0, npts - 1)], 0.)
+
+    lags, coeffs = xcorr_lags(windows, windows[iref])
+    lags -= lags[iref]
+
+    for i in range(iterations):
+        beam = shift_data(windows, lags).mean(axis=0)
+        lags_new, coeffs = xcorr_lags(windows, beam)
+        lags_new -= lags_new[iref]
+        change = abs(lags_new - lags).max()
+        lags = lags_new
+        if change < tolerance:
+            break
+
+    return start[iref] - start + lags
 
 
 def dist_azimuth2gps(lat1, lon1, azimuth, distance):
@@ -2,6 +2,7 @@ from __future__ import absolute_import
 import numpy as np
 import scipy as sp
 import math
+import os
 import obspy
 from obspy.clients.fdsn import Client
 from obspy import Stream, Trace
@@ -14,11 +15,25 @@ Basic collection of fundamental functions for the SiPy lib
 Author: S. Schneider 2016
 """
 
+# Default floating point precision of the processing functions, 'double' or 'single',
+# see set_precision.
+PRECISION = 'double'
 
-def array2stream(ArrayData, st_original=None, network=None):
+_PRECISION_DTYPES = {'double': (np.dtype('float64'), np.dtype('complex128')),
+                     'single': (np.dtype('float32'), np.dtype('complex64'))}
+
+
+def array2stream(ArrayData, st_original=None, network=None, share_stats=False):
     """
     param network: Network, of with all the station information
     type network: obspy.core.inventory.network.Network
+
+    The rows of ArrayData become the data of the traces without copying them. The stats
+    of st_original are copied, the data of st_original are never copied.
+
+    param share_stats: If True, the traces share the stats objects of st_original instead of
+                       copies, only use it if st_original is not used afterwards.
+    type share_stats: bool
     """
     if ArrayData.ndim == 1:
 
@@ -44,21 +59,15 @@ def array2stream(ArrayData, st_original=None, network=None):
         # if possible input original stream
 
         if isinstance(st_original, Stream):
-            st_tmp = st_original.copy()
-            # Checks length of ArrayData and st_original, if needed,
-            # corrects trace.stats.npts value of new generated Stream-object.
-            if ArrayData.shape[1] == len(st_tmp[0]):
+            # Corrects trace.stats.npts value of new generated Stream-object, if needed.
+            for i, trace in enumerate(stream):
+                if share_stats:
+                    trace.stats = st_original[i].stats
+                else:
+                    trace.stats = st_original[i].stats.copy()
+                trace.stats.npts = ArrayData.shape[1]
 
-                for i, trace in enumerate(stream):
-                    trace.stats = st_tmp[i].stats
-
-            else:
-
-                for i, trace in enumerate(stream):
-                    trace.stats = st_tmp[i].stats
-                    trace.stats.npts = ArrayData.shape[1]
-
-        elif isinstance(network, Network) and not isinstance(st_tmp, Stream):
+        elif isinstance(network, Network):
 
             for trace in stream:
                 trace.meta.network = network.code
@@ -86,9 +95,19 @@ def array2trace(ArrayData, st_original=None):
     return trace
 
 
-def cat4stream(stream, client_name):
+def cat4stream(stream, client_name, cache=False):
+    """
+    Catalog of the events in the stats of the traces, requested from client_name.
 
-    client = Client(client_name)
+    :param cache: Events are kept in the local request cache, see
+                  bowpy.util.request_cache. True for the default cache, False for none
+                  (default)
+    """
+    from bowpy.util.download import get_client
+    from bowpy.util.request_cache import cached_request, resolve_cache
+
+    cache = resolve_cache(cache)
+    client = get_client(client_name, offline=cache is not None and cache.offline)
     cat = obspy.core.event.Catalog()
     lat_old = None
     lon_old = None
@@ -120,9 +139,9 @@ def cat4stream(stream, client_name):
         if i > 0 and lat == lat_old and lon == lon_old and stime == stime_old:
             continue
 
-        cat_tmp = client.get_events(starttime=stime, endtime=etime,
-                                    maxdepth=depth, latitude=lat,
-                                    longitude=lon, maxradius=1)
+        params = dict(starttime=stime, endtime=etime, maxdepth=depth, latitude=lat, longitude=lon,
+                      maxradius=1)
+        cat_tmp = cached_request(cache, 'event', client, client.get_events, **params)
 
         lat_old = lat
         lon_old = lon
@@ -247,6 +266,23 @@ def create_sine(no_of_traces=10, len_of_traces=30000, samplingrate=30000,
     return(data, t)
 
 
+def cache_dir(subdir=None):
+    """
+    Returns the directory of the local bowpy cache and creates it, if needed.
+    Default is ~/.bowpy/cache, it can be changed with the environment variable
+    BOWPY_CACHE.
+
+    :param subdir: Name of a subdirectory inside the cache
+    :type  subdir: str
+    """
+    path = os.environ.get('BOWPY_CACHE', os.path.join(os.path.expanduser('~'), '.bowpy', 'cache'))
+    if subdir:
+        path = os.path.join(path, subdir)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+
 def cut2shortest(stream):
     """
     Cuts traces in stream to the same length. Looks for the latest beginning
@@ -265,7 +301,14 @@ def cut2shortest(stream):
     return stream
 
 
-def inv4stream(stream, client_name):
+def inv4stream(stream, client_name, cache=False):
+    """
+    Inventory of the stations of the traces, requested from client_name.
+
+    :param cache: see cat4stream
+    """
+    from bowpy.util.download import get_client
+    from bowpy.util.request_cache import cached_request, resolve_cache
 
     stat = ""
     for i, trace in enumerate(stream):
@@ -275,8 +318,9 @@ def inv4stream(stream, client_name):
         stat = stat + trace.stats.station + ','
 
     stat = str(stat)
-    client = Client(client_name)
-    inv = client.get_stations(station=stat)
+    cache = resolve_cache(cache)
+    client = get_client(client_name, offline=cache is not None and cache.offline)
+    inv = cached_request(cache, 'station', client, client.get_stations, station=stat)
 
     return inv
 
@@ -333,6 +377,23 @@ def nextpow2(i):
     return count
 
 
+def normalize_array(x):
+    """
+    Returns x divided by its maximum. NaN values are set to 0, if the maximum is 0, x is
+    returned unchanged. x itself is not modified.
+    """
+    xmax = x.max()
+    if math.isnan(xmax):
+        print('Maximum values are NaN, set to 0')
+        x = np.where(np.isnan(x), 0., x)
+        xmax = x.max()
+
+    if xmax == 0:
+        print('Maximum value is 0')
+        return x
+    return x / xmax
+
+
 def read_file(stream, inventory, catalog, array=False):
     """
     function to read data files, such as MSEED, station-xml and quakeml, in a
@@ -350,6 +411,92 @@ def read_file(stream, inventory, catalog, array=False):
         return(st, inv, cat)
 
 
+def set_precision(precision):
+    """
+    Sets the default precision of fk_filter, pocs, vespagram, fx_ssa and radon_inverse.
+    With 'single' data, masks, steering vectors and spectra are held in float32/complex64,
+    which halves the memory. The precision argument of a single call overrides the default.
+
+    :param precision: 'double' or 'single'
+    :type precision: str
+    """
+    global PRECISION
+    if precision not in _PRECISION_DTYPES:
+        msg = "Unknown precision %s, must be 'double' or 'single'" % precision
+        raise IOError(msg)
+    PRECISION = precision
+
+
+def precision_dtypes(precision=None):
+    """
+    Returns the real and complex numpy.dtype of precision, default is the precision set by set_precision.
+    """
+    if precision is None:
+        precision = PRECISION
+    if precision not in _PRECISION_DTYPES:
+        msg = "Unknown precision %s, must be 'double' or 'single'" % precision
+        raise IOError(msg)
+    return _PRECISION_DTYPES[precision]
+
+
+def shift_data(data, shifts, method='fft', nfft=None):
+    """
+    Shifts every trace of data by its own number of samples, positive values
+    delay the trace. With method 'fft' the whole array is shifted with one
+    rfft/irfft pair and a phase ramp, so fractional shifts are possible.
+
+    :param data: array of traces, traces along axis 0
+    :type  data: numpy.ndarray, 1D or 2D
+
+    :param shifts: shift in samples for each trace, or one value for all
+    :type  shifts: float or array-like
+
+    :param method: 'fft' for the shift in the frequency domain, the data is
+                   padded with zeros to nfft. 'normal' rolls the data by the
+                   rounded number of samples.
+    :type  method: str
+
+    :param nfft: number of points of the fft, default is the next power of 2
+                 of the number of samples
+    :type  nfft: int
+
+    returns:
+    :param data_shift: shifted data, same shape as data
+    """
+    data = np.asarray(data)
+    isvector = data.ndim == 1
+    data2d = np.atleast_2d(data)
+    npts = data2d.shape[1]
+    shifts = np.broadcast_to(np.asarray(shifts, dtype='float'), (data2d.shape[0],))
+
+    if method.lower() == 'normal':
+        index = (np.arange(npts)[np.newaxis, :] - np.round(shifts).astype('int')[:, np.newaxis]) % npts
+        data_shift = data2d[np.arange(data2d.shape[0])[:, np.newaxis], index]
+
+    elif method.lower() == 'fft':
+        if not nfft:
+            nfft = int(math.pow(2, nextpow2(npts)))
+        spectrum = np.fft.rfft(data2d, nfft, axis=1)
+        freqs = np.fft.rfftfreq(nfft)
+        ramp = shifts[:, np.newaxis] * freqs[np.newaxis, :]
+        single = data2d.dtype == np.float32
+        if single:
+            spectrum = spectrum.astype('complex64', copy=False)
+            ramp = ramp.astype('float32')
+        spectrum *= np.exp(-2j * np.pi * ramp)
+        data_shift = np.fft.irfft(spectrum, nfft, axis=1)[:, :npts]
+        if single:
+            data_shift = data_shift.astype('float32', copy=False)
+
+    else:
+        msg = 'Unknown shift method %s' % method
+        raise IOError(msg)
+
+    if isvector:
+        return data_shift[0]
+    return data_shift
+
+
 def split2stations(stream, min_len=None, merge_traces=None, keep_masked=False):
     """
     Splits a stream in a list of streams, sorted by the stations inside
@@ -438,26 +585,70 @@ def stats(stream):
     return
 
 
-def stream2array(stream, normalize=False):
-    sx = stream.copy()
-    x = np.zeros((len(sx), len(sx[0].data)))
-    for i, traces in enumerate(sx):
-        x[i] = traces.data
+def stream2array(stream, normalize=False, dtype='float', npts=None, copy=True):
+    """
+    Returns the data of all traces in stream as array of shape (len(stream), npts).
+    The stream itself is not copied.
 
-    if normalize:
-        if x.max() == 0:
-            print('Maximum value is 0')
-            return(x)
+    :param normalize: Normalize the array to its maximum
+    :type normalize: bool
+
+    :param dtype: dtype of the array, e.g. 'float32' to halve the memory
+    :type dtype: str or numpy.dtype
+
+    :param npts: Length of the rows. Traces of unequal length raise an IOError, unless npts
+                 is given: an int, 'max' (pad with zeros to the longest) or 'min' (trim to the
+                 shortest trace).
+    :type npts: int or str
+
+    :param copy: If False and the traces already are the rows of one array of the right dtype,
+                 e.g. the output of array2stream, that array is returned without a copy.
+    :type copy: bool
+    """
+    datas = [trace.data for trace in stream]
+    lengths = np.array([d.size for d in datas])
 
-        elif math.isnan(x.max()):
-            print('Maximum values are NaN, set to 0')
-            n = np.isnan(x)
-            x[n] = 0.
+    if npts is None:
+        if lengths.min() != lengths.max():
+            msg = 'Traces of unequal length, set npts to pad or trim them'
+            raise IOError(msg)
+        npts = lengths[0]
+    elif npts == 'max':
+        npts = lengths.max()
+    elif npts == 'min':
+        npts = lengths.min()
+
+    x = None
+    if not copy and not normalize:
+        x = _common_base(datas, npts, dtype)
+
+    if x is None:
+        # One allocation, the rows are cast while copying.
+        x = np.zeros((len(datas), npts), dtype=dtype)
+        for i, d in enumerate(datas):
+            x[i, :min(npts, d.size)] = d[:npts]
 
-        x = x / x.max()
+    if normalize:
+        x = normalize_array(x)
     return(x)
 
 
+def _common_base(datas, npts, dtype):
+    """
+    Returns the 2D array, of which datas are the consecutive rows, or None.
+    """
+    base = datas[0].base
+    if not isinstance(base, np.ndarray) or base.ndim != 2 or base.shape != (len(datas), npts):
+        return None
+    if base.dtype != np.dtype(dtype):
+        return None
+    start = base.__array_interface__['data'][0]
+    for i, d in enumerate(datas):
+        if d.base is not base or d.__array_interface__['data'][0] != start + i * base.strides[0]:
+            return None
+    return base
+
+
 def LCM(a, b):
     """
     Calculates the least common multiple of two values
@@ -482,7 +673,7 @@ def line_cut(array, shape):
     name = shape[0]
     kwarg = shape[1]
     length = shape[2]
-    new_array = np.zeros(array.shape).astype('complex')
+    new_array = np.zeros(array.shape, dtype=np.result_type(array, np.complex64))
     if name in ['spike', 'Spike']:
         new_array[0] = array[0]
         return new_array
@@ -496,15 +687,15 @@ def line_cut(array, shape):
         return new_array
 
     elif name in ['butterworth', 'Butterworth', 'taper', 'Taper'] and isinstance(length, int):
-        fil_lh = create_filter(name, array.shape[0]/2, length, kwarg)
+        fil_lh = create_filter(name, array.shape[0]//2, length, kwarg)
 
     elif name in ['taper', 'Taper'] and isinstance(length, int):
-        fil_lh = create_filter(name, array.shape[0]/2, length, kwarg)
+        fil_lh = create_filter(name, array.shape[0]//2, length, kwarg)
 
     fil_rh = np.flipud(fil_lh)[::-1][0:][::-1]
-    fil = np.zeros(2*fil_lh.size)
-    fil[:fil.size/2] = fil_lh
-    fil[fil.size/2:] = fil_rh
+    fil = np.zeros(2*fil_lh.size, dtype=array.real.dtype)
+    fil[:fil.size//2] = fil_lh
+    fil[fil.size//2:] = fil_rh
 
     new_array = array.transpose() * fil
     new_array = new_array.transpose()
@@ -544,17 +735,17 @@ def line_set_zero(array, shape):
         return new_array
 
     elif name in ['butterworth', 'Butterworth', 'taper', 'Taper'] and isinstance(length, int):
-        fil_lh = create_filter(name, array.shape[0]/2, length, kwarg)
+        fil_lh = create_filter(name, array.shape[0]//2, length, kwarg)
 
     elif name in ['taper', 'Taper'] and isinstance(length, int):
-        fil_lh = create_filter(name, array.shape[0]/2, length, kwarg)
+        fil_lh = create_filter(name, array.shape[0]//2, length, kwarg)
         # fil_lh = -1. * fil_lh + 1.
 
     fil_rh = np.flipud(fil_lh)[::-1][1:][::-1]
-    fil = np.zeros(2*fil_lh.size)
-    fil[:fil.size/2] = fil_lh
-    fil[fil.size/2+1:] = fil_rh
-    newfil = np.ones(fil.shape)
+    fil = np.zeros(2*fil_lh.size, dtype=array.real.dtype)
+    fil[:fil.size//2] = fil_lh
+    fil[fil.size//2+1:] = fil_rh
+    newfil = np.ones(fil.shape, dtype=fil.dtype)
     newfil = newfil - fil
 
     new_array = array.transpose() * newfil
@@ -3,13 +3,21 @@ import matplotlib.pyplot as plt
 from obspy import UTCDateTime
 from obspy.clients.fdsn import Client
 from obspy import Stream
-from obspy.geodetics import locations2degrees, gps2dist_azimuth
-from obspy.taup import TauPyModel
 from obspy.core.event import Catalog, Event, Magnitude, Origin, MomentTensor
+from functools import partial
+import os
 import sys
-from bowpy.util.array_util import (center_of_gravity, attach_network_to_traces,
-                                   attach_coordinates_to_traces,
-                                   geometrical_center)
+from bowpy.util.array_util import (attach_network_to_traces,
+                                   attach_coordinates_to_traces)
+from bowpy.util.download import (download_waveforms, download_waveforms_bulk,
+                                  get_client)
+from bowpy.util.event_geometry import EventGeometry
+from bowpy.util.gcmt import get_gcmt_table
+from bowpy.util.manifest import DONE, NODATA, FAILED, get_manifest
+from bowpy.util.pipeline import (Pipeline, Stage, preprocess_stream,
+                                 stream_nbytes)
+from bowpy.util.request_cache import cached_request, resolve_cache
+from bowpy.util.writer import AsyncWriter, atomic_write, get_writer
 from nmpy.util.writeah import _write_ah1
 try:
     import instaseis
@@ -26,9 +34,13 @@ def data_request(client_name, start=None, end=None, minmag=None, cat=None,
                  radialcenterlon=None, minrad=None, maxrad=None,
                  station_radcenlat=None, station_radcenlon=None,
                  station_minrad=None, station_maxrad=None,
-                 azimuth=None, baz=False, t_before_first_arrival=1,
+                 azimuth=None, baz=False, distance=None,
+                 t_before_first_arrival=1,
                  t_after_first_arrival=9, savefile=False, file_format='SAC',
-                 normal_mode_data=False):
+                 normal_mode_data=False, workers=4, retries=2, backoff=1.,
+                 timeout=120, report=None, bulk_size=None, bulk_events=1,
+                 cache=False, manifest=None, resume=False, preprocess=None,
+                 process_workers=2, queue_size=16):
     """
     Searches in a given Database for seismic data. Restrictions in terms of
     starttime, endtime, network etc can be made. If data is found it returns a
@@ -38,7 +50,8 @@ def data_request(client_name, start=None, end=None, minmag=None, cat=None,
     :param client_name: Name of desired fdsn client,
                         for a list of all clients see:
                         https://docs.obspy.org/tutorial/code_snippets/retrieving_data_from_datacenters.html
-    :type  client_name:  string
+                        or a Client, e.g. of a local server
+    :type  client_name:  string or obspy.clients.fdsn.Client
 
     :param start, end: starttime, endtime
     :type : UTCDateTime
@@ -47,7 +60,10 @@ def data_request(client_name, start=None, end=None, minmag=None, cat=None,
     :type  minmag: float
 
     :param cat_client_name: Name of Event catalog, default is "None", resulting
-                            in catalog search, defined by client_name
+                            in catalog search, defined by client_name.
+                            "globalcmt" searches on globalcmt.org, a path
+                            of NDK files searches the GCMT catalog offline,
+                            see bowpy.util.gcmt
 
     :type  cat_client_name: string
 
@@ -81,6 +97,10 @@ def data_request(client_name, start=None, end=None, minmag=None, cat=None,
                 as a list [minimum back azimuth, maximum back azimuth]
     :type  baz: list
 
+    :param distance: Desired range of epicentral distances of event, station
+                     couples in deg as a list [minimum, maximum]
+    :type  distance: list
+
     :param t_before_first_arrival, t_before_after_arrival:
     Length of the seismograms, startingpoint, minutes before 1st arrival and
     minutes after 1st arrival.
@@ -94,6 +114,64 @@ def data_request(client_name, start=None, end=None, minmag=None, cat=None,
     https://docs.obspy.org/packages/autogen/obspy.core.stream.Stream.write.html#obspy.core.stream.Stream.write
     :type  format: string
 
+    :param workers: Number of parallel waveform requests to the client
+    :type  workers: int
+
+    :param retries, backoff: Failed requests are repeated retries times, after
+                             a pause of backoff s, which doubles each time
+    :type  retries, backoff: int, float
+
+    :param timeout: Timeout of a single request in s
+    :type  timeout: float
+
+    :param report: If a DownloadReport is given, the requests without data and
+                   the failed requests of all events are added to it
+    :type  report: bowpy.util.download.DownloadReport
+
+    :param bulk_size: If given, the time windows are requested with
+                      get_waveforms_bulk, in bulk requests of at most
+                      bulk_size stations
+    :type  bulk_size: int
+
+    :param bulk_events: Number of events, of which the requests are downloaded
+                        together, e.g. combined into the same bulk requests
+    :type  bulk_events: int
+
+    :param cache: Events, inventories and waveforms are kept in the local
+                  request cache, repeated requests are read from it. True for
+                  the default cache, of at most 2 GB in ~/.bowpy/cache, False
+                  for no cache (default), or a RequestCache. In offline mode
+                  only cached data are used.
+    :type  cache: bool or bowpy.util.request_cache.RequestCache
+
+    :param manifest: With savefile, each time window of a station is recorded
+                     as a row of the manifest, with its status, size, checksum
+                     and file. Default is MANIFEST in the current directory,
+                     False for no manifest, or a path or a HarvestManifest.
+    :type  manifest: str or bowpy.util.manifest.HarvestManifest
+
+    :param resume: If True, only the time windows, which are missing or failed
+                   in the manifest, are requested. With savefile 'network' or
+                   'event', a file is written again, if one of its time
+                   windows is missing.
+    :type  resume: bool
+
+    :param preprocess: Preprocessing of the data of each station, while other
+                       stations are still downloading, the keyword arguments
+                       of bowpy.util.pipeline.preprocess_stream, e.g.
+                       {'detrend': 'linear', 'taper': 0.05, 'decimate': 2,
+                       'remove_response': 'VEL'}, or a function of the Stream
+    :type  preprocess: dict or function
+
+    :param process_workers: Number of threads, which preprocess the data. The
+                            files are written by one further thread.
+    :type  process_workers: int
+
+    :param queue_size: Number of stations waiting for preprocessing and number
+                       of files waiting for writing, before the thread in
+                       front of them waits
+    :type  queue_size: int
+
     returns
 
     :param: list_of_stream, Inventory, Catalog
@@ -147,42 +225,91 @@ def data_request(client_name, start=None, end=None, minmag=None, cat=None,
     inv.plot()
     cat.plot()
 
+    ### Example 3 ###
+
+    from bowpy.util.download import DownloadReport
+
+    report = DownloadReport()
+    list_of_stream, inventory, cat = data_request('IRIS', start, end, minmag,
+                                                  net='TA', workers=8,
+                                                  retries=3, report=report)
+    print(report)
+
+    # Bulk requests of 200 stations, combining the requests of 5 events.
+    list_of_stream, inventory, cat = data_request('IRIS', start, end, minmag,
+                                                  net='TA', bulk_size=200,
+                                                  bulk_events=5)
+
+    ### Example 4 ###
+
+    from bowpy.util.request_cache import set_offline
+
+    # Keep the requests in the local cache, the second run uses it without
+    # network access.
+    list_of_stream, inventory, cat = data_request('IRIS', start, end, minmag,
+                                                  net='TA', cache=True)
+    set_offline(True)
+    list_of_stream, inventory, cat = data_request('IRIS', start, end, minmag,
+                                                  net='TA', cache=True)
+
+    ### Example 5 ###
+
+    # Continue an interrupted harvest, failed time windows are requested again.
+    data_request('IRIS', start, end, minmag, net='TA', savefile='station',
+                 manifest='TA_harvest.jsonl', resume=True)
+
+    ### Example 6 ###
+
+    # Velocity, decimated to half the sampling rate, preprocessed by 4 threads
+    # while downloading.
+    data_request('IRIS', start, end, minmag, net='TA', savefile='station',
+                 preprocess={'detrend': 'linear', 'taper': 0.05,
+                             'decimate': 2, 'remove_response': 'VEL'},
+                 process_workers=4)
+
     """
     if not cat and not inv:
         if not start and not end and not minmag:
             print('Neither catalog and inventory specified nor dates')
             return
 
-    stream = Stream()
     streamall = []
+    cache = resolve_cache(cache)
+    offline = cache is not None and cache.offline
+    if savefile:
+        manifest = get_manifest(manifest)
+    else:
+        manifest = None
 
     # build in different approach for catalog search, using urllib
     if cat:
         catalog = cat
-        client = Client(client_name)
+        client = get_client(client_name, timeout, offline)
     else:
-        if cat_client_name == 'globalcmt':
+        if cat_client_name == 'globalcmt' or (
+                cat_client_name and os.path.exists(cat_client_name)):
+            if cat_client_name == 'globalcmt':
+                ndk = None
+            else:
+                ndk = cat_client_name
             catalog = request_gcmt(starttime=start, endtime=end,
                                    minmagnitude=minmag, mindepth=mindepth,
                                    maxdepth=maxdepth, minlatitude=minlat,
                                    maxlatitude=maxlat, minlongitude=minlon,
-                                   maxlongitude=maxlon)
-            client = Client(client_name)
+                                   maxlongitude=maxlon, ndk=ndk)
+            client = get_client(client_name, timeout, offline)
         else:
-            client = Client(client_name)
+            client = get_client(client_name, timeout, offline)
+            params = dict(starttime=start, endtime=end,
+                          minmagnitude=minmag, mindepth=mindepth,
+                          maxdepth=maxdepth, latitude=radialcenterlat,
+                          longitude=radialcenterlon, minradius=minrad,
+                          maxradius=maxrad, minlatitude=minlat,
+                          maxlatitude=maxlat, minlongitude=minlon,
+                          maxlongitude=maxlon)
             try:
-                catalog = client.get_events(starttime=start, endtime=end,
-                                            minmagnitude=minmag,
-                                            mindepth=mindepth,
-                                            maxdepth=maxdepth,
-                                            latitude=radialcenterlat,
-                                            longitude=radialcenterlon,
-                                            minradius=minrad,
-                                            maxradius=maxrad,
-                                            minlatitude=minlat,
-                                            maxlatitude=maxlat,
-                                            minlongitude=minlon,
-                                            maxlongitude=maxlon)
+                catalog = cached_request(cache, 'event', client,
+                                         client.get_events, **params)
 
             except:
                 print("No events found for given parameters.")
@@ -190,263 +317,233 @@ def data_request(client_name, start=None, end=None, minmag=None, cat=None,
 
     print("Following events found: \n")
     print(catalog)
-    m = TauPyModel(model="ak135")
-    for event in catalog:
-        if inv:
-            origin_t = event.origins[0].time
-            inventory = inv
 
-        else:
-            print("\n")
-            print("########################################")
-            print("Looking for available data for event: \n")
-            print(event.short_str())
-            print("\n")
-
-            origin_t = event.origins[0].time
-            station_stime = UTCDateTime(origin_t - 3600*24)
-            station_etime = UTCDateTime(origin_t + 3600*24)
-
-            try:
-                inventory = client.get_stations(network=net, station=scode,
-                                                level="station",
-                                                channel=channels,
-                                                starttime=station_stime,
-                                                endtime=station_etime,
-                                                minlatitude=station_minlat,
-                                                maxlatitude=station_maxlat,
-                                                minlongitude=station_minlon,
-                                                maxlongitude=station_maxlon,
-                                                latitude=station_radcenlat,
-                                                longitude=station_radcenlon,
-                                                minradius=station_minrad,
-                                                maxradius=station_maxrad)
-
-                msg = "Inventory with %i networks, " +\
-                      "containing %i stations found."
-                print(msg % (len(inventory),
-                             len(inventory.get_contents()['stations'])))
-            except:
-                print("No Inventory found for given parameters")
-                continue
-
-        for net in inventory:
-
-            print("Searching in network: %s" % net.code)
-            elat = event.origins[0].latitude
-            elon = event.origins[0].longitude
-            depth = event.origins[0].depth/1000.
-
-            array_fits = True
-            if azimuth or baz:
-                cog = center_of_gravity(net)
-                slat = cog['latitude']
-                slon = cog['longitude']
-                epidist = locations2degrees(slat, slon, elat, elon)
-                arr_time = m.get_travel_times(source_depth_in_km=depth,
-                                              distance_in_degree=epidist)
-
-                # Checking for first arrival time
-                P_arrival_time = arr_time[0]
-
-                Ptime = P_arrival_time.time
-                tstart = UTCDateTime(event.origins[0].time + Ptime -
-                                     t_before_first_arrival * 60)
-                tend = UTCDateTime(event.origins[0].time + Ptime +
-                                   t_after_first_arrival * 60)
-
-                center = geometrical_center(net)
-                clat = center['latitude']
-                clon = center['longitude']
-                if azimuth:
-                    print("Looking for events in the azimuth range of %f to %f\
-                          " % (azimuth[0], azimuth[1]))
-                    center_az = gps2dist_azimuth(clat, clon, elat, elon)[1]
-                    if center_az > azimuth[1] and center_az < azimuth[0]:
-                        print("Geometrical center of Array out of azimuth"
-                              + " bounds, \nchecking if single stations fit")
-                        array_fits = False
-
-                elif baz:
-                    print("Looking for events in the back azimuth " +
-                          "range of %f to %f" % (baz[0], baz[1]))
-                    center_baz = gps2dist_azimuth(clat, clon, elat, elon)[2]
-                    if center_baz > baz[1] and center_baz < baz[0]:
-                        print("Geometrical center of Array out of back " +
-                              "azimuth bounds, \nchecking if " +
-                              "single stations fit")
-                        array_fits = False
-
-            # If array fits to azimuth/back azimuth or no azimuth/back azimuth
-            # is given
-            no_of_stations = 0
-            if array_fits:
-
-                for station in net:
-
-                    epidist = locations2degrees(station.latitude,
-                                                station.longitude,
-                                                elat, elon)
-                    arr_time = m.get_travel_times(source_depth_in_km=depth,
-                                                  distance_in_degree=epidist)
-                    P_arrival_time = arr_time[0]
-
-                    Ptime = P_arrival_time.time
-                    tstart = UTCDateTime(event.origins[0].time + Ptime -
-                                         t_before_first_arrival * 60)
-                    if normal_mode_data:
-                        tend = UTCDateTime(event.origins[0].time +
-                                           Ptime + 170 * 60 * 60)
-                    else:
-                        tend = UTCDateTime(event.origins[0].time + Ptime +
-                                           t_after_first_arrival * 60)
+    kwargs = {'attach_response': True}
+    if normal_mode_data:
+        kwargs['longestonly'] = True
 
+    # Time windows around the first arrival in s.
+    t_before = t_before_first_arrival * 60
+    if normal_mode_data:
+        t_after = 170 * 60 * 60
+    else:
+        t_after = t_after_first_arrival * 60
+
+    events = list(catalog)
+    if inv:
+        # Geometry and selection of all events and stations at once.
+        geometry = EventGeometry(events, inv)
+        mask = geometry.mask(azimuth, baz, distance)
+
+    # Downloaded stations are preprocessed by threads of the pipeline, items
+    # are (Stream, function of the Stream). Files and manifest rows are
+    # written by the thread of writer.
+    pipeline = Pipeline([
+        Stage('preprocess', _call, process_workers, queue_size=queue_size)],
+        size=lambda item: stream_nbytes(item[0]), source='download')
+    writer = AsyncWriter(queue_size)
+
+    try:
+        bulk_events = max(1, int(bulk_events))
+        for i0 in range(0, len(events), bulk_events):
+
+            # Requests of all networks of bulk_events events, downloaded at
+            # once.
+            requests = []
+            # Event, network and station of each request.
+            owners = []
+            batch = []
+            for ievent, event in enumerate(events[i0:i0 + bulk_events], i0):
+                if inv:
+                    inventory = inv
+
+                else:
+                    print("\n")
+                    print("########################################")
+                    print("Looking for available data for event: \n")
+                    print(event.short_str())
+                    print("\n")
+
+                    origin_t = event.origins[0].time
+                    station_stime = UTCDateTime(origin_t - 3600*24)
+                    station_etime = UTCDateTime(origin_t + 3600*24)
+
+                    params = dict(network=net, station=scode, level="station",
+                                  channel=channels, starttime=station_stime,
+                                  endtime=station_etime,
+                                  minlatitude=station_minlat,
+                                  maxlatitude=station_maxlat,
+                                  minlongitude=station_minlon,
+                                  maxlongitude=station_maxlon,
+                                  latitude=station_radcenlat,
+                                  longitude=station_radcenlon,
+                                  minradius=station_minrad,
+                                  maxradius=station_maxrad)
                     try:
-                        if normal_mode_data:
-                            st_req = client.get_waveforms(network=net.code,
-                                                          station=station.code,
-                                                          location='*',
-                                                          channel=channels,
-                                                          starttime=tstart,
-                                                          endtime=tend,
-                                                          attach_response=True,
-                                                          longestonly=True)
-                        else:
-                            st_req = client.get_waveforms(network=net.code,
-                                                          station=station.code,
-                                                          location='*',
-                                                          channel=channels,
-                                                          starttime=tstart,
-                                                          endtime=tend,
-                                                          attach_response=True)
-                        no_of_stations += 1
-                        msg = "Downloaded data for %i of %i available " +\
-                              "stations!"
-                        print(msg % (no_of_stations,
-                                     net.selected_number_of_stations),
-                              end='\r')
-
-                        sys.stdout.flush()
-                        stream += st_req
+                        inventory = cached_request(cache, 'station', client,
+                                                   client.get_stations,
+                                                   **params)
+
+                        msg = "Inventory with %i networks, " +\
+                              "containing %i stations found."
+                        nsta = len(inventory.get_contents()['stations'])
+                        print(msg % (len(inventory), nsta))
                     except:
-                        pass
-
-                    if savefile == 'station' and len(stream) != 0:
-                        stname = str(net.code) + '.' + str(station.code) \
-                                 + '.' + str(origin_t).split('.')[0]
-
-                        if hasattr(stream[0].stats, 'response'):
-                            save_file(stream, origin_t, file_format, stname,
-                                      station, event)
-                            msg = "     Saved data for %i of %i available " +\
-                                  "stations!"
-                            print(msg % (no_of_stations,
-                                         net.selected_number_of_stations),
-                                  end='\r')
-                            stream = Stream()
-                        else:
-                            stream = Stream()
-                            continue
-
-            # If not, checking each station individually.
+                        print("No Inventory found for given parameters")
+                        continue
+
+                    geometry = EventGeometry([event], inventory)
+                    mask = geometry.mask(azimuth, baz, distance)
+                    ievent = 0
+
+                networks = []
+                net_requests = geometry.requests(ievent, t_before, t_after,
+                                                 channels, mask)
+                for network, (code, rows, reqs) in zip(inventory,
+                                                       net_requests):
+                    print("Searching in network: %s" % network.code)
+                    stations = [network.stations[j] for j in rows]
+                    networks.append((network, stations, len(requests)))
+                    requests.extend(reqs)
+                    owners.extend((event, network, station)
+                                  for station in stations)
+                batch.append((event, inventory, networks))
+
+            # Requests, which are complete in the manifest, are not sent again.
+            skip = set()
+            if manifest is not None and resume:
+                skip = _completed(manifest, batch, requests, savefile)
+                msg = "%i of %i time windows complete in manifest"
+                print(msg % (len(skip), len(requests)))
+            todo = [i for i in range(len(requests)) if i not in skip]
+
+            # Counter in a list, it is changed in downloaded.
+            no_of_stations = [0]
+            streams = [Stream() for request in requests]
+            # Error messages of the requests, which failed preprocessing.
+            unprocessed = {}
+
+            def processed(i, st_req):
+                # In a preprocessing thread. Errors are recorded as failed
+                # in the manifest, so resume requests the data again.
+                step = 'Preprocessing'
+                try:
+                    if callable(preprocess):
+                        st_req = preprocess(st_req)
+                    elif preprocess:
+                        st_req = preprocess_stream(st_req, **preprocess)
+                    if len(st_req) == 0:
+                        msg = 'No traces left'
+                        raise ValueError(msg)
+
+                    if savefile == 'station':
+                        step = 'Saving'
+                        event, network, station = owners[i]
+                        _save_station(st_req, network, station, event,
+                                      file_format, manifest, requests[i],
+                                      writer)
+                except Exception as e:
+                    unprocessed[i] = '%s, %s: %s' % (step, type(e).__name__,
+                                                     e)
+                    return
+
+                if savefile == 'station':
+                    # Queued for writing, the data are not kept.
+                    streams[i] = None
+                else:
+                    streams[i] = st_req
+
+            def downloaded(k, request, st_req):
+                no_of_stations[0] += 1
+                msg = "Downloaded data for %i of %i available " +\
+                      "stations!"
+                print(msg % (no_of_stations[0], len(todo)), end='\r')
+                sys.stdout.flush()
+                pipeline.put((st_req, partial(processed, todo[k])))
+
+            # The downloaded data are only passed to downloaded, processed
+            # keeps them in streams or drops them when they are queued for
+            # writing.
+            if bulk_size:
+                batch_report = download_waveforms_bulk(
+                    client, [requests[i] for i in todo], bulk_size, workers,
+                    retries, backoff, timeout, downloaded, cache, keep=False,
+                    **kwargs)[1]
             else:
-                for station in net:
-                    epidist = locations2degrees(station.latitude,
-                                                station.longitude, elat, elon)
-                    arr_time = m.get_travel_times(source_depth_in_km=depth,
-                                                  distance_in_degree=epidist)
-
-                    # Checking for first arrival time
-                    P_arrival_time = arr_time[0]
-
-                    Ptime = P_arrival_time.time
-                    tstart = UTCDateTime(event.origins[0].time + Ptime -
-                                         t_before_first_arrival * 60)
-                    tend = UTCDateTime(event.origins[0].time + Ptime +
-                                       t_after_first_arrival * 60)
-
-                    fit = False
-                    if azimuth:
-                        stat_az = gps2dist_azimuth(station.latitude,
-                                                   station.longitude,
-                                                   elat, elon)[1]
-                        if stat_az > azimuth[1] and stat_az < azimuth[0]:
-                            fit = True
-                    elif baz:
-                        stat_baz = gps2dist_azimuth(station.latitude,
-                                                    station.longitude,
-                                                    elat, elon)[2]
-                        if stat_baz > baz[1] and stat_baz < baz[0]:
-                            fit = True
-                    if fit:
-                        try:
-                            st_req = client.get_waveforms(network=net.code,
-                                                          station=station.code,
-                                                          location='*',
-                                                          channel=channels,
-                                                          startime=tstart,
-                                                          endtime=tend,
-                                                          attach_response=True)
-                            no_of_stations += 1
-                            msg = "Downloaded data for %i of %i available " +\
-                                  "stations!"
-                            print(msg % (no_of_stations,
-                                         net.selected_number_of_stations),
-                                  end='\r')
-
-                            sys.stdout.flush()
-                            stream += st_req
-                        except:
-                            pass
-
-                    if savefile == 'station' and len(stream) != 0:
-                        stname = str(net.code) + '.' + str(station.code) \
-                                 + '.' + str(origin_t).split('.')[0]
-
-                        if hasattr(stream[0].stats, 'response'):
-                            save_file(stream, origin_t, file_format, stname,
-                                      station, event)
-                            msg = "     Saved data for %i of %i available " +\
-                                  "stations!"
-                            print(msg % (no_of_stations,
-                                         net.selected_number_of_stations),
-                                  end='\r')
-                            stream = Stream()
-                        else:
-                            stream = Stream()
+                batch_report = download_waveforms(
+                    client, [requests[i] for i in todo], workers, retries,
+                    backoff, timeout, downloaded, cache, keep=False,
+                    **kwargs)[1]
+            print('\n')
+            pipeline.join('preprocess')
+
+            if batch_report.failed:
+                print(batch_report)
+            if report is not None:
+                report.extend(batch_report)
+            failed = dict((_request_id(request), msg)
+                          for request, msg, attempts in batch_report.failed)
+            for i, msg in unprocessed.items():
+                print(msg)
+                failed[_request_id(requests[i])] = msg
+
+            for event, inventory, networks in batch:
+                origin_t = event.origins[0].time
+                stream = Stream()
+                # Requests with data in stream, recorded when the file is
+                # saved.
+                in_stream = []
+
+                for network, stations, j0 in networks:
+                    for j, station in enumerate(stations):
+                        st_req = streams[j0 + j]
+                        if j0 + j in skip:
                             continue
+                        # Stations are written by the preprocessing threads.
+                        if st_req is None:
+                            continue
+                        if len(st_req) == 0:
+                            writer.call(_record, st_req, event,
+                                        requests[j0 + j], manifest, None,
+                                        failed)
+                            continue
+                        if savefile != 'station':
+                            stream += st_req
+                            in_stream.append(j0 + j)
 
-            if savefile == 'network' and len(stream) != 0:
-                stname = str(origin_t).split('.')[0]
-
-                attach_network_to_traces(stream, inventory)
-                attach_coordinates_to_traces(stream, inventory, event)
-
-                save_file(stream, origin_t, file_format, stname)
-                print('File Saved: %s' % stname)
-                stream = Stream()
+                    if savefile == 'network' and len(stream) != 0:
+                        stname = str(origin_t).split('.')[0]
 
-            print('\n')
-        invall = inventory
+                        attach_network_to_traces(stream, inventory)
+                        attach_coordinates_to_traces(stream, inventory, event)
 
-        attach_network_to_traces(stream, inventory)
-        attach_coordinates_to_traces(stream, inventory, event)
+                        rows = [(requests[i], streams[i]) for i in in_stream]
+                        _save_unit(stream, stname, file_format, manifest,
+                                   event, rows, writer)
+                        stream = Stream()
+                        in_stream = []
 
-        if savefile == 'event' and len(stream) != 0:
-            stname = str(origin_t).split('.')[0]
-            invname = stname + "_inv.xml"
-            catname = stname + "_cat.xml"
+                invall = inventory
 
-            save_file(stream, origin_t, file_format, stname)
-            inventory.write(invname, format="STATIONXML")
-            catalog.write(catname, format="QUAKEML")
+                attach_network_to_traces(stream, inventory)
+                attach_coordinates_to_traces(stream, inventory, event)
 
-            print('File Saved: %s' % stname)
+                if savefile == 'event' and len(stream) != 0:
+                    stname = str(origin_t).split('.')[0]
 
-        if not savefile:
-            streamall.append(stream)
+                    _save_unit(stream, stname, file_format, manifest, event,
+                               [(requests[i], streams[i]) for i in in_stream],
+                               writer, inventory, catalog)
 
-        stream = Stream()
+                if not savefile:
+                    streamall.append(stream)
+    finally:
+        pipeline.close()
+        writer.close()
+    print(pipeline)
+    print(writer)
+    if manifest is not None:
+        print(manifest)
 
     if not savefile:
         inventory = invall
@@ -455,21 +552,149 @@ def data_request(client_name, start=None, end=None, minmag=None, cat=None,
         return(list_of_stream, inventory, catalog)
 
 
-def save_file(stream, origin_t, file_format, stname, station=None, event=None):
+def _call(item):
+    stream, func = item
+    return func(stream)
+
+
+def _save_station(st_req, network, station, event, file_format, manifest,
+                  request, writer):
+    """
+    Queues the data of one station to writer.
+    """
+    origin_t = event.origins[0].time
+    if not hasattr(st_req[0].stats, 'response'):
+        writer.call(_record, st_req, event, request, manifest, None, {})
+        return
+    stname = str(network.code) + '.' + str(station.code) + '.' + \
+        str(origin_t).split('.')[0]
+    save_file(st_req, origin_t, file_format, stname, station, event, writer,
+              partial(_saved, event, [(request, st_req)], manifest, None))
+
+
+def _save_unit(stream, stname, file_format, manifest, event, rows, writer,
+               inventory=None, catalog=None):
+    """
+    Queues the file of a network or an event to writer. rows are the requests
+    and data in stream.
+    """
+    if inventory is not None:
+        writer.write(inventory, stname + "_inv.xml", "STATIONXML")
+    if catalog is not None:
+        writer.write(catalog, stname + "_cat.xml", "QUAKEML")
+    save_file(stream, event.origins[0].time, file_format, stname,
+              writer=writer,
+              callback=partial(_saved, event, rows, manifest, stname))
+
+
+def _saved(event, rows, manifest, stname, filenames):
+    """
+    Records rows, when their file is written, and prints stname, if given.
+    """
+    # Formats with one trace per file have several files, one is recorded.
+    fname = filenames[0] if filenames else None
+    for request, st_req in rows:
+        _record(st_req, event, request, manifest, fname, {})
+    if stname:
+        print('File Saved: %s' % stname)
+
+
+def _completed(manifest, batch, requests, savefile):
+    """
+    Indices of the requests of batch, which are complete in manifest. With
+    savefile 'network' or 'event', the requests of a file are only skipped, if
+    all of them are complete, so the file is written with all stations again.
+    """
+    skip = set()
+    for event, inventory, networks in batch:
+        units = [list(range(j0, j0 + len(stations)))
+                 for network, stations, j0 in networks]
+        if savefile == 'station':
+            units = [[i] for unit in units for i in unit]
+        elif savefile == 'event':
+            units = [[i for unit in units for i in unit]]
+
+        for unit in units:
+            if all(manifest.is_complete(event, requests[i]) for i in unit):
+                skip.update(unit)
+    return skip
+
+
+def _record(st_req, event, request, manifest, fname, failed):
+    """
+    Records request in manifest, as done if st_req was saved to fname.
+    """
+    if manifest is None:
+        return
+    if len(st_req) > 0 and fname:
+        manifest.record(event, request, DONE, st_req, fname)
+    elif len(st_req) > 0:
+        manifest.record(event, request, FAILED,
+                        error='Not saved, no instrument response')
+    elif _request_id(request) in failed:
+        manifest.record(event, request, FAILED,
+                        error=failed[_request_id(request)])
+    else:
+        manifest.record(event, request, NODATA)
+
+
+def _request_id(request):
+    # UTCDateTime can not be hashed.
+    return tuple(str(x) for x in request)
+
+
+def save_file(stream, origin_t, file_format, stname, station=None, event=None,
+              writer=None, callback=None):
+    """
+    Saves stream to stname with the extension file_format. The file is queued
+    to writer, default is bowpy.util.writer.get_writer, and written in the
+    background, it appears under its name when it is complete. With
+    writer=False, it is written at once. AH files, which can not be written,
+    are saved as pickle.
+
+    :param writer: AsyncWriter or False
+    :type  writer: bowpy.util.writer.AsyncWriter
+
+    :param callback: function, called with the list of the written files
+    :type  callback: function
+
+    returns: the file name
+    """
+    if writer is None:
+        writer = get_writer()
 
     if file_format == 'ah':
-        try:
-            stname = stname + '.AH'
-            _write_ah1(stream, stname, station, event)
-        except:
-            stname = stname + '.pickle'
-            stream.write(stname, format='pickle')
+        if writer is False:
+            _save_ah(stream, stname, station, event, callback)
+        else:
+            writer.call(_save_ah, stream, stname, station, event, callback)
+        return stname + '.AH'
+
+    stname = stname + "." + file_format
+    if writer is False:
+        filenames = atomic_write(
+            stname, lambda path: stream.write(path, format=file_format))
+        if callback:
+            callback(filenames)
     else:
-        stname = stname + "." + file_format
-        stream.write(stname, format=file_format)
+        writer.write(stream, stname, file_format, callback)
+    return stname
+
+
+def _save_ah(stream, stname, station, event, callback):
+    try:
+        filenames = atomic_write(
+            stname + '.AH',
+            lambda path: _write_ah1(stream, path, station, event))
+    except Exception:
+        filenames = atomic_write(
+            stname + '.pickle',
+            lambda path: stream.write(path, format='pickle'))
+    if callback:
+        callback(filenames)
 
 
-def create_insta_from_invcat(network, event, database):
+def create_insta_from_invcat(network, event, database, cache=False):
     """
     This function creates synthetic data using the given network and
     event information, with the database of instaseis
@@ -483,9 +708,14 @@ def create_insta_from_invcat(network, event, database):
 
     :param database: Link to the database, e.g. the path on your harddrive
     :type  database: str
-    """
 
-    db = instaseis.open_db(database)
+    :param cache: Seismograms are kept in the local request cache, see
+                  data_request
+    :type  cache: bool or bowpy.util.request_cache.RequestCache
+    """
+    cache = resolve_cache(cache)
+    # The database is opened for the first seismogram, which is not cached.
+    db = []
 
     tofe = event.origins[0].time
     lat = event.origins[0].latitude
@@ -502,6 +732,7 @@ def create_insta_from_invcat(network, event, database):
                               origin_time=tofe
                               )
 
+    mt = event.MomentTensor
     stream = Stream()
     tmp = []
     for station in network:
@@ -509,7 +740,23 @@ def create_insta_from_invcat(network, event, database):
                                  longitude=str(station.longitude),
                                  network=str(network.code),
                                  station=str(station.code))
-        tmp.append(db.get_seismograms(source=source, receiver=rec))
+
+        def seismograms():
+            if not db:
+                db.append(instaseis.open_db(database))
+            return db[0].get_seismograms(source=source, receiver=rec)
+
+        if cache is None:
+            tmp.append(seismograms())
+            continue
+        params = dict(service='instaseis', database=database,
+                      latitude=lat, longitude=lon, depth=depth,
+                      origin_time=tofe, m_rr=mt.m_rr, m_tt=mt.m_tt,
+                      m_pp=mt.m_pp, m_rt=mt.m_rt, m_rp=mt.m_rp,
+                      m_tp=mt.m_tp, network=network.code,
+                      station=station.code, reclat=station.latitude,
+                      reclon=station.longitude)
+        tmp.append(cache.fetch(params, seismograms))
 
     for x in tmp:
         stream += x
@@ -519,16 +766,24 @@ def create_insta_from_invcat(network, event, database):
 
 def request_gcmt(starttime, endtime, minmagnitude=None, mindepth=None,
                  maxdepth=None, minlatitude=None, maxlatitude=None,
-                 minlongitude=None, maxlongitude=None):
-    from mechanize import Browser
-    import re
-
+                 minlongitude=None, maxlongitude=None, ndk=None):
     """
     Description
     I am using mechanize. My attempt is just preliminary, for the current
     globalcmt.org site. It is possible to store Moment Tensor information
     in the catalog file.
+
+    With ndk, the path of NDK files or a directory of them, the catalog is
+    searched offline in the files, see bowpy.util.gcmt. Depths are in km.
     """
+    if ndk:
+        table = get_gcmt_table(ndk)
+        return table.query(starttime, endtime, minlatitude, maxlatitude,
+                           minlongitude, maxlongitude, mindepth, maxdepth,
+                           minmagnitude)
+
+    from mechanize import Browser
+    import re
 
     # Split numbers and text
     r = re.compile("([a-zA-Z]+)([0-9]+)")
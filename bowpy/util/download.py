@@ -0,0 +1,377 @@
+from __future__ import absolute_import, print_function
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from copy import copy
+from fnmatch import fnmatch
+from itertools import islice
+import time
+
+from obspy import Stream
+from obspy.clients.fdsn import Client
+try:
+    from obspy.clients.fdsn.header import FDSNNoDataException
+except ImportError:
+    FDSNNoDataException = None
+try:
+    from obspy.clients.fdsn.header import (FDSNBadRequestException, FDSNForbiddenException,
+                                           FDSNUnauthorizedException, FDSNRequestTooLargeException)
+    _PERMANENT = (FDSNBadRequestException, FDSNForbiddenException, FDSNUnauthorizedException)
+except ImportError:
+    FDSNRequestTooLargeException = None
+    _PERMANENT = ()
+
+from bowpy.util.request_cache import resolve_cache, request_key
+
+"""
+Concurrent waveform download from FDSN clients. The requests of one client are
+sent by a bounded pool of threads, failed requests are repeated with an
+increasing pause, requests without data and requests, which failed after all
+retries, are collected in a DownloadReport. download_waveforms_bulk combines
+the requests into bulk POST requests and assigns the returned traces back to
+the single requests. With a RequestCache, cached requests are not sent again.
+
+The client can be any obspy FDSN Client, e.g. one pointing to a local test
+server by its base url.
+
+Example:
+            from bowpy.util.download import WaveformRequest, download_waveforms
+
+            requests = [WaveformRequest('TA', '034A', '*', 'BHZ', t1, t2),
+                        WaveformRequest('TA', '035A', '*', 'BHZ', t1, t2)]
+            streams, report = download_waveforms('IRIS', requests, workers=4, retries=2)
+            print(report)
+
+            # Local stand-in server
+            streams, report = download_waveforms(Client('http://localhost:8080'), requests)
+
+            # 500 requests in 3 bulk requests
+            streams, report = download_waveforms_bulk('IRIS', requests, group_size=200)
+"""
+
+# Number of requests per worker, which are sent or waiting in the pool at the same time.
+IN_FLIGHT = 2
+
+# Fields in the order of the lines of Client.get_waveforms_bulk.
+WaveformRequest = namedtuple('WaveformRequest', ['network', 'station', 'location', 'channel', 'starttime',
+                                                 'endtime'])
+
+
+class DownloadReport(object):
+    """
+    Outcome of the requests of download_waveforms.
+
+    :attribute succeeded: number of requests with data
+    :attribute nodata: requests, for which the server has no data
+    :attribute failed: list of (request, error message, number of attempts) of the requests,
+                       which failed after all retries
+    """
+
+    def __init__(self):
+        self.succeeded = 0
+        self.nodata = []
+        self.failed = []
+
+    def __len__(self):
+        return self.succeeded + len(self.nodata) + len(self.failed)
+
+    def __str__(self):
+        msg = 'DownloadReport: %i of %i requests with data, %i without data, %i failed' % (
+            self.succeeded, len(self), len(self.nodata), len(self.failed))
+        lines = [msg]
+        for request, error, attempts in self.failed:
+            lines.append('    %s.%s.%s.%s %s - %s after %i attempts: %s' % (
+                request.network, request.station, request.location, request.channel, request.starttime,
+                request.endtime, attempts, error))
+        return '\n'.join(lines)
+
+    def extend(self, other):
+        """
+        Adds the results of the report other to this report.
+        """
+        self.succeeded += other.succeeded
+        self.nodata.extend(other.nodata)
+        self.failed.extend(other.failed)
+
+
+def download_waveforms(client, requests, workers=4, retries=2, backoff=1., timeout=None, callback=None,
+                       cache=None, keep=True, **kwargs):
+    """
+    Downloads the waveforms of all requests with Client.get_waveforms, at most workers
+    requests are sent at the same time. Further requests are submitted as the sent ones
+    finish, so finished requests do not pile up while callback is busy.
+
+    :param client: FDSN client or its name
+    :type  client: obspy.clients.fdsn.Client or str
+
+    :param requests: list of WaveformRequest or tuples in the same order
+    :type  requests: list
+
+    :param workers: maximum number of parallel requests to the client
+    :type  workers: int
+
+    :param retries: number of repetitions of a failed request, requests without data are not repeated
+    :type  retries: int
+
+    :param backoff: pause in s before the first repetition, it is doubled for every further repetition
+    :type  backoff: float
+
+    :param timeout: timeout of one request in s, default is the timeout of the client, which
+                    itself is not changed
+    :type  timeout: float
+
+    :param callback: function callback(index, request, stream), called in the calling thread
+                     as soon as a request has data, e.g. to save or report the progress
+    :type  callback: function
+
+    :param cache: True for the default cache, or a RequestCache, in offline mode requests,
+                  which are not cached, fail
+    :type  cache: bowpy.util.request_cache.RequestCache
+
+    :param keep: If False, the data are only passed to callback and the returned streams are
+                 empty, so they are not all kept in memory until the last request
+    :type  keep: bool
+
+    :param kwargs: passed to get_waveforms, e.g. attach_response=True
+
+    returns:
+
+    :param streams: list with one Stream per request, in the order of requests, empty if no data
+    :type  streams: list
+
+    :param report: successful, empty and failed requests
+    :type  report: DownloadReport
+    """
+    cache = resolve_cache(cache)
+    client = get_client(client, timeout, cache is not None and cache.offline)
+    requests = [WaveformRequest(*request) for request in requests]
+    streams = [Stream() for request in requests]
+    report = DownloadReport()
+    keys = _cached(client, requests, kwargs, cache, streams, report, callback, keep)
+    if not keys:
+        return streams, report
+
+    workers = max(1, int(workers))
+    pool = ThreadPoolExecutor(max_workers=workers)
+    todo = iter(list(keys))
+    pending = {}
+    try:
+        while True:
+            for i in islice(todo, max(0, IN_FLIGHT * workers - len(pending))):
+                future = pool.submit(_retry, client.get_waveforms, tuple(requests[i]), kwargs, retries, backoff)
+                pending[future] = i
+            if not pending:
+                break
+
+            done = wait(pending, return_when=FIRST_COMPLETED)[0]
+            for future in done:
+                i = pending.pop(future)
+                status, result, attempts = future.result()
+                if status == 'ok':
+                    if keep:
+                        streams[i] = result
+                    report.succeeded += 1
+                    if cache is not None:
+                        cache.put(keys[i], result)
+                    if callback:
+                        callback(i, requests[i], result)
+                elif status == 'nodata':
+                    report.nodata.append(requests[i])
+                else:
+                    report.failed.append((requests[i], result, attempts))
+    finally:
+        pool.shutdown(wait=True)
+
+    return streams, report
+
+
+def download_waveforms_bulk(client, requests, group_size=200, workers=2, retries=2, backoff=1., timeout=None,
+                            callback=None, cache=None, keep=True, **kwargs):
+    """
+    Downloads the waveforms of all requests with Client.get_waveforms_bulk, in bulk requests
+    of at most group_size lines, submitted as in download_waveforms. Groups, which the server rejects as too large (HTTP 413), are
+    split in halves. The traces of a bulk request are assigned to the requests by their codes
+    and time windows, so the result is the same as of download_waveforms.
+
+    :param group_size: maximum number of requests in one bulk request
+    :type  group_size: int
+
+    :param workers: maximum number of parallel bulk requests, most datacenters allow only few
+    :type  workers: int
+
+    For the other parameters and the returned values see download_waveforms.
+    """
+    cache = resolve_cache(cache)
+    client = get_client(client, timeout, cache is not None and cache.offline)
+    requests = [WaveformRequest(*request) for request in requests]
+    streams = [Stream() for request in requests]
+    report = DownloadReport()
+    keys = _cached(client, requests, kwargs, cache, streams, report, callback, keep)
+    if not keys:
+        return streams, report
+
+    group_size = max(1, int(group_size))
+    missing = sorted(keys)
+    groups = [missing[i:i + group_size] for i in range(0, len(missing), group_size)]
+
+    workers = max(1, int(workers))
+    pool = ThreadPoolExecutor(max_workers=workers)
+    todo = iter(groups)
+    pending = {}
+    try:
+        def submit(group):
+            bulk = [tuple(requests[i]) for i in group]
+            return pool.submit(_retry, client.get_waveforms_bulk, (bulk,), kwargs, retries, backoff)
+
+        while True:
+            for group in islice(todo, max(0, IN_FLIGHT * workers - len(pending))):
+                pending[submit(group)] = group
+            if not pending:
+                break
+
+            done = wait(pending, return_when=FIRST_COMPLETED)[0]
+            for future in done:
+                group = pending.pop(future)
+                status, result, attempts = future.result()
+
+                if status == 'toolarge' and len(group) > 1:
+                    half = len(group) // 2
+                    for part in (group[:half], group[half:]):
+                        pending[submit(part)] = part
+                    continue
+
+                if status == 'ok':
+                    _demultiplex(result, requests, group, streams)
+                for i in group:
+                    if status == 'ok' and len(streams[i]) > 0:
+                        report.succeeded += 1
+                        if cache is not None:
+                            cache.put(keys[i], streams[i])
+                        if callback:
+                            callback(i, requests[i], streams[i])
+                        if not keep:
+                            streams[i] = Stream()
+                    elif status in ('ok', 'nodata'):
+                        report.nodata.append(requests[i])
+                    else:
+                        report.failed.append((requests[i], result, attempts))
+    finally:
+        pool.shutdown(wait=True)
+
+    return streams, report
+
+
+def get_client(client, timeout=None, offline=False):
+    """
+    Returns the FDSN Client of name client, or client itself. For another timeout, a copy of
+    client is returned, which shares its connection settings, the timeout of client is not
+    changed. Offline, the services of the client are not requested.
+    """
+    if not isinstance(client, Client):
+        return Client(client, timeout=timeout or 120, _discover_services=not offline)
+    if timeout and timeout != client.timeout:
+        client = copy(client)
+        client.timeout = timeout
+    return client
+
+
+def _cached(client, requests, kwargs, cache, streams, report, callback, keep=True):
+    """
+    Fills streams with the cached requests, if keep, and passes them to callback. Returns the
+    cache keys of the remaining requests by their index. Offline, the remaining requests are
+    reported as failed.
+    """
+    keys = {}
+    for i, request in enumerate(requests):
+        if cache is None:
+            keys[i] = None
+            continue
+
+        params = dict(kwargs, service='dataselect', client=client.base_url, network=request.network,
+                      station=request.station, location=request.location, channel=request.channel,
+                      starttime=request.starttime, endtime=request.endtime)
+        key = request_key(params)
+        st = cache.get(key)
+        if st is not None:
+            if keep:
+                streams[i] = st
+            report.succeeded += 1
+            if callback:
+                callback(i, request, st)
+        elif cache.offline:
+            report.failed.append((request, 'Offline mode, request not in cache', 0))
+        else:
+            keys[i] = key
+    return keys
+
+
+def _retry(func, args, kwargs, retries, backoff):
+    """
+    Runs one request in a worker thread, returns status ('ok', 'nodata', 'toolarge' or 'failed'),
+    the Stream or the error message and the number of attempts.
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            st = func(*args, **kwargs)
+        except Exception as e:
+            if _is_nodata(e):
+                return 'nodata', None, attempt
+            # First line only, obspy appends the whole response of the server.
+            msg = '%s: %s' % (type(e).__name__, (str(e).splitlines() or [''])[0])
+            if _is_toolarge(e):
+                return 'toolarge', msg, attempt
+            if isinstance(e, _PERMANENT + (TypeError, ValueError)) or attempt > retries:
+                return 'failed', msg, attempt
+            time.sleep(backoff * 2 ** (attempt - 1))
+            continue
+
+        if len(st) == 0:
+            return 'nodata', None, attempt
+        return 'ok', st, attempt
+
+
+def _demultiplex(stream, requests, group, streams):
+    """
+    Adds each trace of stream to the streams of the requests in group, which match its codes
+    and overlap its time window. Of overlapping windows of the same channel, the trace goes to
+    the window, which covers most of it. A trace, which is covered equally by several windows,
+    e.g. merged by the server, is cut to each of them.
+    """
+    for trace in stream:
+        s = trace.stats
+        matches = [i for i in group if _match(s.network, requests[i].network) and
+                   _match(s.station, requests[i].station) and
+                   _match(s.location, requests[i].location) and
+                   _match(s.channel, requests[i].channel) and
+                   s.starttime <= requests[i].endtime and s.endtime >= requests[i].starttime]
+        if len(matches) > 1:
+            overlap = [min(s.endtime, requests[i].endtime) - max(s.starttime, requests[i].starttime)
+                       for i in matches]
+            matches = [i for i, o in zip(matches, overlap) if o >= 0.9 * max(overlap)]
+            if len(matches) > 1:
+                for i in matches:
+                    streams[i].append(trace.slice(requests[i].starttime, requests[i].endtime))
+                continue
+        for i in matches:
+            streams[i].append(trace)
+
+
+def _match(code, pattern):
+    # '--' stands for an empty location code in FDSN requests.
+    if pattern == '--':
+        pattern = ''
+    return fnmatch(code, pattern)
+
+
+def _is_nodata(error):
+    if FDSNNoDataException is not None and isinstance(error, FDSNNoDataException):
+        return True
+    # Older obspy versions raise FDSNException for HTTP 204.
+    return 'No data available' in str(error)
+
+
+def _is_toolarge(error):
+    if FDSNRequestTooLargeException is not None and isinstance(error, FDSNRequestTooLargeException):
+        return True
+    return 'Request too large' in str(error)
@@ -0,0 +1,168 @@
+from __future__ import absolute_import
+import numpy as np
+from obspy import UTCDateTime
+
+from bowpy.util.download import WaveformRequest
+from bowpy.util.geodesy import locations2degrees, vincenty_inverse
+from bowpy.util.station_index import get_station_index
+from bowpy.util.traveltimes import traveltimes
+
+"""
+Geometry of all event-station pairs of a catalog and an inventory, computed
+at once before any download. Distances, azimuths, back-azimuths and the first
+arrival times are (n_events, n_stations) matrices, the stations are in the
+order of the StationIndex of the inventory, i.e. network by network. The
+selection by azimuth, back-azimuth or distance is a boolean mask of the same
+shape.
+
+Example:
+            from bowpy.util.event_geometry import EventGeometry
+
+            geometry = EventGeometry(cat, inv)
+            mask = geometry.mask(baz=[30., 60.], distance=[30., 90.])
+            tstart, tend = geometry.windows(60., 540.)
+            for ievent, istation in zip(*np.nonzero(mask)):
+                print(geometry.index.codes[istation], UTCDateTime(tstart[ievent, istation]))
+"""
+
+# Maximum number of event-station pairs computed in one block.
+BLOCK_SIZE = 2 ** 20
+
+# Phases of the first P arrival at all distances. Their first arrival is the one of 'ttall'
+# within 1 ms, but a row of the traveltime table is computed about 30 times faster.
+FIRST_ARRIVALS = ('p', 'P', 'Pn', 'Pdiff', 'PKIKP')
+
+
+class EventGeometry(object):
+    """
+    Event-station matrices of catalog and inventory.
+
+    :attribute index: StationIndex of inventory, the columns of the matrices
+    :attribute networks: list of (network code, slice of its columns)
+    :attribute latitude, longitude, depth: of the events in degree and km
+    :attribute origin: origin times of the events as timestamps
+    :attribute distance: epicentral distances in degree
+    :attribute azimuth: azimuth from the station to the event in degree, as
+                        gps2dist_azimuth(station, event)[1]
+    :attribute back_azimuth: azimuth from the event to the station in degree, as
+                             gps2dist_azimuth(station, event)[2]
+    :attribute ptime: time of the first arrival of phase after the origin in s, default is
+                      the first of FIRST_ARRIVALS
+    """
+
+    def __init__(self, catalog, inventory, phase=FIRST_ARRIVALS, taup_model='ak135'):
+        self.index = get_station_index(inventory)
+        self.networks = []
+        j0 = 0
+        for network in inventory:
+            self.networks.append((network.code, slice(j0, j0 + len(network.stations))))
+            j0 += len(network.stations)
+
+        origins = [event.origins[0] for event in catalog]
+        self.latitude = np.array([o.latitude for o in origins], dtype='float')
+        self.longitude = np.array([o.longitude for o in origins], dtype='float')
+        self.depth = np.array([o.depth for o in origins], dtype='float') / 1000.
+        self.origin = np.array([o.time.timestamp for o in origins], dtype='float')
+
+        shape = (len(origins), len(self.index))
+        self.distance = np.empty(shape)
+        self.azimuth = np.empty(shape)
+        self.back_azimuth = np.empty(shape)
+        self.ptime = np.empty(shape)
+
+        # Blocks of events, the temporary arrays of vincenty_inverse stay small.
+        step = max(1, BLOCK_SIZE // max(1, len(self.index)))
+        for i0 in range(0, len(origins), step):
+            block = slice(i0, i0 + step)
+            elat = self.latitude[block, np.newaxis]
+            elon = self.longitude[block, np.newaxis]
+            self.distance[block] = locations2degrees(self.index.latitude, self.index.longitude, elat, elon)
+            self.azimuth[block], self.back_azimuth[block] = vincenty_inverse(
+                self.index.latitude, self.index.longitude, elat, elon)[1:]
+            self.ptime[block] = traveltimes(self.depth[block, np.newaxis], self.distance[block], phase,
+                                            taup_model)
+
+    def __len__(self):
+        return self.distance.shape[0]
+
+    @property
+    def shape(self):
+        return self.distance.shape
+
+    def center_values(self):
+        """
+        Azimuth and back-azimuth of the geometrical center of each network to the events,
+        arrays of shape (n_events, n_networks).
+        """
+        clat = np.array([_center(self.index.latitude[s]) for code, s in self.networks])
+        clon = np.array([_center(self.index.longitude[s]) for code, s in self.networks])
+        az, baz = vincenty_inverse(clat, clon, self.latitude[:, np.newaxis], self.longitude[:, np.newaxis])[1:]
+        return az, baz
+
+    def mask(self, azimuth=None, baz=None, distance=None):
+        """
+        Boolean mask of the event-station pairs, which fit the selection. If the geometrical
+        center of a network fits azimuth or baz, all of its stations are selected, otherwise
+        the single stations, which fit.
+
+        :param azimuth: [minimum, maximum] of the azimuth in degree, minimum > maximum
+                        is a range through north
+        :param baz: [minimum, maximum] of the back-azimuth in degree, not used with azimuth
+        :param distance: [minimum, maximum] of the epicentral distance in degree
+        """
+        mask = np.ones(self.shape, dtype='bool')
+        if azimuth or baz:
+            if azimuth:
+                values, bounds, column = self.azimuth, azimuth, 0
+            else:
+                values, bounds, column = self.back_azimuth, baz, 1
+            center = _in_range(self.center_values()[column], *bounds)
+            for k, (code, s) in enumerate(self.networks):
+                mask[:, s] = center[:, k, np.newaxis] | _in_range(values[:, s], *bounds)
+
+        if distance:
+            mask &= (self.distance >= distance[0]) & (self.distance <= distance[1])
+        # Stations and phases, which have no arrival.
+        mask &= np.isfinite(self.ptime)
+        return mask
+
+    def windows(self, t_before, t_after):
+        """
+        Start and end of the time windows t_before s before and t_after s after the first
+        arrival, as timestamps of shape (n_events, n_stations).
+        """
+        arrival = self.origin[:, np.newaxis] + self.ptime
+        return arrival - t_before, arrival + t_after
+
+    def requests(self, ievent, t_before, t_after, channels='*', mask=None):
+        """
+        WaveformRequests of the selected stations for the event ievent, grouped by network.
+
+        returns: list of (network code, positions of the stations in the network,
+                 list of WaveformRequest)
+        """
+        arrival = self.origin[ievent] + self.ptime[ievent]
+        tstart, tend = arrival - t_before, arrival + t_after
+        result = []
+        for code, s in self.networks:
+            columns = np.arange(s.start, s.stop)
+            if mask is not None:
+                columns = columns[mask[ievent, s]]
+            requests = [WaveformRequest(code, self.index.stations[j], '*', channels,
+                                        UTCDateTime(tstart[j]), UTCDateTime(tend[j]))
+                        for j in columns]
+            result.append((code, columns - s.start, requests))
+        return result
+
+
+def _center(values):
+    # As array_util.geometrical_center, NaN for a network without stations.
+    if values.size == 0:
+        return np.nan
+    return (values.max() + values.min()) / 2.
+
+
+def _in_range(values, vmin, vmax):
+    if vmin <= vmax:
+        return (values >= vmin) & (values <= vmax)
+    return (values >= vmin) | (values <= vmax)
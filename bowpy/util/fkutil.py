@@ -7,10 +7,10 @@ import sys
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import obspy.signal.filter as obsfilter
-from obspy.taup import TauPyModel
 from obspy.core.event.event import Event
 from obspy import Stream, Trace, Inventory
-from bowpy.util.base import nextpow2, stream2array
+from bowpy.util.base import nextpow2, stream2array, precision_dtypes
+from bowpy.util.traveltimes import get_model
 from bowpy.util.array_util import (attach_coordinates_to_traces,
                                    attach_network_to_traces)
 from bowpy.util.picker import pick_data
@@ -698,7 +698,7 @@ def plot(st, inv=None, event=None, zoom=1, yinfo=False, stationlabel=True, epidi
                 origin = st[0].stats.origin
                 depth = st[0].stats.depth
 
-            m = TauPyModel('ak135')
+            m = get_model('ak135')
 
 
 
@@ -979,7 +979,7 @@ def plot(st, inv=None, event=None, zoom=1, yinfo=False, stationlabel=True, epidi
                 origin = st.stats.origin
                 depth = st.stats.depth
 
-            m = TauPyModel('ak135')
+            m = get_model('ak135')
             arrivals = m.get_travel_times(depth, y_dist, phase_list=markphases)
             timetable = [ [], [] ]
             for k, phase in enumerate(arrivals):
@@ -1117,7 +1117,7 @@ def plotfk(data, fs=15, savefig=False, dpi=400, logscale=False, hold=False, cmap
             plt.show()
 
 
-def pocs(data, maxiter, noft, alpha=0.9, beta=None, method='linear', dmethod='denoise', peaks=None, maskshape=None, dt=None, p=None, flow=None, fhigh=None, slidingwindow=False, overlap=0.5, plotfeedback=False):
+def pocs(data, maxiter, noft, alpha=0.9, beta=None, method='linear', dmethod='denoise', peaks=None, maskshape=None, dt=None, p=None, flow=None, fhigh=None, slidingwindow=False, overlap=0.5, plotfeedback=False, precision=None):
     """
     This functions reconstructs missing signals in the f-k domain, using the original data,
     including gaps, filled with zeros. It applies the projection onto convex sets (pocs) algorithm in
@@ -1144,6 +1144,8 @@ def pocs(data, maxiter, noft, alpha=0.9, beta=None, method='linear', dmethod='de
 
     :param maskshape: Shape of the corners of mask, see makemask
 
+    :param precision: 'single' to iterate in float32/complex64, default see base.set_precision
+
     returns:
 
     :param datap:
@@ -1153,17 +1155,18 @@ def pocs(data, maxiter, noft, alpha=0.9, beta=None, method='linear', dmethod='de
     #	msg='No decrease method chosen'
     #	raise IOError(msg)
 
-    ArrayData 	= data.copy()
+    real, cplx = precision_dtypes(precision)
+    ArrayData 	= np.array(data, dtype=real)
     ix = ArrayData.shape[0]
     iK = int(math.pow(2,nextpow2(ix)))
     it = ArrayData.shape[1]
     iF = int(math.pow(2,nextpow2(it)))
-    fkdata = np.fft.fft2(ArrayData, s=(iK,iF))
+    fkdata = np.fft.fft2(ArrayData, s=(iK,iF)).astype(cplx, copy=False)
     threshold = abs(fkdata.max())
 
     ADold = ArrayData.copy()
     ADnew = ArrayData.copy()
-    ADfinal = np.zeros(ArrayData.shape).astype('complex')
+    ADfinal = np.zeros(ArrayData.shape, dtype=cplx)
     if method in ('linear', 'exp'):
         if slidingwindow:
             if dmethod in ('reconstruct'):
@@ -1255,7 +1258,7 @@ def pocs(data, maxiter, noft, alpha=0.9, beta=None, method='linear', dmethod='de
 
 
     elif method in ('mask'):
-        W 		= makeMask(fkdata, peaks[0], maskshape)
+        W 		= np.asarray(makeMask(fkdata, peaks[0], maskshape), dtype=real)
         ADfinal = ArrayData.copy()
         for n in noft:
             ADtemp 	= ArrayData.copy()
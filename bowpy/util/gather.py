@@ -0,0 +1,264 @@
+from __future__ import absolute_import
+import numpy as np
+from obspy import Stream, Trace, UTCDateTime
+from obspy.core import AttribDict
+from obspy.core.trace import Stats
+
+from bowpy.util.geodesy import haversine
+from bowpy.util.station_index import get_station_index
+
+"""
+Contiguous representation of the traces of one event recorded by an array.
+The data are held in one (n_traces, n_samples) array, the metadata as numpy
+columns, so distances, coordinates or the zerotrace flags are read without
+looping over the trace.stats. Selecting, sorting and windowing return new
+gathers, windows and slices share the data of the original gather.
+
+Example:
+            from bowpy.util.gather import ArrayGather
+
+            gather = ArrayGather.from_stream(st, inv, event)
+            gather = gather.sort('distance').window(300., 600.)
+            vespa, taxis, urange = vespagram(gather, 3., 12., 0.1)
+            st_win = gather.to_stream()
+"""
+
+# Columns of an ArrayGather, one value per trace.
+COLUMNS = ('offsets', 'distance', 'back_azimuth', 'latitude', 'longitude', 'elevation', 'live')
+
+
+class ArrayGather(object):
+    """
+    Data and metadata of the traces of one event.
+
+    :attribute data: numpy.ndarray of shape (n_traces, n_samples)
+    :attribute delta: sampling interval in s, equal for all traces
+    :attribute starttime: UTCDateTime of the first sample of data
+    :attribute offsets: start of each trace in s relative to starttime
+    :attribute distance, back_azimuth: epicentral distance and back-azimuth in degree, NaN if unknown
+    :attribute latitude, longitude, elevation: station coordinates in degree and m, NaN if unknown
+    :attribute live: False for zerotraces
+    :attribute stats: list of the obspy Stats of the traces, used by to_stream
+    :attribute depth, origin: source depth in km and origin time, None if unknown
+    """
+
+    def __init__(self, data, delta, starttime, offsets=None, distance=None, back_azimuth=None, latitude=None,
+                 longitude=None, elevation=None, live=None, stats=None, depth=None, origin=None):
+        self.data = np.asarray(data)
+        if self.data.ndim != 2:
+            msg = 'Data of ArrayGather must be 2D'
+            raise IOError(msg)
+
+        n = self.data.shape[0]
+        self.delta = float(delta)
+        self.starttime = UTCDateTime(starttime)
+        self.offsets = _column(offsets, n, 0.)
+        self.distance = _column(distance, n, np.nan)
+        self.back_azimuth = _column(back_azimuth, n, np.nan)
+        self.latitude = _column(latitude, n, np.nan)
+        self.longitude = _column(longitude, n, np.nan)
+        self.elevation = _column(elevation, n, np.nan)
+        self.live = _column(live, n, True, dtype='bool')
+
+        if stats is None:
+            stats = [Stats() for i in range(n)]
+        self.stats = list(stats)
+        self.depth = depth
+        self.origin = origin
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def __repr__(self):
+        return 'ArrayGather of %i traces with %i samples, delta %g s' % (len(self), self.npts, self.delta)
+
+    @property
+    def npts(self):
+        return self.data.shape[1]
+
+    @property
+    def stations(self):
+        return [s.station for s in self.stats]
+
+    @classmethod
+    def from_stream(cls, stream, inventory=None, event=None, dtype='float', npts=None):
+        """
+        Creates an ArrayGather from stream, the stream is not altered.
+
+        Coordinates, distances and back-azimuths are taken from inventory and event if given,
+        otherwise from the stats of the traces as set by attach_coordinates_to_traces.
+
+        :param dtype: dtype of the data array
+        :param npts: see base.stream2array, for traces of unequal length
+        """
+        from bowpy.util.base import stream2array
+
+        if isinstance(stream, Trace):
+            stream = Stream(stream)
+
+        delta = stream[0].stats.delta
+        for trace in stream:
+            if trace.stats.delta != delta:
+                msg = 'No equal sampling rate in stream'
+                raise IOError(msg)
+
+        data = stream2array(stream, dtype=dtype, npts=npts)
+        stats = [trace.stats.copy() for trace in stream]
+        n = len(stats)
+
+        starttimes = np.array([s.starttime.timestamp for s in stats])
+        starttime = UTCDateTime(starttimes.min())
+        offsets = starttimes - starttimes.min()
+
+        distance = np.array([s.get('distance', np.nan) for s in stats], dtype='float')
+        back_azimuth = np.array([s.get('back_azimuth', np.nan) for s in stats], dtype='float')
+        coords = [s.get('coordinates', {}) for s in stats]
+        latitude = np.array([c.get('latitude', np.nan) for c in coords], dtype='float')
+        longitude = np.array([c.get('longitude', np.nan) for c in coords], dtype='float')
+        elevation = np.array([c.get('elevation', np.nan) for c in coords], dtype='float')
+        live = np.array([s.get('zerotrace') != 'True' for s in stats], dtype='bool')
+
+        depth = stats[0].get('depth')
+        origin = stats[0].get('origin')
+
+        if inventory is not None:
+            index = get_station_index(inventory)
+            # Network codes by station code first, as in attach_network_to_traces.
+            for s in stats:
+                i = index.station_row.get(s.station)
+                if i is not None:
+                    s.network = index.networks[i]
+            rows = np.array([index.row.get('%s.%s' % (s.network, s.station), -1) for s in stats], dtype='int')
+            found = rows >= 0
+
+            latitude[found] = index.latitude[rows[found]]
+            longitude[found] = index.longitude[rows[found]]
+            elevation[found] = index.elevation[rows[found]]
+            if event is not None:
+                distance[found] = index.distances(event)[rows[found]]
+                back_azimuth[found] = index.back_azimuths(event)[rows[found]]
+
+        if event is not None:
+            depth = event.origins[0].depth / 1000.
+            origin = event.origins[0].time
+
+        return cls(data, delta, starttime, offsets, distance, back_azimuth, latitude, longitude, elevation,
+                   live, stats, depth, origin)
+
+    def to_stream(self, copy=False):
+        """
+        Returns the gather as Stream, with the columns written to the stats of the traces.
+
+        :param copy: If False, the data of the traces are views of the data of the gather.
+        """
+        traces = []
+        for i, row in enumerate(self.data):
+            if copy:
+                row = row.copy()
+            # Trace copies the stats.
+            trace = Trace(row, self.stats[i])
+            stats = trace.stats
+            stats.delta = self.delta
+            stats.starttime = self.starttime + self.offsets[i]
+            stats.npts = row.size
+
+            if np.isfinite(self.latitude[i]):
+                stats.coordinates = AttribDict()
+                stats.coordinates.latitude = self.latitude[i]
+                stats.coordinates.longitude = self.longitude[i]
+                stats.coordinates.elevation = self.elevation[i]
+            if np.isfinite(self.distance[i]):
+                stats.distance = self.distance[i]
+            if np.isfinite(self.back_azimuth[i]):
+                stats.back_azimuth = self.back_azimuth[i]
+            if self.depth is not None:
+                stats.depth = self.depth
+            if self.origin is not None:
+                stats.origin = self.origin
+            if not self.live[i]:
+                stats.zerotrace = 'True'
+            traces.append(trace)
+
+        return Stream(traces)
+
+    def copy(self, data=None):
+        """
+        Returns a copy of the gather. If data is given, it replaces the data of the copy,
+        e.g. the result of a filter, and is not copied.
+        """
+        if data is None:
+            data = self.data.copy()
+        elif np.shape(data)[0] != len(self):
+            msg = 'Number of rows of data does not fit the gather'
+            raise IOError(msg)
+
+        return ArrayGather(data, self.delta, self.starttime, *[getattr(self, c).copy() for c in COLUMNS],
+                           stats=[s.copy() for s in self.stats], depth=self.depth, origin=self.origin)
+
+    def select(self, index):
+        """
+        Returns a gather of the selected traces.
+
+        :param index: slice, boolean mask or array of trace indices. A slice returns a view of the data,
+                      masks and indices a copy.
+        """
+        if isinstance(index, slice):
+            data = self.data[index]
+            stats = self.stats[index]
+        else:
+            index = np.asarray(index)
+            if index.dtype == bool:
+                index = np.flatnonzero(index)
+            data = self.data[index]
+            stats = [self.stats[i] for i in index]
+
+        return ArrayGather(data, self.delta, self.starttime, *[getattr(self, c)[index] for c in COLUMNS],
+                           stats=stats, depth=self.depth, origin=self.origin)
+
+    def sort(self, key='distance', reverse=False):
+        """
+        Returns a gather with the traces sorted by the column key.
+        """
+        order = np.argsort(getattr(self, key), kind='stable')
+        if reverse:
+            order = order[::-1]
+        return self.select(order)
+
+    def window(self, tmin, tmax=None):
+        """
+        Returns a gather of the time window tmin to tmax in s after starttime. The data are a view
+        of the data of this gather.
+        """
+        imin = max(int(round(tmin / self.delta)), 0)
+        if tmax is None:
+            imax = self.npts
+        else:
+            imax = min(int(round(tmax / self.delta)), self.npts)
+
+        gather = self.select(slice(None))
+        gather.data = self.data[:, imin:imax]
+        gather.starttime = self.starttime + imin * self.delta
+        return gather
+
+    def center_index(self):
+        """
+        Index of the live trace closest to the mean coordinates of the live traces, 0 if the
+        coordinates are unknown.
+        """
+        known = self.live & np.isfinite(self.latitude) & np.isfinite(self.longitude)
+        if not known.any():
+            return 0
+        dist = haversine(self.latitude, self.longitude, self.latitude[known].mean(),
+                         self.longitude[known].mean())
+        dist[~known] = np.inf
+        return int(np.argmin(dist))
+
+
+def _column(values, n, default, dtype='float'):
+    if values is None:
+        return np.full(n, default, dtype=dtype)
+    values = np.asarray(values, dtype=dtype)
+    if values.shape != (n,):
+        msg = 'Column of length %i does not fit %i traces' % (values.size, n)
+        raise IOError(msg)
+    return values
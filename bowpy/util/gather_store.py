@@ -0,0 +1,328 @@
+from __future__ import absolute_import
+import json
+import os
+
+import numpy as np
+from obspy import UTCDateTime
+from obspy.core.trace import Stats
+
+from bowpy.util.gather import ArrayGather, COLUMNS
+
+"""
+On-disk store of an ArrayGather for arrays, which do not fit into memory.
+The data are written in chunks of traces as .npy files, which are opened as
+memory maps, the metadata are kept in a small json sidecar. Tiles, i.e. time
+windows of all or some traces, are read and written without loading the
+whole record.
+
+Example:
+            from bowpy.util.gather_store import save_gather, open_gather_store, apply_windowed
+
+            store = save_gather(gather, '/data/event01.gather', dtype='float32')
+
+            store = open_gather_store('/data/event01.gather')
+            tile = store.gather(imin=12000, imax=16000)
+            vespa, taxis, urange = vespagram(store, 3., 12., 0.1)
+
+            # fx_ssa in windows of 2048 samples, written to a new store.
+            out = apply_windowed(store, lambda d: fx_ssa(d, store.delta, 4, 0.01, 1.),
+                                 2048, overlap=0.5, out='/data/event01_ssa.gather')
+"""
+
+SIDECAR = 'gather.json'
+
+
+def create_gather_store(path, ntraces, npts, delta, starttime, dtype='float32', chunk_traces=64, meta=None):
+    """
+    Creates an empty store of ntraces traces with npts samples, filled with zeros.
+
+    :param path: directory of the store, is created
+    :type path: str
+
+    :param chunk_traces: number of traces per .npy file
+    :type chunk_traces: int
+
+    :param meta: ArrayGather, of which the metadata (columns and stats) are stored, its data are ignored.
+    :type meta: bowpy.util.gather.ArrayGather
+    """
+    if os.path.exists(os.path.join(path, SIDECAR)):
+        msg = 'Gather store %s exists already' % path
+        raise IOError(msg)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    if meta is None:
+        meta = ArrayGather(np.empty((ntraces, 0)), delta, starttime)
+    elif len(meta) != ntraces:
+        msg = 'Metadata of %i traces do not fit %i traces' % (len(meta), ntraces)
+        raise IOError(msg)
+
+    chunks = []
+    for i, t0 in enumerate(range(0, ntraces, chunk_traces)):
+        name = 'data_%04i.npy' % i
+        rows = min(chunk_traces, ntraces - t0)
+        mm = np.lib.format.open_memmap(os.path.join(path, name), mode='w+', dtype=dtype, shape=(rows, npts))
+        del mm
+        chunks.append(name)
+
+    header = {
+        'ntraces': int(ntraces),
+        'npts': int(npts),
+        'dtype': np.dtype(dtype).str,
+        'delta': float(delta),
+        'starttime': str(UTCDateTime(starttime)),
+        'chunk_traces': int(chunk_traces),
+        'chunks': chunks,
+    }
+    _write_sidecar(path, header, meta)
+
+    return GatherStore(path, mode='r+')
+
+
+def save_gather(gather, path, dtype=None, chunk_traces=64):
+    """
+    Writes gather to a new store at path chunk by chunk and returns the store.
+    """
+    if dtype is None:
+        dtype = gather.data.dtype
+    store = create_gather_store(path, len(gather), gather.npts, gather.delta, gather.starttime, dtype,
+                                chunk_traces, meta=gather)
+    for t0 in range(0, len(gather), chunk_traces):
+        store.write(gather.data[t0:t0 + chunk_traces], trace0=t0)
+    store.flush()
+    return store
+
+
+def open_gather_store(path, mode='r'):
+    """
+    Opens the store at path, mode 'r' for reading, 'r+' to write data.
+    """
+    return GatherStore(path, mode)
+
+
+class GatherStore(object):
+    """
+    Data of a gather in memory mapped chunks of traces.
+
+    :attribute meta: ArrayGather with the columns and stats of all traces, but no samples
+    :attribute delta, starttime, npts: as in ArrayGather
+    """
+
+    def __init__(self, path, mode='r'):
+        self.path = path
+        self.mode = mode
+        with open(os.path.join(path, SIDECAR)) as fh:
+            header = json.load(fh)
+
+        self.ntraces = header['ntraces']
+        self.npts = header['npts']
+        self.dtype = np.dtype(header['dtype'])
+        self.delta = header['delta']
+        self.starttime = UTCDateTime(header['starttime'])
+        self.chunk_traces = header['chunk_traces']
+        self.chunk_names = header['chunks']
+        self._header = header
+        self._chunks = [None] * len(self.chunk_names)
+
+        stats = []
+        for s in header['stats']:
+            st = Stats()
+            for key, value in s.items():
+                st[key] = value
+            stats.append(st)
+        depth = header.get('depth')
+        origin = header.get('origin')
+        if origin is not None:
+            origin = UTCDateTime(origin)
+        self.meta = ArrayGather(np.empty((self.ntraces, 0)), self.delta, self.starttime,
+                                *[header['columns'][c] for c in COLUMNS], stats=stats, depth=depth, origin=origin)
+
+    def __len__(self):
+        return self.ntraces
+
+    def __repr__(self):
+        return 'GatherStore %s of %i traces with %i samples, delta %g s' % (self.path, self.ntraces, self.npts,
+                                                                          self.delta)
+
+    @property
+    def shape(self):
+        return (self.ntraces, self.npts)
+
+    def chunk(self, i):
+        """
+        Memory map of the i-th chunk of traces, opened on first use.
+        """
+        if self._chunks[i] is None:
+            self._chunks[i] = np.load(os.path.join(self.path, self.chunk_names[i]), mmap_mode=self.mode)
+        return self._chunks[i]
+
+    def read(self, traces=None, imin=0, imax=None, dtype=None):
+        """
+        Reads a tile of the data into memory.
+
+        :param traces: slice or indices of the traces, default all
+        :param imin, imax: sample range of the tile
+        :param dtype: dtype of the returned array, default the dtype of the store
+        """
+        rows = self._rows(traces)
+        if imax is None:
+            imax = self.npts
+        tile = np.empty((rows.size, max(imax - imin, 0)), dtype=dtype or self.dtype)
+
+        for i, sel, pos in self._by_chunk(rows):
+            tile[pos] = self.chunk(i)[sel, imin:imax]
+        return tile
+
+    def write(self, data, trace0=0, imin=0):
+        """
+        Writes the tile data to the traces trace0 ... and samples imin ... of the store.
+        """
+        if self.mode == 'r':
+            msg = 'Gather store %s is opened read only' % self.path
+            raise IOError(msg)
+        data = np.atleast_2d(data)
+        rows = np.arange(trace0, trace0 + data.shape[0])
+        imax = imin + data.shape[1]
+
+        for i, sel, pos in self._by_chunk(rows):
+            self.chunk(i)[sel, imin:imax] = data[pos]
+
+    def gather(self, imin=0, imax=None, traces=None, dtype=None):
+        """
+        Reads a tile as ArrayGather with the metadata of its traces.
+        """
+        if imax is None:
+            imax = self.npts
+        rows = self._rows(traces)
+        gather = self.meta.select(rows)
+        gather.data = self.read(rows, imin, imax, dtype)
+        gather.starttime = self.starttime + imin * self.delta
+        return gather
+
+    def to_gather(self, dtype=None):
+        """
+        Loads the whole store into memory.
+        """
+        return self.gather(dtype=dtype)
+
+    def trace_chunks(self, dtype=None):
+        """
+        Iterates over the stored chunks, yields the index of the first trace and the data of the chunk.
+        """
+        for i in range(len(self.chunk_names)):
+            yield i * self.chunk_traces, np.asarray(self.chunk(i), dtype=dtype or self.dtype)
+
+    def tiles(self, window, overlap=0., traces=None, dtype=None):
+        """
+        Iterates over time windows of window samples, which overlap by the fraction overlap.
+        The last window ends at the last sample. Yields imin, imax and the tile.
+        """
+        for imin, imax in _window_bounds(self.npts, window, overlap):
+            yield imin, imax, self.read(traces, imin, imax, dtype)
+
+    def max(self):
+        """
+        Maximum of the data, calculated chunk by chunk.
+        """
+        return max(chunk.max() for t0, chunk in self.trace_chunks())
+
+    def flush(self):
+        """
+        Writes the data of all open chunks and the metadata to disk.
+        """
+        for mm in self._chunks:
+            if mm is not None and self.mode != 'r':
+                mm.flush()
+        if self.mode != 'r':
+            _write_sidecar(self.path, self._header, self.meta)
+
+    def close(self):
+        self.flush()
+        self._chunks = [None] * len(self.chunk_names)
+
+    def _rows(self, traces):
+        if traces is None:
+            return np.arange(self.ntraces)
+        if isinstance(traces, slice):
+            return np.arange(self.ntraces)[traces]
+        traces = np.asarray(traces)
+        if traces.dtype == bool:
+            return np.flatnonzero(traces)
+        return traces.astype('int')
+
+    def _by_chunk(self, rows):
+        """
+        Groups rows by chunk: chunk index, rows inside of the chunk and positions in rows.
+        """
+        ichunk = rows // self.chunk_traces
+        for i in np.unique(ichunk):
+            pos = np.flatnonzero(ichunk == i)
+            sel = rows[pos] - i * self.chunk_traces
+            # Contiguous rows are read as slice, which keeps the read sequential.
+            if sel.size > 1 and np.all(np.diff(sel) == 1):
+                sel = slice(sel[0], sel[-1] + 1)
+            yield i, sel, pos
+
+
+def apply_windowed(store, func, window, overlap=0.5, out=None, dtype='float'):
+    """
+    Applies func to overlapping time windows of all traces of store and writes the result chunk
+    by chunk to out. Overlapping windows are blended with a hanning taper, as in the sliding
+    window of fkutil.pocs. Only one window is held in memory.
+
+    :param func: function of a 2D array, which returns an array of the same shape, e.g. fx_ssa
+    :param window: length of the windows in samples
+    :param overlap: overlap of the windows as fraction of window
+    :param out: GatherStore or path of a new store, default is a store next to store.path
+    """
+    if out is None:
+        out = store.path.rstrip(os.sep) + '_windowed'
+    if not isinstance(out, GatherStore):
+        out = create_gather_store(out, store.ntraces, store.npts, store.delta, store.starttime, store.dtype,
+                                  store.chunk_traces, meta=store.meta)
+
+    bounds = list(_window_bounds(store.npts, window, overlap))
+    weightsum = np.zeros(store.npts)
+    for imin, imax in bounds:
+        if len(bounds) > 1:
+            taper = np.hanning(imax - imin + 2)[1:-1]
+        else:
+            taper = np.ones(imax - imin)
+        result = np.asarray(func(store.read(imin=imin, imax=imax, dtype=dtype)))[:, :imax - imin]
+
+        out.write(out.read(imin=imin, imax=imax, dtype=dtype) + taper * result, imin=imin)
+        weightsum[imin:imax] += taper
+
+    weightsum[weightsum == 0] = 1.
+    for t0, chunk in out.trace_chunks(dtype=dtype):
+        out.write(chunk / weightsum, trace0=t0)
+    out.flush()
+
+    return out
+
+
+def _window_bounds(npts, window, overlap):
+    window = int(min(window, npts))
+    step = max(int(window * (1. - overlap)), 1)
+    imin = 0
+    while True:
+        if imin + window >= npts:
+            yield npts - window, npts
+            return
+        yield imin, imin + window
+        imin += step
+
+
+def _write_sidecar(path, header, meta):
+    header = dict(header)
+    header['columns'] = dict((c, getattr(meta, c).tolist()) for c in COLUMNS)
+    header['stats'] = [dict((key, s.get(key, '')) for key in ('network', 'station', 'location', 'channel'))
+                       for s in meta.stats]
+    header['depth'] = meta.depth
+    # Timestamp, the origin may also be given as float.
+    header['origin'] = UTCDateTime(meta.origin).timestamp if meta.origin is not None else None
+
+    tmpname = os.path.join(path, SIDECAR + '.tmp')
+    with open(tmpname, 'w') as fh:
+        json.dump(header, fh)
+    os.replace(tmpname, os.path.join(path, SIDECAR))
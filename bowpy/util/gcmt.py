@@ -0,0 +1,385 @@
+from __future__ import absolute_import
+import calendar
+import glob
+import hashlib
+import os
+
+import numpy as np
+from obspy import UTCDateTime
+from obspy.core.event import (Catalog, Event, EventDescription, FocalMechanism, Magnitude, MomentTensor, Origin,
+                              ResourceIdentifier, Tensor)
+
+from bowpy.util.base import cache_dir
+
+"""
+Offline Global CMT catalog from NDK files, e.g. jan76_dec20.ndk and the monthly
+files of www.globalcmt.org. The files are parsed line by line into a columnar
+table of the centroids (time, location, depth, Mw and moment tensor), sorted
+by time. The table and a lat/lon index of 10 degree cells are saved in
+cache_dir('gcmt') and reused, as long as the files do not change. A query
+selects the rows with numpy and returns a Catalog, which creates the obspy
+Events only when they are used.
+
+Example:
+            from bowpy.util.gcmt import get_gcmt_table
+
+            table = get_gcmt_table('/data/gcmt')
+            cat = table.query(UTCDateTime(2010, 1, 1), UTCDateTime(2011, 1, 1), minmagnitude=6.5,
+                              minlatitude=-60, maxlatitude=10, minlongitude=150, maxlongitude=-60)
+            print(len(cat), table.mw[cat.rows].max())
+            event = cat[0]
+
+            # In data_request instead of the globalcmt.org web form
+            data_request('IRIS', start, end, minmag, cat_client_name='/data/gcmt')
+"""
+
+# Size of the cells of the lat/lon index in degree.
+CELL = 10.
+
+_NLAT = int(180. / CELL)
+_NLON = int(360. / CELL)
+
+# Columns of a GCMTTable, saved with the index.
+COLUMNS = ('time', 'latitude', 'longitude', 'depth', 'mw', 'moment', 'tensor', 'name', 'region')
+
+_TABLES = {}
+
+
+def get_gcmt_table(path):
+    """
+    Returns the GCMTTable of the NDK files in path. It is read from the saved table in
+    cache_dir('gcmt'), if the files did not change, otherwise the files are parsed and the
+    table is saved.
+
+    :param path: NDK file, directory with NDK files (*.ndk) or list of NDK files
+    :type  path: str or list
+    """
+    filenames = _ndk_files(path)
+    signature = _signature(filenames)
+    table = _TABLES.get(signature)
+    if table is not None:
+        return table
+
+    filename = os.path.join(cache_dir('gcmt'), signature + '.npz')
+    if os.path.exists(filename):
+        try:
+            table = GCMTTable.load(filename)
+        except (IOError, OSError, ValueError, KeyError):
+            # Interrupted or from another numpy version.
+            table = None
+    if table is None:
+        table = read_ndk(filenames)
+        table.save(filename)
+    _TABLES[signature] = table
+    return table
+
+
+def read_ndk(filenames):
+    """
+    Parses NDK files into a GCMTTable, without keeping the lines of the files.
+
+    :param filenames: NDK file or list of NDK files
+    """
+    if not isinstance(filenames, (list, tuple)):
+        filenames = [filenames]
+    columns = dict((name, []) for name in COLUMNS)
+    for filename in filenames:
+        with open(filename) as fh:
+            block = []
+            for line in fh:
+                if not line.strip():
+                    continue
+                block.append(line.rstrip('\n'))
+                if len(block) == 5:
+                    _parse_event(block, columns, filename)
+                    block = []
+        if block:
+            msg = 'Incomplete event at the end of %s' % filename
+            raise IOError(msg)
+
+    return GCMTTable(np.array(columns['time'], dtype='float'), np.array(columns['latitude'], dtype='float'),
+                     np.array(columns['longitude'], dtype='float'), np.array(columns['depth'], dtype='float'),
+                     np.array(columns['mw'], dtype='float'), np.array(columns['moment'], dtype='float'),
+                     np.array(columns['tensor'], dtype='float').reshape(-1, 6),
+                     np.array(columns['name'], dtype='U16'), np.array(columns['region'], dtype='U24'))
+
+
+class GCMTTable(object):
+    """
+    Centroids of a GCMT catalog, sorted by time.
+
+    :attribute time: centroid times as timestamps
+    :attribute latitude, longitude: centroid location in degree
+    :attribute depth: centroid depth in km
+    :attribute mw: moment magnitude of the scalar moment
+    :attribute moment: scalar moment in Nm
+    :attribute tensor: moment tensors in Nm, shape (n, 6), columns m_rr, m_tt, m_pp, m_rt, m_rp, m_tp
+    :attribute name: CMT event names, e.g. 'C201001121000A'
+    :attribute region: Flinn-Engdahl region names
+    """
+
+    def __init__(self, time, latitude, longitude, depth, mw, moment, tensor, name, region, cells=None):
+        order = np.argsort(time, kind='stable')
+        self.time = time[order]
+        self.latitude = latitude[order]
+        self.longitude = longitude[order]
+        self.depth = depth[order]
+        self.mw = mw[order]
+        self.moment = moment[order]
+        self.tensor = tensor[order]
+        self.name = name[order]
+        self.region = region[order]
+
+        # Rows of each cell, in time order, as in a compressed sparse row matrix.
+        if cells is None:
+            cells = _cells(self.latitude, self.longitude)
+            self.cell_order = np.argsort(cells, kind='stable')
+            self.cell_start = np.searchsorted(cells[self.cell_order], np.arange(_NLAT * _NLON + 1))
+        else:
+            self.cell_order, self.cell_start = cells
+
+    def __len__(self):
+        return len(self.time)
+
+    def __str__(self):
+        if len(self) == 0:
+            return 'GCMTTable: 0 events'
+        return 'GCMTTable: %i events, %s - %s' % (len(self), UTCDateTime(self.time[0]), UTCDateTime(self.time[-1]))
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename, allow_pickle=False) as npz:
+            columns = [npz[name] for name in COLUMNS]
+            cells = (npz['cell_order'], npz['cell_start'])
+        # Saved in time order, the sort keeps it.
+        return cls(*columns, cells=cells)
+
+    def save(self, filename):
+        """
+        Saves the table and its index to filename, a .npz file.
+        """
+        columns = dict((name, getattr(self, name)) for name in COLUMNS)
+        tmpname = filename + '.tmp'
+        with open(tmpname, 'wb') as fh:
+            np.savez(fh, cell_order=self.cell_order, cell_start=self.cell_start, **columns)
+        os.replace(tmpname, filename)
+
+    def select(self, starttime=None, endtime=None, minlatitude=None, maxlatitude=None, minlongitude=None,
+               maxlongitude=None, mindepth=None, maxdepth=None, minmagnitude=None, maxmagnitude=None):
+        """
+        Rows of the events, which fit all given bounds, in time order. Parameters as in
+        Client.get_events, depths in km, minlongitude > maxlongitude is a range through
+        the date line.
+        """
+        i0 = np.searchsorted(self.time, UTCDateTime(starttime).timestamp) if starttime is not None else 0
+        i1 = np.searchsorted(self.time, UTCDateTime(endtime).timestamp, 'right') if endtime is not None else len(self)
+
+        # Rows of the cells in the lat/lon box, if they are fewer than the rows in the time range.
+        rows = None
+        if any(v is not None for v in (minlatitude, maxlatitude, minlongitude, maxlongitude)):
+            cells = _box_cells(minlatitude, maxlatitude, minlongitude, maxlongitude)
+            if (self.cell_start[cells + 1] - self.cell_start[cells]).sum() < i1 - i0:
+                rows = np.sort(np.concatenate([self.cell_order[self.cell_start[c]:self.cell_start[c + 1]]
+                                               for c in cells] + [np.zeros(0, dtype='int')]))
+                rows = rows[(rows >= i0) & (rows < i1)]
+        if rows is None:
+            rows = np.arange(i0, i1)
+
+        mask = np.ones(len(rows), dtype='bool')
+        if minlatitude is not None:
+            mask &= self.latitude[rows] >= minlatitude
+        if maxlatitude is not None:
+            mask &= self.latitude[rows] <= maxlatitude
+        if minlongitude is not None or maxlongitude is not None:
+            lon = self.longitude[rows]
+            lonmin = minlongitude if minlongitude is not None else -180.
+            lonmax = maxlongitude if maxlongitude is not None else 180.
+            if lonmin <= lonmax:
+                mask &= (lon >= lonmin) & (lon <= lonmax)
+            else:
+                mask &= (lon >= lonmin) | (lon <= lonmax)
+        for values, vmin, vmax in ((self.depth, mindepth, maxdepth), (self.mw, minmagnitude, maxmagnitude)):
+            if vmin is not None:
+                mask &= values[rows] >= vmin
+            if vmax is not None:
+                mask &= values[rows] <= vmax
+        return rows[mask]
+
+    def query(self, *args, **kwargs):
+        """
+        LazyCatalog of the events, which fit the bounds, for the parameters see select.
+        """
+        return LazyCatalog(self, self.select(*args, **kwargs))
+
+    def event(self, row):
+        """
+        obspy Event of row, with the centroid as origin, Mw and the moment tensor. The moment
+        tensor is also the attribute MomentTensor, as in request_gcmt.
+        """
+        name = str(self.name[row])
+        prefix = 'smi:local/ndk/%s' % name
+        origin = Origin(resource_id=ResourceIdentifier(prefix + '/origin'), time=UTCDateTime(self.time[row]),
+                        latitude=float(self.latitude[row]), longitude=float(self.longitude[row]),
+                        depth=1000. * float(self.depth[row]), origin_type='centroid')
+        magnitude = Magnitude(resource_id=ResourceIdentifier(prefix + '/magnitude'), mag=float(self.mw[row]),
+                              magnitude_type='Mw', origin_id=origin.resource_id)
+        m_rr, m_tt, m_pp, m_rt, m_rp, m_tp = [float(m) for m in self.tensor[row]]
+        tensor = MomentTensor(resource_id=ResourceIdentifier(prefix + '/momenttensor'),
+                              derived_origin_id=origin.resource_id, scalar_moment=float(self.moment[row]),
+                              tensor=Tensor(m_rr=m_rr, m_tt=m_tt, m_pp=m_pp, m_rt=m_rt, m_rp=m_rp, m_tp=m_tp))
+
+        event = Event(resource_id=ResourceIdentifier(prefix + '/event'), event_type='earthquake')
+        event.origins.append(origin)
+        event.magnitudes.append(magnitude)
+        event.focal_mechanisms.append(FocalMechanism(resource_id=ResourceIdentifier(prefix + '/focalmechanism'),
+                                                     moment_tensor=tensor))
+        event.event_descriptions.append(EventDescription(text=str(self.region[row]), type='Flinn-Engdahl region'))
+        event.preferred_origin_id = origin.resource_id.id
+        event.preferred_magnitude_id = magnitude.resource_id.id
+
+        event.MomentTensor = MomentTensor()
+        event.MomentTensor.m_rr = m_rr
+        event.MomentTensor.m_tt = m_tt
+        event.MomentTensor.m_pp = m_pp
+        event.MomentTensor.m_rt = m_rt
+        event.MomentTensor.m_rp = m_rp
+        event.MomentTensor.m_tp = m_tp
+        return event
+
+
+class LazyCatalog(Catalog):
+    """
+    Catalog of rows of a GCMTTable. The Events are created, when they are accessed by index
+    or iteration, all of them, when the list events is used.
+
+    :attribute rows: rows of the events in the table
+    """
+
+    def __init__(self, table=None, rows=None, **kwargs):
+        Catalog.__init__(self, **kwargs)
+        if table is not None:
+            self.__dict__['_table'] = table
+            self.__dict__['_built'] = {}
+            self.rows = np.asarray(rows, dtype='int')
+
+    def _get_events(self):
+        if self.__dict__.get('_table') is not None:
+            self.__dict__['_events'] = [self._event(k) for k in range(len(self.rows))]
+            self.__dict__['_table'] = None
+        return self.__dict__['_events']
+
+    def _set_events(self, events):
+        self.__dict__['_table'] = None
+        self.__dict__['_events'] = events
+
+    events = property(_get_events, _set_events)
+
+    def __len__(self):
+        if self.__dict__.get('_table') is not None:
+            return len(self.rows)
+        return len(self.events)
+
+    def __iter__(self):
+        if self.__dict__.get('_table') is None:
+            return iter(self.events)
+        return (self._event(k) for k in range(len(self.rows)))
+
+    def __getitem__(self, index):
+        if self.__dict__.get('_table') is not None and isinstance(index, (int, np.integer)):
+            if index < 0:
+                index += len(self.rows)
+            if not 0 <= index < len(self.rows):
+                raise IndexError('list index out of range')
+            return self._event(index)
+        return Catalog.__getitem__(self, index)
+
+    def _event(self, k):
+        built = self.__dict__['_built']
+        if k not in built:
+            built[k] = self.__dict__['_table'].event(self.rows[k])
+        return built[k]
+
+
+def _parse_event(lines, columns, filename):
+    """
+    Appends the values of the five lines of one event to columns.
+    """
+    try:
+        # The first line has the hypocenter, the time of the centroid is relative to it.
+        date = [int(v) for v in lines[0][5:15].split('/')]
+        hour, minute, second = lines[0][16:26].split(':')
+        reference = calendar.timegm((date[0], date[1], date[2], int(hour), int(minute), 0)) + float(second)
+        region = lines[0][56:].strip()
+        name = lines[1][:16].strip()
+
+        # Time shift, latitude, longitude and depth of the centroid, the errors are skipped.
+        centroid = [float(lines[2][a:b]) for a, b in ((10, 18), (22, 29), (34, 42), (47, 53))]
+        exponent = int(lines[3][:2])
+        values = [float(v) for v in lines[3][2:].split()]
+        moment = float(lines[4][49:56]) * 10. ** exponent
+    except (ValueError, IndexError):
+        msg = 'Not an NDK event in %s: %s' % (filename, lines[1][:16])
+        raise IOError(msg)
+
+    columns['time'].append(reference + centroid[0])
+    columns['latitude'].append(centroid[1])
+    columns['longitude'].append(centroid[2])
+    columns['depth'].append(centroid[3])
+    # Moments in dyne-cm in the file, 1 dyne-cm = 1e-7 Nm.
+    columns['tensor'].append([v * 10. ** exponent * 1e-7 for v in values[0::2]])
+    columns['moment'].append(moment * 1e-7)
+    columns['mw'].append(2. / 3. * (np.log10(moment) - 16.1))
+    columns['name'].append(name)
+    columns['region'].append(region)
+
+
+def _cells(latitude, longitude):
+    ilat = np.clip(((latitude + 90.) // CELL).astype('int'), 0, _NLAT - 1)
+    ilon = np.clip(((longitude + 180.) // CELL).astype('int'), 0, _NLON - 1)
+    return ilat * _NLON + ilon
+
+
+def _box_cells(minlatitude, maxlatitude, minlongitude, maxlongitude):
+    """
+    Cells, which overlap the lat/lon box.
+    """
+    ilat = np.arange(_NLAT)
+    latmin = minlatitude if minlatitude is not None else -90.
+    latmax = maxlatitude if maxlatitude is not None else 90.
+    ilat = ilat[(ilat * CELL - 90. <= latmax) & ((ilat + 1) * CELL - 90. >= latmin)]
+
+    ilon = np.arange(_NLON)
+    lonmin = minlongitude if minlongitude is not None else -180.
+    lonmax = maxlongitude if maxlongitude is not None else 180.
+    west, east = ilon * CELL - 180., (ilon + 1) * CELL - 180.
+    if lonmin <= lonmax:
+        ilon = ilon[(west <= lonmax) & (east >= lonmin)]
+    else:
+        ilon = ilon[(east >= lonmin) | (west <= lonmax)]
+    return (ilat[:, np.newaxis] * _NLON + ilon[np.newaxis, :]).ravel()
+
+
+def _ndk_files(path):
+    if isinstance(path, (list, tuple)):
+        return sorted(os.path.abspath(p) for p in path)
+    if os.path.isdir(path):
+        filenames = sorted(glob.glob(os.path.join(os.path.abspath(path), '*.ndk')))
+        if not filenames:
+            msg = 'No NDK files in %s' % path
+            raise IOError(msg)
+        return filenames
+    if not os.path.exists(path):
+        msg = 'No NDK file %s' % path
+        raise IOError(msg)
+    return [os.path.abspath(path)]
+
+
+def _signature(filenames):
+    """
+    Hash of the names, sizes and modification times of filenames.
+    """
+    sha = hashlib.sha1()
+    for filename in filenames:
+        stat = os.stat(filename)
+        sha.update(('%s %i %r\n' % (filename, stat.st_size, stat.st_mtime)).encode('utf-8'))
+    return sha.hexdigest()
@@ -0,0 +1,226 @@
+from __future__ import absolute_import
+import numpy as np
+
+"""
+Vectorized geodesics on numpy arrays, all functions broadcast their input
+like numpy ufuncs, so one station and many events, or many stations and one
+event are computed in one call.
+
+Example:
+            from bowpy.util.geodesy import locations2degrees, vincenty_inverse, geo_km
+
+            dist = locations2degrees(lats, lons, event_lat, event_lon)
+            meters, az, baz = vincenty_inverse(lats, lons, event_lat, event_lon)
+            x, y = geo_km(lons.mean(), lats.mean(), lons, lats)
+"""
+
+# WGS84 ellipsoid, as used by obspy.geodetics.gps2dist_azimuth.
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+
+# Mean radius of the earth in km.
+EARTH_RADIUS = 6371.0
+
+
+def locations2degrees(lat1, lon1, lat2, lon2):
+    """
+    Great circle distance in degree on a sphere, same as obspy.geodetics.locations2degrees.
+
+    :param lat1: latitude(s) of the first point(s) in degree
+    :param lon1: longitude(s) of the first point(s) in degree
+    :param lat2: latitude(s) of the second point(s) in degree
+    :param lon2: longitude(s) of the second point(s) in degree
+    """
+    lat1, lon1, lat2, lon2 = [np.radians(np.asarray(x, dtype='float')) for x in
+                              np.broadcast_arrays(lat1, lon1, lat2, lon2)]
+    dlon = lon2 - lon1
+    return np.degrees(np.arctan2(
+        np.sqrt((np.cos(lat2) * np.sin(dlon)) ** 2 +
+                (np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(dlon)) ** 2),
+        np.sin(lat1) * np.sin(lat2) + np.cos(lat1) * np.cos(lat2) * np.cos(dlon)))
+
+
+def haversine(lat1, lon1, lat2, lon2, radius=EARTH_RADIUS):
+    """
+    Great circle distance in km on a sphere with radius in km.
+    """
+    lat1, lon1, lat2, lon2 = [np.radians(np.asarray(x, dtype='float')) for x in
+                              np.broadcast_arrays(lat1, lon1, lat2, lon2)]
+    h = np.sin((lat2 - lat1) / 2.) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2.) ** 2
+    return 2. * radius * np.arcsin(np.sqrt(np.clip(h, 0., 1.)))
+
+
+def unit_vectors(lat, lon):
+    """
+    Cartesian unit vectors of points on the sphere, shape (n, 3). The euclidian distance of
+    two vectors grows monotonic with the great circle distance, so they can be used in a
+    scipy.spatial.cKDTree for nearest neighbour queries on the sphere.
+    """
+    lat = np.radians(np.asarray(lat, dtype='float'))
+    lon = np.radians(np.asarray(lon, dtype='float'))
+    return np.stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)), axis=-1)
+
+
+def geodetic2ecef(lat, lon, h=0., a=WGS84_A, f=WGS84_F):
+    """
+    Earth centered, earth fixed coordinates in km of points on the ellipsoid.
+
+    :param lat: latitude(s) in degree
+    :param lon: longitude(s) in degree
+    :param h: height(s) above the ellipsoid in km
+    """
+    lat = np.radians(np.asarray(lat, dtype='float'))
+    lon = np.radians(np.asarray(lon, dtype='float'))
+    a = a / 1000.
+    e2 = f * (2. - f)
+    N = a / np.sqrt(1. - e2 * np.sin(lat) ** 2)
+    x = (N + h) * np.cos(lat) * np.cos(lon)
+    y = (N + h) * np.cos(lat) * np.sin(lon)
+    z = (N * (1. - e2) + h) * np.sin(lat)
+    return x, y, z
+
+
+def geodetic2enu(lat, lon, h, lat0, lon0, h0=0.):
+    """
+    Local east, north, up coordinates in km of points relative to the reference point
+    lat0, lon0, h0, e.g. the center of an array.
+
+    :param lat: latitude(s) in degree
+    :param lon: longitude(s) in degree
+    :param h: height(s) in km
+    """
+    x, y, z = geodetic2ecef(lat, lon, h)
+    x0, y0, z0 = geodetic2ecef(lat0, lon0, h0)
+    dx, dy, dz = x - x0, y - y0, z - z0
+
+    lat0 = np.radians(lat0)
+    lon0 = np.radians(lon0)
+    east = -np.sin(lon0) * dx + np.cos(lon0) * dy
+    north = -np.sin(lat0) * np.cos(lon0) * dx - np.sin(lat0) * np.sin(lon0) * dy + np.cos(lat0) * dz
+    up = np.cos(lat0) * np.cos(lon0) * dx + np.cos(lat0) * np.sin(lon0) * dy + np.sin(lat0) * dz
+    return east, north, up
+
+
+def geo_km(orig_lon, orig_lat, lon, lat, a=WGS84_A, f=WGS84_F):
+    """
+    Vectorized version of obspy.signal.util.util_geo_km, transforms lon, lat to x, y in km
+    relative to orig_lon, orig_lat on the elliptic earth. Longitude differences are scaled
+    with the radius of the parallel at the mean latitude, latitude differences with the
+    meridian radius at orig_lat. Agrees with util_geo_km to about 1e-4 relative.
+
+    :param orig_lon: longitude of the origin in degree
+    :param orig_lat: latitude of the origin in degree
+    :param lon: longitude(s) in degree
+    :param lat: latitude(s) in degree
+    """
+    lon = np.asarray(lon, dtype='float')
+    lat = np.asarray(lat, dtype='float')
+    a = a / 1000.
+    e2 = f * (2. - f)
+
+    mid = np.radians((lat + orig_lat) / 2.)
+    parallel = a * np.cos(mid) / np.sqrt(1. - e2 * np.sin(mid) ** 2)
+    meridian = a * (1. - e2) / (1. - e2 * np.sin(np.radians(orig_lat)) ** 2) ** 1.5
+
+    x = np.radians(lon - orig_lon) * parallel
+    y = np.radians(lat - orig_lat) * meridian
+    return x, y
+
+
+def vincenty_inverse(lat1, lon1, lat2, lon2, a=WGS84_A, f=WGS84_F, maxiter=200, tol=1e-12):
+    """
+    Distance and azimuths between points on the ellipsoid, vectorized version of
+    obspy.geodetics.gps2dist_azimuth.
+
+    Points, for which the iteration does not converge (nearly antipodal), are
+    calculated on the sphere.
+
+    :param lat1: latitude(s) of the first point(s) in degree
+    :param lon1: longitude(s) of the first point(s) in degree
+    :param lat2: latitude(s) of the second point(s) in degree
+    :param lon2: longitude(s) of the second point(s) in degree
+
+    returns:
+    :param distance: distance in meters
+    :param azimuth: azimuth from point 1 to point 2 in degree
+    :param back_azimuth: azimuth from point 2 to point 1 in degree
+
+    Reference: Vincenty, T. (1975). Direct and inverse solutions of geodesics on the
+               ellipsoid with application of nested equations, Survey Review, 23, 88-93
+    """
+    lat1, lon1, lat2, lon2 = [np.asarray(x, dtype='float') for x in np.broadcast_arrays(lat1, lon1, lat2, lon2)]
+    b = a * (1. - f)
+
+    U1 = np.arctan((1. - f) * np.tan(np.radians(lat1)))
+    U2 = np.arctan((1. - f) * np.tan(np.radians(lat2)))
+    L = np.radians(lon2 - lon1)
+    sinU1, cosU1 = np.sin(U1), np.cos(U1)
+    sinU2, cosU2 = np.sin(U2), np.cos(U2)
+
+    lam = np.array(L, dtype='float')
+    active = np.ones(L.shape, dtype='bool')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for i in range(maxiter):
+            # Only the points, which have not converged yet, nearly antipodal points would
+            # otherwise keep the whole array iterating.
+            idx = active.copy()
+            lam_new = _vincenty_lambda(lam[idx], L[idx], sinU1[idx], cosU1[idx], sinU2[idx], cosU2[idx], f)[0]
+            active[idx] = abs(lam_new - lam[idx]) > tol
+            lam[idx] = np.where(np.isfinite(lam_new), lam_new, lam[idx])
+            if not active.any():
+                break
+
+        sigma, sinsigma, cossigma, cos2alpha, cos2sigmam = _vincenty_lambda(lam, L, sinU1, cosU1, sinU2,
+                                                                            cosU2, f)[1:]
+        sinlam, coslam = np.sin(lam), np.cos(lam)
+        u2 = cos2alpha * (a ** 2 - b ** 2) / b ** 2
+        A = 1. + u2 / 16384. * (4096. + u2 * (-768. + u2 * (320. - 175. * u2)))
+        B = u2 / 1024. * (256. + u2 * (-128. + u2 * (74. - 47. * u2)))
+        dsigma = B * sinsigma * (cos2sigmam + B / 4. * (
+            cossigma * (-1. + 2. * cos2sigmam ** 2) -
+            B / 6. * cos2sigmam * (-3. + 4. * sinsigma ** 2) * (-3. + 4. * cos2sigmam ** 2)))
+        distance = b * A * (sigma - dsigma)
+
+        azimuth = np.degrees(np.arctan2(cosU2 * sinlam, cosU1 * sinU2 - sinU1 * cosU2 * coslam))
+        back_azimuth = np.degrees(np.arctan2(cosU1 * sinlam, -sinU1 * cosU2 + cosU1 * sinU2 * coslam))
+
+    # gps2dist_azimuth returns 0 - 360 degree, back azimuth pointing back to point 1.
+    back_azimuth = back_azimuth + 180.
+
+    # Not converged, use the sphere with the mean radius.
+    failed = active | ~np.isfinite(distance)
+    if failed.any():
+        radius = (2. * a + b) / 3.
+        distance = np.where(failed, np.radians(locations2degrees(lat1, lon1, lat2, lon2)) * radius, distance)
+        azimuth = np.where(failed, _spherical_azimuth(lat1, lon1, lat2, lon2), azimuth)
+        back_azimuth = np.where(failed, _spherical_azimuth(lat2, lon2, lat1, lon1), back_azimuth)
+
+    azimuth = azimuth % 360.
+    back_azimuth = np.where(distance == 0, 0., back_azimuth % 360.)
+
+    return distance, azimuth, back_azimuth
+
+
+def _vincenty_lambda(lam, L, sinU1, cosU1, sinU2, cosU2, f):
+    """
+    One iteration of the longitude on the auxiliary sphere, returns the new lambda and the
+    terms of the distance.
+    """
+    sinlam, coslam = np.sin(lam), np.cos(lam)
+    sinsigma = np.sqrt((cosU2 * sinlam) ** 2 + (cosU1 * sinU2 - sinU1 * cosU2 * coslam) ** 2)
+    cossigma = sinU1 * sinU2 + cosU1 * cosU2 * coslam
+    sigma = np.arctan2(sinsigma, cossigma)
+    sinalpha = np.where(sinsigma == 0, 0., cosU1 * cosU2 * sinlam / sinsigma)
+    cos2alpha = 1. - sinalpha ** 2
+    cos2sigmam = np.where(cos2alpha == 0, 0., cossigma - 2. * sinU1 * sinU2 / cos2alpha)
+    C = f / 16. * cos2alpha * (4. + f * (4. - 3. * cos2alpha))
+    lam_new = L + (1. - C) * f * sinalpha * (
+        sigma + C * sinsigma * (cos2sigmam + C * cossigma * (-1. + 2. * cos2sigmam ** 2)))
+    return lam_new, sigma, sinsigma, cossigma, cos2alpha, cos2sigmam
+
+
+def _spherical_azimuth(lat1, lon1, lat2, lon2):
+    lat1, lat2 = np.radians(lat1), np.radians(lat2)
+    dlon = np.radians(lon2 - lon1)
+    return np.degrees(np.arctan2(np.sin(dlon) * np.cos(lat2),
+                                 np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(dlon)))
@@ -0,0 +1,189 @@
+from __future__ import absolute_import
+import hashlib
+import json
+import os
+import time
+
+"""
+Manifest of a data harvest with data_request. Each time window of a station
+for an event is one row with its status ('done', 'nodata' or 'failed'), the
+number of bytes and the checksum of the data and the file it was saved to.
+The rows are appended to a json lines file as soon as they are known, so an
+interrupted harvest keeps all finished rows. With resume=True, data_request
+only requests the rows, which are missing or failed.
+
+Example:
+            from bowpy.util.manifest import HarvestManifest
+
+            data_request('IRIS', start, end, minmag, net='TA',
+                         savefile='station', manifest='TA_2017.jsonl')
+
+            # After an interruption, only missing and failed windows are requested.
+            data_request('IRIS', start, end, minmag, net='TA',
+                         savefile='station', manifest='TA_2017.jsonl', resume=True)
+
+            manifest = HarvestManifest('TA_2017.jsonl')
+            print(manifest)
+            for row in manifest.rows(status='failed'):
+                print(row['network'], row['station'], row['error'])
+"""
+
+# Default file name of the manifest in the current directory.
+MANIFEST = 'harvest_manifest.jsonl'
+
+DONE = 'done'
+NODATA = 'nodata'
+FAILED = 'failed'
+
+
+def get_manifest(manifest):
+    """
+    Manifest argument of data_request: None or True for MANIFEST, False for no manifest,
+    the path of a manifest or a HarvestManifest.
+    """
+    if manifest is False:
+        return None
+    if manifest is None or manifest is True:
+        return HarvestManifest(MANIFEST)
+    if isinstance(manifest, HarvestManifest):
+        return manifest
+    return HarvestManifest(manifest)
+
+
+def event_id(event):
+    """
+    Identifier of event in the manifest, its resource id, or the time, coordinates and depth
+    of its preferred origin. obspy gives each new Event a random id under smi:local/, e.g.
+    for catalogs built in memory, these ids are not used.
+    """
+    rid = event.resource_id.id if event.resource_id is not None else None
+    if rid and not rid.startswith('smi:local/'):
+        return str(rid)
+
+    origin = event.preferred_origin() or event.origins[0]
+    return '%s %s %s %s' % (origin.time, _rounded(origin.latitude, 4), _rounded(origin.longitude, 4),
+                            _rounded(origin.depth, 0))
+
+
+def _rounded(value, ndigits):
+    if value is None:
+        return '-'
+    return '%.*f' % (ndigits, value)
+
+
+def stream_checksum(stream):
+    """
+    Number of bytes and sha1 checksum of the samples and codes of the traces of stream,
+    independent of the order of the traces and of the file format.
+    """
+    sha = hashlib.sha1()
+    nbytes = 0
+    for trace in sorted(stream, key=lambda tr: (tr.id, tr.stats.starttime.timestamp)):
+        sha.update(('%s %s %s' % (trace.id, trace.stats.starttime, trace.stats.sampling_rate)).encode('utf-8'))
+        sha.update(trace.data.tobytes())
+        nbytes += trace.data.nbytes
+    return nbytes, sha.hexdigest()
+
+
+class HarvestManifest(object):
+    """
+    Rows of a harvest in the json lines file path, the last line of a row is valid.
+    """
+
+    def __init__(self, path=MANIFEST):
+        self.path = path
+        self._rows = {}
+        self._lines = 0
+        self._load()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __str__(self):
+        counts = self.counts()
+        return 'HarvestManifest %s: %i rows, %i done, %i without data, %i failed' % (
+            self.path, len(self), counts[DONE], counts[NODATA], counts[FAILED])
+
+    def counts(self):
+        counts = {DONE: 0, NODATA: 0, FAILED: 0}
+        for row in self._rows.values():
+            counts[row['status']] += 1
+        return counts
+
+    def rows(self, status=None):
+        """
+        List of the rows, dicts with the keys event, network, station, location, channel,
+        starttime, endtime, status, bytes, checksum, file, error and time.
+        """
+        return [row for row in self._rows.values() if status is None or row['status'] == status]
+
+    def get(self, event, request):
+        """
+        Row of the WaveformRequest request for event, None if not in the manifest.
+        """
+        return self._rows.get(_row_key(event_id(event), request))
+
+    def is_complete(self, event, request):
+        """
+        True, if request for event has no data or was saved to a file, which still exists.
+        """
+        row = self.get(event, request)
+        if row is None:
+            return False
+        if row['status'] == NODATA:
+            return True
+        return row['status'] == DONE and (not row['file'] or os.path.exists(row['file']))
+
+    def record(self, event, request, status, stream=None, filename=None, error=None):
+        """
+        Adds or replaces the row of request for event and appends it to the file.
+
+        :param status: DONE, NODATA or FAILED
+        :param stream: the downloaded data of a DONE row
+        :param filename: file, to which the data were saved
+        :param error: error message of a FAILED row
+        """
+        eid = event_id(event)
+        nbytes, checksum = 0, None
+        if stream is not None:
+            nbytes, checksum = stream_checksum(stream)
+
+        row = {'event': eid, 'network': request.network, 'station': request.station,
+               'location': request.location, 'channel': request.channel,
+               'starttime': str(request.starttime), 'endtime': str(request.endtime), 'status': status,
+               'bytes': nbytes, 'checksum': checksum, 'file': filename, 'error': error, 'time': time.time()}
+        self._rows[_row_key(eid, request)] = row
+
+        with open(self.path, 'a') as fh:
+            fh.write(json.dumps(row) + '\n')
+        self._lines += 1
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as fh:
+            for text in fh:
+                try:
+                    row = json.loads(text)
+                except ValueError:
+                    # Last line of an interrupted harvest.
+                    continue
+                self._lines += 1
+                self._rows[_row_key(row['event'], row)] = row
+
+        # Rewrite the file, if it is mostly replaced rows.
+        if self._lines > 2 * len(self._rows) + 1000:
+            tmpname = self.path + '.tmp'
+            with open(tmpname, 'w') as fh:
+                for row in self._rows.values():
+                    fh.write(json.dumps(row) + '\n')
+            os.replace(tmpname, self.path)
+            self._lines = len(self._rows)
+
+
+def _row_key(eid, request):
+    if isinstance(request, dict):
+        codes = [request[k] for k in ('network', 'station', 'location', 'channel', 'starttime', 'endtime')]
+    else:
+        codes = list(request)
+    return '|'.join([eid] + [str(c) for c in codes])
@@ -0,0 +1,252 @@
+from __future__ import absolute_import, print_function
+import threading
+import time
+
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+from bowpy.util.response_cache import remove_response_batch
+
+"""
+Producer-consumer pipeline of threads, connected by bounded queues. Items
+put into the pipeline are passed through the stages in order, each stage has
+its own workers, a full queue blocks the stage in front of it. Used by
+data_request to preprocess and write the data of some stations while others
+are still downloading. Each stage counts its items, bytes and busy time.
+
+Example:
+            from bowpy.util.pipeline import Pipeline, Stage, preprocess_stream
+
+            pipeline = Pipeline([Stage('preprocess', lambda st: preprocess_stream(st, detrend='linear'),
+                                       workers=4),
+                                 Stage('write', lambda sts: [st.write(...) for st in sts],
+                                       batch_size=8)], size=stream_nbytes)
+            for st in streams:
+                pipeline.put(st)
+            pipeline.close()
+            print(pipeline)
+"""
+
+# Default length of the queue in front of each stage.
+QUEUE_SIZE = 16
+
+_STOP = object()
+
+
+class StageStats(object):
+    """
+    Throughput of one stage.
+
+    :attribute items, errors: number of processed and failed items
+    :attribute nbytes: size of the processed items in bytes
+    :attribute busy: time in s the workers spent on the items, summed over all workers
+    :attribute blocked: time in s the stage waited for a full queue behind it
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.errors = 0
+        self.nbytes = 0
+        self.busy = 0.
+        self.blocked = 0.
+        self.start = time.time()
+        self.end = None
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        elapsed = max((self.end or time.time()) - self.start, 1e-9)
+        return '%-12s %7i items %9.2f MB %8.1f s busy %8.1f s blocked %8.1f items/s %8.2f MB/s' % (
+            self.name, self.items, self.nbytes / 1e6, self.busy, self.blocked, self.items / elapsed,
+            self.nbytes / 1e6 / elapsed)
+
+    def add(self, items=0, nbytes=0, busy=0., blocked=0., errors=0):
+        with self._lock:
+            self.items += items
+            self.nbytes += nbytes
+            self.busy += busy
+            self.blocked += blocked
+            self.errors += errors
+
+
+class Stage(object):
+    """
+    One stage of a Pipeline.
+
+    :param name: name in the statistics
+    :param func: function of one item, or of a list of items if batch_size > 1. Its result is
+                 passed to the next stage, None is not passed on. With batch_size > 1 it returns
+                 a list of results or None.
+    :param workers: number of threads
+    :param batch_size: maximum number of items, which are passed to func at once, func gets
+                       the items, which are waiting in the queue
+    :param queue_size: length of the queue in front of the stage
+    """
+
+    def __init__(self, name, func, workers=1, batch_size=1, queue_size=QUEUE_SIZE):
+        self.name = name
+        self.func = func
+        self.workers = max(1, int(workers))
+        self.batch_size = max(1, int(batch_size))
+        self.queue = Queue(maxsize=max(1, int(queue_size)))
+        self.stats = StageStats(name)
+
+
+class Pipeline(object):
+    """
+    Threads of stages, started at once.
+
+    :param stages: list of Stage
+    :param size: function, which returns the size of an item in bytes for the statistics
+    :param source: name of the producer in the statistics
+
+    :attribute errors: list of (stage name, item, error message) of the items, which failed
+    """
+
+    def __init__(self, stages, size=None, source='input'):
+        self.stages = stages
+        self.size = size
+        self.source = StageStats(source)
+        self.errors = []
+        self._threads = []
+        for k, stage in enumerate(stages):
+            for w in range(stage.workers):
+                thread = threading.Thread(target=self._run, args=(k,), name='%s-%i' % (stage.name, w))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def __str__(self):
+        lines = ['Pipeline statistics:', '    %s' % self.source]
+        lines.extend('    %s' % stage.stats for stage in self.stages)
+        for name, item, error in self.errors:
+            lines.append('    %s failed: %s' % (name, error))
+        return '\n'.join(lines)
+
+    def put(self, item, stage=None):
+        """
+        Puts item into the queue of the first stage, or of the stage named stage. Blocks, if the
+        queue is full.
+        """
+        k = self._index(stage)
+        t0 = time.time()
+        self.stages[k].queue.put(item)
+        if stage is None:
+            self.source.add(1, self._size(item), blocked=time.time() - t0)
+
+    def join(self, stage=None):
+        """
+        Waits until all items are processed by all stages up to stage, default all stages.
+        """
+        last = self._index(stage) if stage is not None else len(self.stages) - 1
+        for k in range(last + 1):
+            self.stages[k].queue.join()
+
+    def close(self):
+        """
+        Waits until all items are processed and stops the threads.
+        """
+        self.join()
+        self.source.end = time.time()
+        for stage in self.stages:
+            for w in range(stage.workers):
+                stage.queue.put(_STOP)
+            stage.queue.join()
+            stage.stats.end = time.time()
+        for thread in self._threads:
+            thread.join()
+
+    def _index(self, name):
+        if name is None:
+            return 0
+        for k, stage in enumerate(self.stages):
+            if stage.name == name:
+                return k
+        msg = 'No stage %s in pipeline' % name
+        raise IOError(msg)
+
+    def _size(self, item):
+        if self.size is None:
+            return 0
+        try:
+            return self.size(item)
+        except Exception:
+            return 0
+
+    def _run(self, k):
+        stage = self.stages[k]
+        following = self.stages[k + 1] if k + 1 < len(self.stages) else None
+        while True:
+            items = [stage.queue.get()]
+            if items[0] is _STOP:
+                stage.queue.task_done()
+                return
+            # The items waiting in the queue, as one batch.
+            while len(items) < stage.batch_size:
+                try:
+                    item = stage.queue.get_nowait()
+                except Empty:
+                    break
+                if item is _STOP:
+                    # For another worker, or for this one after the batch.
+                    stage.queue.task_done()
+                    stage.queue.put(_STOP)
+                    break
+                items.append(item)
+
+            t0 = time.time()
+            try:
+                if stage.batch_size > 1:
+                    results = stage.func(items) or []
+                else:
+                    results = [stage.func(items[0])]
+                errors = 0
+            except Exception as e:
+                results = []
+                errors = len(items)
+                self.errors.append((stage.name, items, '%s: %s' % (type(e).__name__, e)))
+            busy = time.time() - t0
+
+            t0 = time.time()
+            if following is not None:
+                for result in results:
+                    if result is not None:
+                        following.queue.put(result)
+            stage.stats.add(len(items) - errors, sum(self._size(item) for item in items), busy,
+                            time.time() - t0, errors)
+            for item in items:
+                stage.queue.task_done()
+
+
+def preprocess_stream(stream, detrend=None, taper=None, decimate=None, remove_response=None,
+                      pre_filt=None):
+    """
+    Preprocessing of the traces of stream in place, in the order detrend, taper, response
+    removal and decimation.
+
+    :param detrend: type of Stream.detrend, e.g. 'linear' or 'demean'
+    :param taper: max_percentage of a hann taper, e.g. 0.05
+    :param decimate: integer factor of Stream.decimate, with its anti-alias filter
+    :param remove_response: output of Stream.remove_response, 'DISP', 'VEL' or 'ACC'. The
+                            response must be attached, e.g. by data_request. The evaluated
+                            responses are cached, see bowpy.util.response_cache.
+    :param pre_filt: pre_filt of Stream.remove_response
+    """
+    if detrend:
+        stream.detrend(detrend)
+    if taper:
+        stream.taper(max_percentage=taper, type='hann')
+    if remove_response:
+        remove_response_batch(stream, output=remove_response, pre_filt=pre_filt)
+    if decimate and decimate > 1:
+        stream.decimate(int(decimate), strict_length=False)
+    return stream
+
+
+def stream_nbytes(stream):
+    """
+    Size of the samples of stream in bytes.
+    """
+    return sum(trace.data.nbytes for trace in stream)
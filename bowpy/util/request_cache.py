@@ -0,0 +1,405 @@
+from __future__ import absolute_import, print_function
+from collections import OrderedDict
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+
+import obspy
+from obspy import Stream, UTCDateTime
+from obspy.core.event import Catalog
+from obspy.core.inventory import Channel, Inventory, Network, Station
+
+from bowpy.util.base import cache_dir
+
+"""
+Local cache of downloaded waveforms, inventories and catalogs. Each request is
+normalized (client, codes, time window, model, source parameters ...) and
+hashed to a key. The results are stored as miniSEED, StationXML or QuakeML
+blobs, which are named by the hash of their content, so e.g. the same
+inventory requested for many events is stored once. Responses attached to
+waveforms are stored as a StationXML inventory of their own and attached
+again when the waveforms are read, other stats, which miniSEED does not keep,
+are lost. The index is a journal of json lines next to the blobs. If the blobs exceed max_size, the least
+recently used requests are removed. In offline mode requests, which are not
+in the cache, raise an IOError instead of using the network.
+
+Example:
+            from bowpy.util.request_cache import get_cache, set_offline
+
+            cache = get_cache()
+            inv = cache.fetch({'service': 'station', 'client': 'IRIS', 'network': 'TA'},
+                              lambda: client.get_stations(network='TA'))
+
+            # The same, for cache=None client.get_stations is called directly
+            inv = cached_request(cache, 'station', client, client.get_stations, network='TA')
+
+            # Reprocess without network access
+            set_offline(True)
+            list_of_stream, inventory, cat = data_request('IRIS', cat=cat, inv=inv, cache=True)
+"""
+
+INDEX = 'index.jsonl'
+
+# Size of the default cache in bytes.
+MAX_SIZE = 2 * 1024 ** 3
+
+_CACHE = []
+
+
+def get_cache():
+    """
+    Returns the default RequestCache in cache_dir('requests'), shared inside a session.
+    The environment variable BOWPY_OFFLINE=1 starts it in offline mode.
+    """
+    if not _CACHE:
+        offline = os.environ.get('BOWPY_OFFLINE', '0') not in ('', '0')
+        _CACHE.append(RequestCache(cache_dir('requests'), MAX_SIZE, offline))
+    return _CACHE[0]
+
+
+def set_offline(offline=True):
+    """
+    Switches the default cache to offline mode, or back.
+    """
+    get_cache().offline = offline
+
+
+def resolve_cache(cache):
+    """
+    Cache argument of the request functions: True for the default cache, False or None for
+    no cache, or a RequestCache.
+    """
+    if cache is True:
+        return get_cache()
+    if cache is None or cache is False:
+        return None
+    return cache
+
+
+def cached_request(cache, service, client, func, **params):
+    """
+    Returns func(**params), the request of service of client, read from cache if the same
+    request was made before. Without cache (None), func is called.
+
+    :param service: name of the service, e.g. 'event', 'station' or 'syngine'
+    :param client: FDSN Client, its base url is part of the request, or None
+    """
+    if cache is None:
+        return func(**params)
+    key = dict(params, service=service, client=client.base_url if client is not None else None)
+    return cache.fetch(key, lambda: func(**params))
+
+
+def request_key(params):
+    """
+    Hash of the normalized request params, a dict of str, numbers, UTCDateTimes and lists
+    of them. None values are dropped, so optional arguments do not change the key.
+    """
+    text = json.dumps(_normalize(params), sort_keys=True)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class RequestCache(object):
+    """
+    Blobs of request results in path, with the journal INDEX.
+
+    :attribute max_size: maximum size of all blobs in bytes
+    :attribute offline: If True, fetch raises an IOError for requests, which are not cached
+    """
+
+    def __init__(self, path, max_size=MAX_SIZE, offline=False):
+        self.path = path
+        self.max_size = max_size
+        self.offline = offline
+        self._lock = threading.Lock()
+        # key -> dict(blob, format, size, atime)
+        self._entries = {}
+        # blob -> number of keys referring to it
+        self._refs = {}
+        self._size = 0
+        self._lines = 0
+        if not os.path.isdir(os.path.join(path, 'blobs')):
+            os.makedirs(os.path.join(path, 'blobs'))
+        self._load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, params):
+        return request_key(params) in self._entries
+
+    @property
+    def size(self):
+        """
+        Size of all blobs in bytes, blobs shared by several requests count once.
+        """
+        return self._size
+
+    def fetch(self, params, func):
+        """
+        Returns the cached result of the request params, or calls func, caches and returns
+        its result. Empty results are not cached.
+
+        :param params: normalized request, see request_key
+        :type  params: dict
+
+        :param func: function without arguments, which requests the data
+        """
+        key = request_key(params)
+        obj = self.get(key)
+        if obj is not None:
+            return obj
+        if self.offline:
+            msg = 'Offline mode, request not in cache: %s' % json.dumps(_normalize(params), sort_keys=True)
+            raise IOError(msg)
+
+        obj = func()
+        if obj is not None and len(obj) > 0:
+            self.put(key, obj)
+        return obj
+
+    def get(self, key):
+        """
+        Cached Stream, Inventory or Catalog of key, None if not cached.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            filename = self._blob_path(entry['blob'], entry['format'])
+            if not os.path.exists(filename):
+                self._remove(key)
+                return None
+            entry['atime'] = time.time()
+            self._append({'op': 'get', 'key': key, 'atime': entry['atime']})
+
+        try:
+            obj = _read(filename, entry['format'])
+        except (IOError, OSError):
+            # Evicted by another thread meanwhile.
+            return None
+
+        if entry.get('responses'):
+            inv = self.get(entry['responses'])
+            if inv is None:
+                return None
+            for trace in obj:
+                try:
+                    trace.stats.response = inv.get_response(trace.id, trace.stats.starttime)
+                except Exception:
+                    # Trace without response, obspy raises Exception.
+                    continue
+        return obj
+
+    def put(self, key, obj):
+        """
+        Stores obj, a Stream, Inventory or Catalog, as result of key. The responses attached
+        to a Stream are stored as an Inventory under a key of their own.
+        """
+        fmt = _format(obj)
+        responses = None
+        if isinstance(obj, Stream):
+            inv = _response_inventory(obj)
+            if inv is not None:
+                responses = key + '-responses'
+                self.put(responses, inv)
+
+        buf = io.BytesIO()
+        obj.write(buf, format=fmt)
+        data = buf.getvalue()
+        blob = hashlib.sha256(data).hexdigest()
+
+        filename = self._blob_path(blob, fmt)
+        with self._lock:
+            if not os.path.exists(filename):
+                if not os.path.isdir(os.path.dirname(filename)):
+                    os.makedirs(os.path.dirname(filename))
+                tmpname = filename + '.%i.tmp' % threading.current_thread().ident
+                with open(tmpname, 'wb') as fh:
+                    fh.write(data)
+                os.replace(tmpname, filename)
+
+            entry = {'blob': blob, 'format': fmt, 'size': len(data), 'atime': time.time()}
+            if responses:
+                entry['responses'] = responses
+            old = self._entries.get(key)
+            if old is not None and self._unref(old) and old['blob'] != blob:
+                oldname = self._blob_path(old['blob'], old['format'])
+                if os.path.exists(oldname):
+                    os.remove(oldname)
+            self._entries[key] = entry
+            self._ref(entry)
+            line = dict(entry)
+            line.update({'op': 'put', 'key': key})
+            self._append(line)
+            self._evict()
+
+    def clear(self):
+        """
+        Removes all requests and blobs.
+        """
+        with self._lock:
+            for key in list(self._entries):
+                self._remove(key)
+            self._compact()
+
+    def _blob_path(self, blob, fmt):
+        return os.path.join(self.path, 'blobs', blob[:2], '%s.%s' % (blob, fmt.lower()))
+
+    def _ref(self, entry):
+        if entry['blob'] not in self._refs:
+            self._refs[entry['blob']] = 0
+            self._size += entry['size']
+        self._refs[entry['blob']] += 1
+
+    def _unref(self, entry):
+        """
+        Returns True, if no key refers to the blob of entry any more.
+        """
+        self._refs[entry['blob']] -= 1
+        if self._refs[entry['blob']] > 0:
+            return False
+        del self._refs[entry['blob']]
+        self._size -= entry['size']
+        return True
+
+    def _evict(self):
+        if self._size <= self.max_size:
+            return
+        for key in sorted(self._entries, key=lambda k: self._entries[k]['atime']):
+            self._remove(key)
+            if self._size <= self.max_size:
+                break
+
+    def _remove(self, key):
+        """
+        Removes key from the index and its blob, if no other key refers to it.
+        """
+        entry = self._entries.pop(key)
+        self._append({'op': 'del', 'key': key})
+        if self._unref(entry):
+            filename = self._blob_path(entry['blob'], entry['format'])
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def _append(self, line):
+        with open(os.path.join(self.path, INDEX), 'a') as fh:
+            fh.write(json.dumps(line) + '\n')
+        self._lines += 1
+
+    def _load(self):
+        filename = os.path.join(self.path, INDEX)
+        if not os.path.exists(filename):
+            return
+        with open(filename) as fh:
+            for text in fh:
+                try:
+                    line = json.loads(text)
+                except ValueError:
+                    # Last line of an interrupted session.
+                    continue
+                self._lines += 1
+                key = line.get('key')
+                if line['op'] == 'put':
+                    self._entries[key] = dict((k, line[k]) for k in ('blob', 'format', 'size', 'atime',
+                                                                     'responses') if k in line)
+                elif line['op'] == 'get' and key in self._entries:
+                    self._entries[key]['atime'] = line['atime']
+                elif line['op'] == 'del':
+                    self._entries.pop(key, None)
+        for entry in self._entries.values():
+            self._ref(entry)
+
+        # Streams of older versions, pickled with their responses, are not read.
+        for key in [k for k, entry in self._entries.items() if entry['format'] not in _FORMATS]:
+            self._remove(key)
+
+        # Rewrite the journal, if it is mostly outdated lines.
+        if self._lines > 2 * len(self._entries) + 1000:
+            self._compact()
+
+    def _compact(self):
+        filename = os.path.join(self.path, INDEX)
+        tmpname = filename + '.tmp'
+        with open(tmpname, 'w') as fh:
+            for key, entry in self._entries.items():
+                line = dict(entry)
+                line.update({'op': 'put', 'key': key})
+                fh.write(json.dumps(line) + '\n')
+        os.replace(tmpname, filename)
+        self._lines = len(self._entries)
+
+
+_FORMATS = ('MSEED', 'STATIONXML', 'QUAKEML')
+
+
+def _format(obj):
+    if isinstance(obj, Stream):
+        return 'MSEED'
+    if isinstance(obj, Inventory):
+        return 'STATIONXML'
+    if isinstance(obj, Catalog):
+        return 'QUAKEML'
+    msg = 'Type %s can not be cached' % type(obj).__name__
+    raise TypeError(msg)
+
+
+def _response_inventory(stream):
+    """
+    Inventory with the responses attached to the traces of stream, None if there are none.
+    The channels have no coordinates. They have no dates, unless a channel has different
+    responses in stream, so the same responses of several requests give the same blob.
+    """
+    traces = OrderedDict()
+    for trace in stream:
+        if trace.stats.get('response') is not None:
+            traces.setdefault(trace.id, []).append(trace)
+    if not traces:
+        return None
+
+    networks = OrderedDict()
+    stations = {}
+    for seed_id, channel_traces in traces.items():
+        net, sta, loc, cha = seed_id.split('.')
+        if net not in networks:
+            networks[net] = Network(net)
+        if (net, sta) not in stations:
+            stations[net, sta] = Station(sta, 0., 0., 0.)
+            networks[net].stations.append(stations[net, sta])
+
+        response = channel_traces[0].stats.response
+        dated = any(trace.stats.response != response for trace in channel_traces[1:])
+        for trace in (channel_traces if dated else channel_traces[:1]):
+            channel = Channel(cha, loc, 0., 0., 0., 0., response=trace.stats.response)
+            if dated:
+                channel.start_date = trace.stats.starttime
+                channel.end_date = trace.stats.endtime
+            stations[net, sta].channels.append(channel)
+
+    # Fixed creation time, the content of equal responses is the same.
+    return Inventory(list(networks.values()), source='bowpy', created=UTCDateTime(0))
+
+
+def _read(filename, fmt):
+    if fmt == 'STATIONXML':
+        return obspy.read_inventory(filename, format=fmt)
+    if fmt == 'QUAKEML':
+        return obspy.read_events(filename, format=fmt)
+    return obspy.read(filename, format=fmt)
+
+
+def _normalize(value):
+    if isinstance(value, dict):
+        return dict((str(k), _normalize(v)) for k, v in value.items() if v is not None)
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    if isinstance(value, UTCDateTime):
+        return str(value)
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, (str, int, bool)):
+        return value
+    return str(value)
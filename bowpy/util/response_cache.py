@@ -0,0 +1,231 @@
+from __future__ import absolute_import
+from collections import OrderedDict
+import hashlib
+import pickle
+import threading
+
+import numpy as np
+from obspy.core.inventory import PolynomialResponseStage
+from obspy.signal.invsim import cosine_sac_taper, cosine_taper, invert_spectrum
+from obspy.signal.util import _npts2nfft
+
+"""
+Cache of evaluated instrument responses and response removal of many traces
+at once. The inverted frequency response of a channel epoch, with water level
+and pre-filter applied, depends only on the fft length, the sampling rate,
+the output units and the pre-filter, so it is evaluated once and reused for
+all events. remove_response_batch groups the traces of a stream by length
+and sampling rate and deconvolves each group in one rfft, multiply and irfft
+pass. The result is the same as of Stream.remove_response.
+
+Example:
+            from bowpy.util.response_cache import get_response_cache, remove_response_batch
+
+            for event in cat:
+                st = data[event]
+                remove_response_batch(st, inv, output='VEL', pre_filt=[0.005, 0.01, 1., 2.])
+            print(get_response_cache())
+"""
+
+# Size of the default cache in bytes.
+MAX_SIZE = 512 * 1024 ** 2
+
+# Maximum number of samples deconvolved in one block.
+BLOCK_SIZE = 2 ** 24
+
+_CACHE = []
+
+
+def get_response_cache():
+    """
+    Returns the default ResponseCache, shared inside a session.
+    """
+    if not _CACHE:
+        _CACHE.append(ResponseCache(MAX_SIZE))
+    return _CACHE[0]
+
+
+class ResponseCache(object):
+    """
+    Inverted frequency responses in memory, the least recently used are removed, if
+    they exceed max_size.
+
+    :attribute hits, misses: number of responses read from the cache and evaluated
+    """
+
+    def __init__(self, max_size=MAX_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __str__(self):
+        return 'ResponseCache: %i responses, %.1f MB, %i hits, %i misses' % (
+            len(self), self._size / 1024. ** 2, self.hits, self.misses)
+
+    @property
+    def size(self):
+        """
+        Size of all cached responses in bytes.
+        """
+        return self._size
+
+    def get(self, response, epoch, delta, nfft, output='VEL', water_level=60, pre_filt=None):
+        """
+        Inverted frequency response of response at the nfft // 2 + 1 frequencies of rfft,
+        multiplied by the pre-filter, as applied by Trace.remove_response.
+
+        :param response: Response of the channel
+        :type  response: obspy.core.inventory.response.Response
+
+        :param epoch: key of the channel epoch, e.g. (seed id, start date)
+        :param delta: sampling interval in s
+        :param nfft: length of the fft
+        :param output: 'DISP', 'VEL' or 'ACC'
+        :param water_level: water level in dB, None for none
+        :param pre_filt: four corner frequencies of the cosine taper in Hz
+        """
+        key = (epoch, int(nfft), float(delta), output, water_level,
+               tuple(pre_filt) if pre_filt is not None else None)
+        with self._lock:
+            spectrum = self._entries.get(key)
+            if spectrum is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return spectrum
+            self.misses += 1
+
+        spectrum = _inverse_response(response, delta, nfft, output, water_level, pre_filt)
+        spectrum.setflags(write=False)
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = spectrum
+                self._size += spectrum.nbytes
+            while self._size > self.max_size and len(self._entries) > 1:
+                self._size -= self._entries.popitem(last=False)[1].nbytes
+        return spectrum
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+def remove_response_batch(stream, inventory=None, output='VEL', water_level=60, pre_filt=None, zero_mean=True,
+                          taper=True, taper_fraction=0.05, cache=None):
+    """
+    Removes the instrument response of all traces of stream in place, with the same
+    parameters and results as Stream.remove_response. Traces of the same length and
+    sampling rate are deconvolved together.
+
+    :param stream: traces, the responses are taken from inventory or from the attached
+                   stats.response
+    :type  stream: obspy.core.stream.Stream
+
+    :param inventory: Inventory with the responses, None for the attached responses
+    :type  inventory: obspy.core.inventory.inventory.Inventory
+
+    :param cache: ResponseCache, default is the cache of get_response_cache
+    :type  cache: bowpy.util.response_cache.ResponseCache
+
+    For the other parameters see obspy.core.trace.Trace.remove_response.
+    """
+    if cache is None:
+        cache = get_response_cache()
+    channels = _channels(inventory) if inventory is not None else None
+
+    groups = {}
+    for trace in stream:
+        response, epoch = _channel_response(trace, channels)
+        if _is_polynomial(response):
+            # Not a frequency response, obspy divides by the gain.
+            trace.remove_response(inventory=inventory, output=output, water_level=water_level,
+                                  pre_filt=pre_filt, zero_mean=zero_mean, taper=taper,
+                                  taper_fraction=taper_fraction)
+            continue
+        groups.setdefault((trace.stats.npts, trace.stats.delta), []).append((trace, response, epoch))
+
+    info = 'bowpy: remove_response_batch(output=%r::water_level=%r::pre_filt=%r)' % (output, water_level, pre_filt)
+    for (npts, delta), members in groups.items():
+        nfft = _npts2nfft(npts)
+        if taper:
+            window = cosine_taper(npts, taper_fraction, sactaper=True, halfcosine=False)
+        step = max(1, BLOCK_SIZE // nfft)
+        for k0 in range(0, len(members), step):
+            block = members[k0:k0 + step]
+            data = np.array([trace.data for trace, response, epoch in block], dtype=np.float64)
+            if zero_mean:
+                data -= data.mean(axis=1)[:, np.newaxis]
+            if taper:
+                data *= window
+
+            spectrum = np.fft.rfft(data, n=nfft, axis=1)
+            for k, (trace, response, epoch) in enumerate(block):
+                spectrum[k] *= cache.get(response, epoch, delta, nfft, output, water_level, pre_filt)
+            spectrum[:, -1] = np.abs(spectrum[:, -1])
+            data = np.fft.irfft(spectrum, nfft, axis=1)[:, :npts]
+
+            for k, (trace, response, epoch) in enumerate(block):
+                trace.data = np.ascontiguousarray(data[k])
+                trace.stats.setdefault('processing', []).append(info)
+    return stream
+
+
+def _inverse_response(response, delta, nfft, output, water_level, pre_filt):
+    # As Trace.remove_response.
+    spectrum, freqs = response.get_evalresp_response(delta, nfft, output=output)
+    if water_level is None:
+        spectrum[0] = 0.
+        spectrum[1:] = 1. / spectrum[1:]
+    else:
+        invert_spectrum(spectrum, water_level)
+    if pre_filt:
+        spectrum *= cosine_sac_taper(freqs, flimit=pre_filt)
+    return spectrum
+
+
+def _channels(inventory):
+    """
+    Channels of inventory by seed id, as lists of (start date, end date, channel).
+    """
+    channels = {}
+    for network in inventory:
+        for station in network:
+            for channel in station:
+                seed_id = '%s.%s.%s.%s' % (network.code, station.code, channel.location_code, channel.code)
+                channels.setdefault(seed_id, []).append((channel.start_date, channel.end_date, channel))
+    return channels
+
+
+def _channel_response(trace, channels):
+    """
+    Response of trace and the key of its channel epoch, from channels or from the attached
+    response.
+    """
+    if channels is None:
+        response = trace.stats.get('response')
+        if response is None:
+            msg = 'No response attached to %s' % trace.id
+            raise ValueError(msg)
+        # Each request attaches a new Response, the same channel epoch has the same content.
+        return response, (trace.id, hashlib.sha1(pickle.dumps(response, protocol=2)).hexdigest())
+
+    t = trace.stats.starttime
+    for start, end, channel in channels.get(trace.id, []):
+        if (start is None or start <= t) and (end is None or t <= end):
+            if channel.response is None:
+                break
+            return channel.response, (trace.id, str(start))
+    msg = 'No matching response information found for %s at %s' % (trace.id, t)
+    raise ValueError(msg)
+
+
+def _is_polynomial(response):
+    if not response.response_stages:
+        return response.instrument_polynomial is not None
+    return isinstance(response.response_stages[0], PolynomialResponseStage)
@@ -0,0 +1,203 @@
+from __future__ import absolute_import
+import weakref
+
+import numpy as np
+from obspy import Trace
+from obspy.core import AttribDict
+from obspy.core.inventory.network import Network
+
+from bowpy.util.geodesy import EARTH_RADIUS, locations2degrees, unit_vectors, vincenty_inverse
+
+"""
+Lookup index of the stations in an Inventory, built once per Inventory and
+shared by all functions working on the same array. Holds the station codes
+and columnar coordinate arrays, distances and back-azimuths to an event are
+calculated for all stations at once.
+
+Example:
+            from bowpy.util.station_index import get_station_index
+
+            index = get_station_index(inv)
+            index.attach(stream, event)
+            rows = index.rows(stream)
+            dist = index.distances(event)[rows]
+"""
+
+_INDEXES = {}
+
+
+def get_station_index(inventory):
+    """
+    Returns the StationIndex of inventory. It is cached by the identity of the inventory and
+    rebuilt if networks or stations were added or removed since. After changing codes or
+    coordinates of stations in place, call invalidate(inventory).
+
+    :param inventory: Inventory or Network
+    :type inventory: obspy.core.inventory.inventory.Inventory
+    """
+    key = id(inventory)
+    counts = _counts(inventory)
+    cached = _INDEXES.get(key)
+    if cached is not None:
+        ref, index = cached
+        if ref() is inventory and index.counts == counts:
+            return index
+
+    index = StationIndex(inventory)
+    index.counts = counts
+    try:
+        ref = weakref.ref(inventory, lambda r, key=key: _INDEXES.pop(key, None))
+    except TypeError:
+        return index
+    _INDEXES[key] = (ref, index)
+    return index
+
+
+def invalidate(inventory):
+    """
+    Removes the cached StationIndex of inventory, the next get_station_index rebuilds it.
+    """
+    _INDEXES.pop(id(inventory), None)
+
+
+class StationIndex(object):
+    """
+    Codes and coordinates of all stations of an Inventory.
+
+    :attribute codes: list of 'NETWORK.STATION' codes
+    :attribute latitude, longitude: numpy.ndarray in degree
+    :attribute elevation: numpy.ndarray in m
+    """
+
+    def __init__(self, inventory, signature=None):
+        if signature is None:
+            signature = _signature(inventory)
+        self.signature = signature
+
+        self.codes = ['%s.%s' % (net, sta) for net, sta, lat, lon, ele in signature]
+        self.networks = [net for net, sta, lat, lon, ele in signature]
+        self.stations = [sta for net, sta, lat, lon, ele in signature]
+        self.latitude = np.array([s[2] for s in signature], dtype='float')
+        self.longitude = np.array([s[3] for s in signature], dtype='float')
+        self.elevation = np.array([s[4] for s in signature], dtype='float')
+
+        self.row = dict((code, i) for i, code in enumerate(self.codes))
+        # Station code only, the last network wins, as in attach_network_to_traces.
+        self.station_row = dict((sta, i) for i, sta in enumerate(self.stations))
+
+        self._event_cache = {}
+        self._tree = None
+
+    def __len__(self):
+        return len(self.codes)
+
+    def rows(self, stream):
+        """
+        Row of each trace in stream, found by network and station code, -1 if not found.
+        """
+        if isinstance(stream, Trace):
+            stream = [stream]
+        return np.array([self.row.get('%s.%s' % (tr.stats.network, tr.stats.station), -1) for tr in stream],
+                        dtype='int')
+
+    def distances(self, event):
+        """
+        Epicentral distances in degree of all stations to the event.
+        """
+        return self._event_values(event)[0]
+
+    def back_azimuths(self, event):
+        """
+        Back-azimuths of all stations as set by attach_coordinates_to_traces.
+        """
+        return self._event_values(event)[1]
+
+    def nearest(self, latitude, longitude, absolute_height_in_km=0., candidates=None):
+        """
+        Row of the station closest to the given point, searched in a KD-tree of the stations
+        on the sphere, with the absolute height as fourth coordinate.
+
+        :param candidates: rows of the stations to choose from, default all
+        :type candidates: set
+        """
+        if len(self) == 0:
+            return None
+        if self._tree is None:
+            from scipy.spatial import cKDTree
+            points = np.hstack((EARTH_RADIUS * unit_vectors(self.latitude, self.longitude),
+                                abs(self.elevation[:, np.newaxis]) / 1000.))
+            self._tree = cKDTree(points)
+
+        point = np.append(EARTH_RADIUS * unit_vectors(latitude, longitude), abs(absolute_height_in_km))
+        k = 1
+        while True:
+            k = min(k, len(self))
+            rows = np.atleast_1d(self._tree.query(point, k=k)[1])
+            for row in rows:
+                if candidates is None or row in candidates:
+                    return int(row)
+            if k == len(self):
+                return None
+            k *= 8
+
+    def attach(self, stream, event=None, network=True, coordinates=True):
+        """
+        Attaches network code, coordinates and, if event is given, distance, depth, origin
+        and back-azimuth to the traces in one pass. Traces of unknown stations are skipped.
+        """
+        if isinstance(stream, Trace):
+            stream = [stream]
+
+        if event:
+            distances, back_azimuths = self._event_values(event)
+            depth = event.origins[0].depth / 1000.
+            origin = event.origins[0].time
+
+        for trace in stream:
+            if network:
+                i = self.station_row.get(trace.stats.station)
+                if i is not None:
+                    trace.stats.network = self.networks[i]
+            if not coordinates:
+                continue
+
+            i = self.row.get('%s.%s' % (trace.stats.network, trace.stats.station))
+            if i is None:
+                continue
+            trace.stats.coordinates = AttribDict()
+            trace.stats.coordinates.latitude = self.latitude[i]
+            trace.stats.coordinates.longitude = self.longitude[i]
+            trace.stats.coordinates.elevation = self.elevation[i]
+            if event:
+                trace.stats.distance = distances[i]
+                trace.stats.depth = depth
+                trace.stats.origin = origin
+                trace.stats.back_azimuth = back_azimuths[i]
+
+    def _event_values(self, event):
+        origin = event.origins[0]
+        key = (origin.latitude, origin.longitude)
+        if key not in self._event_cache:
+            distances = locations2degrees(self.latitude, self.longitude, origin.latitude, origin.longitude)
+            back_azimuths = vincenty_inverse(self.latitude, self.longitude, origin.latitude, origin.longitude)[2]
+            # Keep only the last events, one array is processed with few events at a time.
+            if len(self._event_cache) > 16:
+                self._event_cache.clear()
+            self._event_cache[key] = (distances, back_azimuths)
+        return self._event_cache[key]
+
+
+def _counts(inventory):
+    # Number of stations of each network, without walking the stations.
+    if isinstance(inventory, Network):
+        return (len(inventory.stations),)
+    return tuple(len(network.stations) for network in inventory)
+
+
+def _signature(inventory):
+    if isinstance(inventory, Network):
+        networks = [inventory]
+    else:
+        networks = inventory
+    return tuple((network.code, station.code, station.latitude, station.longitude, station.elevation)
+                 for network in networks for station in network)
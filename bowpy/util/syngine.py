@@ -5,6 +5,8 @@ from obspy.clients.fdsn import Client as fdsnClient
 from obspy.core.util.attribdict import AttribDict
 from obspy.geodetics.base import degrees2kilometers, gps2dist_azimuth
 from bowpy.util.array_util import dist_azimuth2gps, geometrical_center
+from bowpy.util.download import get_client
+from bowpy.util.request_cache import cached_request, resolve_cache
 
 """
 :param sourcedoublecouple: Specify a source as a double couple. The
@@ -65,17 +67,31 @@ st = streams.TA
 
 def get_syngine_data(model, client=None, reclat=None, reclon=None, inv=None,
                      eventid=None, origins=None, m_tensor=None,
-                     source_dc=None):
+                     source_dc=None, cache=False):
     """
     param reclat:
     type reclat: list of floats
     param reclon:
     type reclon: list of floats
+    param cache: Seismograms and events are kept in the local request cache,
+                 see bowpy.util.request_cache. True for the default cache,
+                 False for none (default)
     """
+    cache = resolve_cache(cache)
     if client:
-        client = fdsnClient(client)
+        client = get_client(client, offline=cache is not None and cache.offline)
     synclient = synClient()
 
+    if eventid:
+        source = dict(eventid=eventid)
+    else:
+        source = dict(origintime=origins.time,
+                      sourcelatitude=origins.latitude,
+                      sourcelongitude=origins.longitude,
+                      sourcedepthinmeters=origins.depth,
+                      sourcemomenttensor=m_tensor,
+                      sourcedoublecouple=source_dc)
+
     if inv:
         streams = AttribDict()
         for network in inv:
@@ -83,46 +99,18 @@ def get_syngine_data(model, client=None, reclat=None, reclon=None, inv=None,
 
             for station in network:
                 print(station)
-                if eventid:
-                    stream_tmp = synclient.get_waveforms(model=model,
-                                                         network=network.code,
-                                                         station=station.code,
-                                                         eventid=eventid
-                                                         )
-                else:
-                    stream_tmp = synclient.get_waveforms(model=model,
-                                                         network=network.code,
-                                                         station=station.code,
-                                                         origintime=origins.time,
-                                                         sourcelatitude=origins.latitude,
-                                                         sourcelongitude=origins.longitude,
-                                                         sourcedepthinmeters=origins.depth,
-                                                         sourcemomenttensor=m_tensor,
-                                                         sourcedoublecouple=source_dc
-                                                         )
+                stream_tmp = _get_waveforms(synclient, cache, model=model,
+                                            network=network.code,
+                                            station=station.code, **source)
                 stream.append(stream_tmp[0])
             streams[network.code] = stream
 
     if reclat and reclon:
         stream = obspy.Stream()
         for rlat, rlon in zip(reclat, reclon):
-            if eventid:
-                stream_tmp = synclient.get_waveforms(model=model,
-                                                     receiverlatitude=rlat,
-                                                     receiverlongitude=rlon,
-                                                     eventid=eventid
-                                                     )
-            else:
-                stream_tmp = synclient.get_waveforms(model=model,
-                                                     receiverlatitude=rlat,
-                                                     receiverlongitude=rlon,
-                                                     origintime=origins.time,
-                                                     sourcelatitude=origins.latitude,
-                                                     sourcelongitude=origins.longitude,
-                                                     sourcedepthinmeters=origins.depth,
-                                                     sourcemomenttensor=m_tensor,
-                                                     sourcedoublecouple=source_dc
-                                                     )
+            stream_tmp = _get_waveforms(synclient, cache, model=model,
+                                        receiverlatitude=rlat,
+                                        receiverlongitude=rlon, **source)
             stream.append(stream_tmp[0])
         streams = stream
 
@@ -130,9 +118,11 @@ def get_syngine_data(model, client=None, reclat=None, reclon=None, inv=None,
         starttime = origins.time - 120
         endtime = starttime + 120
         if client:
-            cat = client.get_events(starttime, endtime,
-                                    minlatitude=origins.latitude-.5,
-                                    maxlatitude=origins.latitude+.5)
+            params = dict(starttime=starttime, endtime=endtime,
+                          minlatitude=origins.latitude-.5,
+                          maxlatitude=origins.latitude+.5)
+            cat = cached_request(cache, 'event', client, client.get_events,
+                                 **params)
         else:
             cat = None
     else:
@@ -141,6 +131,15 @@ def get_syngine_data(model, client=None, reclat=None, reclon=None, inv=None,
     return streams, cat
 
 
+def _get_waveforms(synclient, cache, **params):
+    """
+    synclient.get_waveforms(**params), read from cache if the same
+    seismogram was requested before.
+    """
+    return cached_request(cache, 'syngine', None, synclient.get_waveforms,
+                          **params)
+
+
 def get_ref_data(stream, inv, model='ak135f_1s', eventid=None, origins=None,
                  m_tensor=None, source_dc=None):
 
@@ -1,5 +1,14 @@
 from __future__ import absolute_import, print_function
 
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import threading
+import time
+try:
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    from urlparse import parse_qs, urlparse
+
 import numpy
 import numpy as np
 from numpy.random import randint
@@ -7,9 +16,21 @@ import matplotlib
 import matplotlib.pyplot as plt
 import sys
 
+from obspy import Stream, Trace, UTCDateTime
+from obspy.clients.fdsn import Client
+from obspy.core.event import Catalog, Event, Origin
+from obspy.core.inventory import Inventory, Network, Station
+from obspy.geodetics import locations2degrees
+
 from bowpy.util.base import stream2array, array2stream
-from bowpy.filter.fk import pocs_recon
-from bowpy.util.array_util import stack
+from bowpy.util.download import download_waveforms, download_waveforms_bulk
+from bowpy.filter.fk import fk_filter, pocs_recon
+from bowpy.filter.radon import radon_inverse
+from bowpy.filter.ssa import fx_ssa
+from bowpy.util.array_util import stack, vespagram
+from bowpy.util.event_geometry import FIRST_ARRIVALS, EventGeometry
+from bowpy.util.gather import ArrayGather
+from bowpy.util.traveltimes import get_model, traveltimes
 from bowpy.util.fkutil import plot
 # If using a Mac Machine, otherwitse comment the next line out:
 matplotlib.use('TkAgg')
@@ -56,6 +77,333 @@ def qtest_pocs(st_rec, st_orginal, alpharange, irange):
     return Qall
 
 
+def qtest_precision(func, *args, **kwargs):
+    """
+    Runs func once with precision='double' and once with precision='single'
+    and returns the deviation of the single precision result, defined as:
+
+    dev = || d_double - d_single ||_2 / || d_double ||_2
+
+    and its Q value as in qtest_pocs. func is one of fk_filter, pocs_recon,
+    vespagram, fx_ssa or radon_inverse, args and kwargs are passed to it.
+    For functions, which return a tuple, the first item is compared.
+
+    :param tolerance: maximum accepted deviation, default 1e-3
+    :type tolerance: float
+
+    returns: dev, Q and whether dev is below tolerance.
+
+    Example:
+            dev, Q, passed = qtest_precision(vespagram, st, 3., 12., 0.1, inv=inv, event=event,
+                                             plot=None)
+    """
+    tolerance = kwargs.pop('tolerance', 1e-3)
+
+    results = []
+    for precision in ('double', 'single'):
+        result = func(*args, precision=precision, **kwargs)
+        if isinstance(result, tuple):
+            result = result[0]
+        if hasattr(result, 'to_stream'):
+            result = result.data
+        elif not isinstance(result, numpy.ndarray):
+            result = stream2array(result, copy=False)
+        results.append(np.asarray(result))
+
+    d_double, d_single = results
+    if d_single.real.dtype != np.float32:
+        print('Result of single precision is %s' % d_single.dtype)
+
+    diff = np.linalg.norm((d_double - d_single).ravel(), 2)
+    dev = diff / np.linalg.norm(d_double.ravel(), 2)
+    if diff == 0:
+        Q = np.inf
+    else:
+        Q = 10.*np.log(np.linalg.norm(d_double.ravel(), 2)**2. / diff**2.)
+
+    passed = dev <= tolerance
+    print('%s: deviation single/double %e, Q %f, %s' % (func.__name__, dev, Q,
+                                                       'passed' if passed else 'FAILED'))
+    return dev, Q, passed
+
+
+def precision_gather(n_of_traces=20, n_of_samples=512, delta=0.1, seed=0):
+    """
+    Synthetic ArrayGather for qtest_precision_all: two Ricker wavelets with
+    a linear moveout of 2 and -1 s/deg between 30 and 40 deg and some noise.
+    The depth is 100 km, the origin at the first sample.
+    """
+    rng = np.random.RandomState(seed)
+    distance = np.linspace(30., 40., n_of_traces)
+    t = np.arange(n_of_samples) * delta
+
+    data = 0.05 * rng.randn(n_of_traces, n_of_samples)
+    for t0, slowness in ((15., 2.), (35., -1.)):
+        x = (np.pi * (t[np.newaxis, :] - t0 - slowness * (distance[:, np.newaxis] - 30.)) / 1.)**2.
+        data += (1. - 2. * x) * np.exp(-x)
+
+    return ArrayGather(data, delta, 0., distance=distance, depth=100., origin=0.)
+
+
+def qtest_precision_all(gather=None, tolerance=1e-3):
+    """
+    Runs qtest_precision for fk_filter, pocs_recon, vespagram, fx_ssa and
+    radon_inverse on gather, default is precision_gather(), and raises an
+    AssertionError, if the deviation of one of them exceeds tolerance.
+
+    returns: dict of function name and (dev, Q)
+
+    Example:
+            results = qtest_precision_all()
+    """
+    if gather is None:
+        gather = precision_gather()
+
+    # pocs_recon reconstructs the dead traces.
+    gaps = gather.copy(data=gather.data.copy())
+    gaps.data[3::5] = 0.
+    gaps.live[3::5] = False
+
+    p = np.linspace(-3., 3., 61)
+    tests = [
+        (fk_filter, (gather,), dict(ftype='extract', fshape=['butterworth', 2, 2])),
+        (pocs_recon, (gaps,), dict(maxiter=10, method='linear', dmethod='reconstruct', alpha=0.9)),
+        (vespagram, (gather, -3., 3., 0.1), dict(plot=None)),
+        (fx_ssa, (gather.data.T, gather.delta, 4, 0.1, 4.), {}),
+        (radon_inverse, (gather, None, None, p, None, 'linear', 'L2', [5e-2]), {}),
+    ]
+
+    results = {}
+    failed = []
+    for func, args, kwargs in tests:
+        dev, Q, passed = qtest_precision(func, *args, tolerance=tolerance, **kwargs)
+        results[func.__name__] = (dev, Q)
+        if not passed:
+            failed.append('%s: %e' % (func.__name__, dev))
+
+    if failed:
+        msg = 'Deviation of single precision above %e: %s' % (tolerance, ', '.join(failed))
+        raise AssertionError(msg)
+
+    return results
+
+
+def qtest_traveltimes(phase='P', tolerance=0.05):
+    """
+    Compares traveltimes of a 2D array of depths and distances, including
+    the triplications between 15 and 30 deg, with the exact first arrival
+    of TauP. Raises an AssertionError, if a time differs by more than
+    tolerance s.
+
+    returns: largest difference in s
+
+    Example:
+            qtest_traveltimes('P')
+    """
+    depth = np.array([[10.], [33.], [150.]])
+    distance = np.array([[5., 15., 18., 19.5, 21., 22.5, 25., 28., 40., 95.]])
+    times = traveltimes(depth, distance, phase)
+    assert times.shape == (3, 10), 'shape %s' % (times.shape,)
+
+    model = get_model()
+    exact = np.empty(times.shape)
+    for (i, j), t in np.ndenumerate(times):
+        arrivals = model.get_travel_times(depth[i, 0], distance[0, j], phase_list=[phase])
+        exact[i, j] = arrivals[0].time if arrivals else np.nan
+
+    assert (np.isnan(times) == np.isnan(exact)).all(), 'arrivals differ'
+    dev = np.nanmax(abs(times - exact))
+    print('traveltimes %s: largest difference to TauP %.4f s' % (phase, dev))
+    assert dev <= tolerance, 'difference %f s above %f s' % (dev, tolerance)
+    return dev
+
+
+def qtest_event_geometry(tolerance=0.05):
+    """
+    Selects the stations of three events at 20 to 22 deg N with
+    EventGeometry, the stations at 40 to 45 deg N are 18 to 25 deg away,
+    where the first arrival has triplications. Compares the distances and
+    first arrival times with obspy and TauP and checks the distance mask.
+    Raises an AssertionError, if a check fails.
+
+    Example:
+            qtest_event_geometry()
+    """
+    t0 = UTCDateTime(2010, 1, 1)
+    catalog = Catalog([Event(origins=[Origin(time=t0, latitude=lat, longitude=0., depth=10000.)])
+                       for lat in (20., 21., 22.)])
+    stations = [Station('G%02i' % i, 40. + i, 0.5 * i, 0.) for i in range(6)]
+    inventory = Inventory([Network('XX', stations=stations)], source='bowpy')
+
+    geometry = EventGeometry(catalog, inventory)
+    model = get_model()
+    for i, event in enumerate(catalog):
+        o = event.origins[0]
+        for j, station in enumerate(stations):
+            dist = locations2degrees(o.latitude, o.longitude, station.latitude, station.longitude)
+            assert abs(geometry.distance[i, j] - dist) < 1e-6, 'distance %s %s' % (i, j)
+            arrivals = model.get_travel_times(o.depth / 1000., dist, phase_list=FIRST_ARRIVALS)
+            dt = abs(geometry.ptime[i, j] - arrivals[0].time)
+            assert dt <= tolerance, 'first arrival %s %s differs by %f s' % (i, j, dt)
+
+    mask = geometry.mask(distance=[20., 25.])
+    expected = (geometry.distance >= 20.) & (geometry.distance <= 25.)
+    assert (mask == expected).all() and 0 < mask.sum() < mask.size, 'distance mask'
+
+    requests = geometry.requests(0, 60., 540., 'BHZ', mask)
+    assert len(requests[0][2]) == mask[0].sum(), 'requests'
+    print('EventGeometry: %i of %i pairs selected' % (mask.sum(), mask.size))
+
+
+class FDSNTestServer(object):
+    """
+    Local stand-in of an FDSN dataselect service in a background thread, which
+    serves miniSEED with one BHZ trace of 1 Hz per request line.
+
+    :param status: dict of station code and list of HTTP status codes, which
+                   the requests of this station get in order, before the data
+                   are returned, e.g. {'A01': [204], 'A02': [500, 500]}.
+                   Codes of bulk requests are taken from their first station.
+    :param max_bulk: bulk requests with more lines are rejected with 413
+
+    :attribute url: base url for obspy.clients.fdsn.Client
+    :attribute calls: dict of station code and number of requests
+    :attribute times: dict of station code and list of the request times
+    :attribute rejected: number of bulk requests rejected with 413
+
+    Example:
+            server = FDSNTestServer({'A01': [204]})
+            client = Client(server.url, _discover_services=False)
+            st = client.get_waveforms('XX', 'A02', '', 'BHZ', t1, t2)
+            server.close()
+    """
+
+    def __init__(self, status=None, max_bulk=None):
+        self.status = dict(status or {})
+        self.max_bulk = max_bulk
+        self.calls = {}
+        self.times = {}
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                query = dict((k, v[0]) for k, v in parse_qs(urlparse(self.path).query).items())
+                line = [query.get(k, '') for k in ('network', 'station', 'location', 'channel',
+                                                   'starttime', 'endtime')]
+                server._respond(self, [line])
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+                lines = [line.split() for line in body.splitlines()]
+                server._respond(self, [line for line in lines if len(line) == 6])
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%i' % self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _respond(self, handler, lines):
+        if not lines:
+            return self._send(handler, 400, b'No request lines', 'text/plain')
+        if self.max_bulk and len(lines) > self.max_bulk:
+            with self._lock:
+                self.rejected += 1
+            return self._send(handler, 413, b'Request too large', 'text/plain')
+
+        station = lines[0][1]
+        with self._lock:
+            self.calls[station] = self.calls.get(station, 0) + 1
+            self.times.setdefault(station, []).append(time.time())
+            codes = self.status.get(station, [])
+            code = codes[self.calls[station] - 1] if self.calls[station] <= len(codes) else 200
+        if code != 200:
+            return self._send(handler, code, b'Status %i' % code, 'text/plain')
+
+        buf = io.BytesIO()
+        Stream([_test_trace(*line) for line in lines]).write(buf, format='MSEED')
+        self._send(handler, 200, buf.getvalue(), 'application/vnd.fdsn.mseed')
+
+    def _send(self, handler, code, body, content_type):
+        handler.send_response(code)
+        if code == 204:
+            handler.end_headers()
+            return
+        handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+
+def _test_trace(network, station, location, channel, starttime, endtime):
+    starttime, endtime = UTCDateTime(starttime), UTCDateTime(endtime)
+    if location == '--':
+        location = ''
+    if '*' in channel or '?' in channel:
+        channel = 'BHZ'
+    data = np.arange(int(endtime - starttime), dtype='int32')
+    return Trace(data, dict(network=network, station=station, location=location, channel=channel,
+                            starttime=starttime, delta=1.))
+
+
+def qtest_download(backoff=0.2):
+    """
+    Runs download_waveforms and download_waveforms_bulk against a local
+    FDSNTestServer and checks the DownloadReport: station A02 has no data
+    (204), A03 fails twice with 500 and succeeds on the second retry, A04
+    fails on all attempts. The pauses between the attempts of A03 must be at
+    least backoff and 2 * backoff. Bulk requests of more than 2 lines are
+    rejected with 413 and have to be split. Raises an AssertionError, if a
+    check fails.
+
+    Example:
+            qtest_download()
+    """
+    t1 = UTCDateTime(2010, 1, 1)
+    requests = [('XX', 'A%02i' % i, '', 'BHZ', t1, t1 + 60) for i in range(1, 6)]
+    status = {'A02': [204], 'A03': [500, 500], 'A04': [500] * 10}
+
+    server = FDSNTestServer(status)
+    try:
+        client = Client(server.url, timeout=30, _discover_services=False)
+        streams, report = download_waveforms(client, requests, workers=2, retries=2, backoff=backoff,
+                                             timeout=10)
+        print(report)
+        assert client.timeout == 30, 'timeout of the client changed'
+        assert report.succeeded == 3, 'succeeded %i of 3' % report.succeeded
+        assert [r.station for r in report.nodata] == ['A02'], 'no data %s' % report.nodata
+        assert [(r.station, n) for r, msg, n in report.failed] == [('A04', 3)], 'failed %s' % report.failed
+        assert server.calls['A02'] == 1, 'request without data repeated'
+        assert all(len(st) == 1 and st[0].stats.npts == 60 for i, st in enumerate(streams) if i in (0, 2, 4))
+        pauses = np.diff(server.times['A03'])
+        assert pauses[0] >= backoff and pauses[1] >= 2 * backoff, 'pauses %s' % pauses
+    finally:
+        server.close()
+
+    server = FDSNTestServer({'A01': [500]}, max_bulk=2)
+    try:
+        client = Client(server.url, _discover_services=False)
+        streams, report = download_waveforms_bulk(client, requests, group_size=5, retries=1,
+                                                  backoff=backoff)
+        print(report)
+        assert report.succeeded == 5 and not report.failed, 'bulk %s' % report
+        assert [st[0].stats.station for st in streams] == [r[1] for r in requests], 'bulk assignment'
+        assert server.calls['A01'] == 2, 'bulk request not repeated after 500'
+        assert server.rejected > 0, 'no bulk request rejected'
+    finally:
+        server.close()
+
+
 def qtest_plot(ifile, alpharange, irange, ifile_path=None, ofile=None, fs=20,
                cmap='Blues', cbarlim=None):
 
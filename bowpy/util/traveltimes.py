@@ -0,0 +1,285 @@
+from __future__ import absolute_import, print_function
+import atexit
+from collections import OrderedDict
+import os
+
+import numpy as np
+from obspy.taup import TauPyModel
+from obspy.taup.taup_time import TauPTime
+
+from bowpy.util.base import cache_dir
+
+"""
+Travel-time service shared by all of bowpy. Each TauPyModel is loaded once,
+first arrivals are tabulated on a (depth, distance) grid per phase and
+queried by bilinear interpolation. Tables are persisted on disk. Queries
+outside of the grid, or in a cell, which is not linear within TOLERANCE (e.g.
+where the first arrival changes its branch), use the exact TauP calculation,
+whose results are kept with the table. They are written to disk with the
+next computed rows, every SAVE_BATCH new results and at exit.
+
+Example:
+            from bowpy.util.traveltimes import traveltimes
+
+            t = traveltimes(35., np.array([30., 31.5, 40.2]), 'P')
+            p = traveltimes(35., 31.5, 'P', attribute='ray_param_sec_degree')
+"""
+
+# Attributes of obspy.taup.helper_classes.Arrival stored in each table.
+ATTRIBUTES = ('time', 'ray_param_sec_degree', 'incident_angle')
+
+# Largest deviation of the times of a grid cell from a plane in s, up to which
+# the cell is interpolated.
+TOLERANCE = 0.01
+
+# Maximum number of exact results kept per table, the least recently used are removed.
+EXACT_SIZE = 100000
+
+# Number of new exact results, after which a table is written to disk.
+SAVE_BATCH = 1000
+
+_MODELS = {}
+_TABLES = {}
+
+
+def get_model(taup_model='ak135'):
+    """
+    Returns the TauPyModel of name taup_model, loaded only once per session.
+    """
+    if taup_model not in _MODELS:
+        _MODELS[taup_model] = TauPyModel(taup_model)
+    return _MODELS[taup_model]
+
+
+def get_table(phase, taup_model='ak135', depth_step=5., distance_step=0.5, maxdepth=800., persist=True):
+    """
+    Returns the TravelTimeTable of phase in taup_model, tables are shared inside a session.
+    """
+    phase = _phase_list(phase)
+    key = (tuple(phase), taup_model, float(depth_step), float(distance_step), float(maxdepth))
+    if key not in _TABLES:
+        if not _TABLES:
+            atexit.register(_flush_all)
+        _TABLES[key] = TravelTimeTable(phase, taup_model, depth_step, distance_step, maxdepth, persist)
+    return _TABLES[key]
+
+
+def traveltimes(depth, distance, phase, taup_model='ak135', attribute='time'):
+    """
+    Vectorized lookup of the first arrival of phase.
+
+    :param depth: source depth(s) in km
+    :type  depth: float or numpy.ndarray
+
+    :param distance: epicentral distance(s) in degree
+    :type  distance: float or numpy.ndarray
+
+    :param phase: Name of phase, or list of phases of which the first arrival is used,
+                  e.g. 'ttall' for the first arrival of all phases.
+    :type  phase: str or list
+
+    :param taup_model: model used by TauPyModel, default is ak135
+    :type  taup_model: str
+
+    :param attribute: 'time' (s), 'ray_param_sec_degree' (s/deg) or 'incident_angle' (deg)
+    :type  attribute: str
+
+    returns: values of attribute, same shape as the broadcast input, NaN where the phase
+             does not exist.
+    """
+    return get_table(phase, taup_model).lookup(depth, distance, attribute)
+
+
+class TravelTimeTable(object):
+    """
+    First arrivals of one phase (list) on a regular (depth, distance) grid.
+
+    The grid spans 0 to maxdepth km and 0 to 180 degree. Depth rows are only
+    calculated when a query needs them and written to the cache directory,
+    so following sessions start with all rows already used before.
+    """
+
+    def __init__(self, phase, taup_model='ak135', depth_step=5., distance_step=0.5, maxdepth=800.,
+                 persist=True):
+        self.phase = _phase_list(phase)
+        self.taup_model = taup_model
+        self.depth_step = float(depth_step)
+        self.distance_step = float(distance_step)
+        self.depths = np.arange(0., maxdepth + self.depth_step / 2., self.depth_step)
+        self.distances = np.arange(0., 180. + self.distance_step / 2., self.distance_step)
+
+        self.grid = np.empty((self.depths.size, len(ATTRIBUTES), self.distances.size))
+        self.grid[:] = np.nan
+        self.computed = np.zeros(self.depths.size, dtype='bool')
+        # Exact results, (depth, distance) -> values of ATTRIBUTES
+        self.exact = OrderedDict()
+        # Number of exact results, which are not written to disk.
+        self._unsaved = 0
+
+        self.filename = None
+        if persist:
+            name = '%s_%s_%g_%g_%g.npz' % (os.path.basename(str(taup_model)), '-'.join(self.phase),
+                                           self.depth_step, self.distance_step, maxdepth)
+            self.filename = os.path.join(cache_dir('taup'), name.replace('^', 'v'))
+            self._load()
+
+    def lookup(self, depth, distance, attribute='time'):
+        """
+        Interpolates attribute for the given depth(s) in km and distance(s) in degree.
+        """
+        isscalar = np.isscalar(depth) and np.isscalar(distance)
+        depth, distance = np.broadcast_arrays(np.atleast_1d(np.asarray(depth, dtype='float')),
+                                              np.atleast_1d(np.asarray(distance, dtype='float')))
+        # Flat queries, the values get the broadcast shape on return.
+        shape = depth.shape
+        depth, distance = depth.ravel(), distance.ravel()
+        iattr = ATTRIBUTES.index(attribute)
+
+        zpos = depth / self.depth_step
+        xpos = distance / self.distance_step
+        inside = (zpos >= 0) & (zpos <= self.depths.size - 1) & (xpos >= 0) & (xpos <= self.distances.size - 1)
+
+        iz = np.clip(np.floor(zpos).astype('int'), 0, self.depths.size - 2)
+        ix = np.clip(np.floor(xpos).astype('int'), 0, self.distances.size - 2)
+        wz = zpos - iz
+        wx = xpos - ix
+
+        self._compute_rows(np.unique(np.append(iz[inside], iz[inside] + 1)))
+
+        values = np.empty(depth.shape)
+        values[:] = np.nan
+        g = self.grid[:, iattr]
+        z0, z1, x0, x1 = iz[inside], iz[inside] + 1, ix[inside], ix[inside] + 1
+        values[inside] = ((1. - wz[inside]) * ((1. - wx[inside]) * g[z0, x0] + wx[inside] * g[z0, x1]) +
+                          wz[inside] * ((1. - wx[inside]) * g[z1, x0] + wx[inside] * g[z1, x1]))
+
+        # Cells, in which the time is not linear, e.g. at a triplication or a change of the
+        # first phase. The times along distance are compared to the trapezoid rule of the
+        # ray parameters, NaN next to a grid point without arrival fails all tests.
+        t, p, dx = self.grid[:, 0], self.grid[:, 1], self.distance_step
+        linear = ((np.abs(t[z0, x1] - t[z0, x0] - 0.5 * (p[z0, x0] + p[z0, x1]) * dx) < TOLERANCE) &
+                  (np.abs(t[z1, x1] - t[z1, x0] - 0.5 * (p[z1, x0] + p[z1, x1]) * dx) < TOLERANCE) &
+                  (np.abs(t[z1, x0] - t[z0, x0] - t[z1, x1] + t[z0, x1]) < TOLERANCE))
+        values[np.flatnonzero(inside)[~linear]] = np.nan
+
+        # Out of grid or not linear, use exact TauP.
+        for i in np.flatnonzero(np.isnan(values)):
+            values[i] = self._exact(depth[i], distance[i])[iattr]
+        if self._unsaved >= SAVE_BATCH:
+            self._save()
+
+        if isscalar:
+            return float(values[0])
+        return values.reshape(shape)
+
+    def flush(self):
+        """
+        Writes the table to disk, if it has exact results, which are not written yet.
+        """
+        if self._unsaved:
+            self._save()
+
+    def _compute_rows(self, rows):
+        rows = [r for r in rows if not self.computed[r]]
+        if not rows:
+            return
+        m = get_model(self.taup_model)
+        for r in rows:
+            # Depth correction is the expensive part, do it once per row.
+            tt = TauPTime(m.model, self.phase, self.depths[r], 0.)
+            try:
+                tt.depth_correct(self.depths[r])
+                tt.recalc_phases()
+            except Exception:
+                tt = None
+            for j, dist in enumerate(self.distances):
+                if tt is None:
+                    continue
+                try:
+                    tt.calc_time(dist)
+                except Exception:
+                    continue
+                if tt.arrivals:
+                    self.grid[r, :, j] = [getattr(tt.arrivals[0], attr) for attr in ATTRIBUTES]
+            self.computed[r] = True
+        self._save()
+
+    def _exact(self, depth, distance):
+        key = (round(float(depth), 3), round(float(distance), 4))
+        if key in self.exact:
+            self.exact.move_to_end(key)
+            return self.exact[key]
+        m = get_model(self.taup_model)
+        try:
+            arrivals = m.get_travel_times(key[0], key[1], phase_list=self.phase)
+        except Exception:
+            arrivals = []
+        if not arrivals:
+            values = (np.nan,) * len(ATTRIBUTES)
+        else:
+            values = tuple(getattr(arrivals[0], attr) for attr in ATTRIBUTES)
+        self.exact[key] = values
+        self._unsaved += 1
+        while len(self.exact) > EXACT_SIZE:
+            self.exact.popitem(last=False)
+        return values
+
+    def _load(self):
+        if not os.path.isfile(self.filename):
+            return
+        try:
+            with np.load(self.filename) as npz:
+                if npz['grid'].shape == self.grid.shape:
+                    self.grid = npz['grid']
+                    self.computed = npz['computed']
+                if 'exact_points' in npz:
+                    self.exact.update(_exact_dict(npz['exact_points'], npz['exact_values']))
+        except Exception:
+            print('Could not read traveltime table %s, recalculating' % self.filename)
+
+    def _save(self):
+        if not self.filename:
+            return
+        # Keep rows another session has written in the meantime.
+        if os.path.isfile(self.filename):
+            try:
+                with np.load(self.filename) as npz:
+                    missing = npz['computed'] & ~self.computed
+                    self.grid[missing] = npz['grid'][missing]
+                    self.computed = self.computed | missing
+                    if 'exact_points' in npz:
+                        saved = _exact_dict(npz['exact_points'], npz['exact_values'])
+                        saved.update(self.exact)
+                        self.exact = saved
+            except Exception:
+                pass
+        while len(self.exact) > EXACT_SIZE:
+            self.exact.popitem(last=False)
+
+        points = np.array(list(self.exact.keys()), dtype='float').reshape(-1, 2)
+        values = np.array(list(self.exact.values()), dtype='float').reshape(-1, len(ATTRIBUTES))
+        tmpname = self.filename + '.%i.tmp' % os.getpid()
+        with open(tmpname, 'wb') as fh:
+            np.savez(fh, grid=self.grid, computed=self.computed, exact_points=points, exact_values=values)
+        os.replace(tmpname, self.filename)
+        self._unsaved = 0
+
+
+def _flush_all():
+    for table in _TABLES.values():
+        try:
+            table.flush()
+        except Exception:
+            pass
+
+
+def _exact_dict(points, values):
+    # Ordered, the results of this session are added after the saved ones.
+    return OrderedDict(((float(z), float(x)), tuple(float(v) for v in vals))
+                       for (z, x), vals in zip(points, values))
+
+
+def _phase_list(phase):
+    if isinstance(phase, (list, tuple)):
+        return [str(p) for p in phase]
+    return [str(phase)]
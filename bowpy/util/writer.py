@@ -0,0 +1,218 @@
+from __future__ import absolute_import, print_function
+import atexit
+from functools import partial
+import os
+import shutil
+import threading
+
+from obspy import Stream
+
+from bowpy.util.pipeline import QUEUE_SIZE, Pipeline, Stage, stream_nbytes
+
+"""
+Writing of files in a background thread. Streams, inventories and catalogs are
+put into a bounded queue and written by one thread, so the threads, which
+download or process data, do not wait for the disk, unless the queue is full.
+The files waiting in the queue are written in one batch to one temporary
+directory per target directory and renamed together, when the batch is
+complete, so an interrupted run leaves no partial files. flush waits until
+all queued files are written, close also stops the thread.
+
+Example:
+            from bowpy.util.writer import AsyncWriter
+
+            writer = AsyncWriter(queue_size=32)
+            for st in streams:
+                writer.write(st, st[0].stats.station + '.MSEED', 'MSEED',
+                             callback=lambda filenames: print('Saved', filenames))
+            failed = writer.close()
+            print(writer)
+"""
+
+# Maximum number of files written in one batch.
+BATCH_SIZE = 8
+
+_WRITER = []
+
+
+def get_writer():
+    """
+    Returns the default AsyncWriter of save_file, shared inside a session. It is flushed
+    and closed at exit.
+    """
+    if not _WRITER:
+        _WRITER.append(AsyncWriter())
+        atexit.register(_WRITER[0].close)
+    return _WRITER[0]
+
+
+def atomic_write(filename, func):
+    """
+    Calls func(path) to write filename and moves the written files to the directory of
+    filename, when func returns. Formats with one trace per file, e.g. SAC, write several
+    files, numbered in front of the extension.
+
+    returns: list of the written files
+    """
+    dirname = os.path.dirname(os.path.abspath(filename))
+    tmpdir = _tmpdir(dirname, os.path.basename(filename))
+    try:
+        func(os.path.join(tmpdir, os.path.basename(filename)))
+        filenames = []
+        for name in sorted(os.listdir(tmpdir)):
+            os.replace(os.path.join(tmpdir, name), os.path.join(dirname, name))
+            filenames.append(os.path.join(os.path.dirname(filename), name))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return filenames
+
+
+def _tmpdir(dirname, name='batch'):
+    """
+    Creates a temporary directory of the current thread in dirname.
+    """
+    tmpdir = os.path.join(dirname, '.%s.%i.tmp' % (name, threading.current_thread().ident))
+    if not os.path.isdir(tmpdir):
+        os.makedirs(tmpdir)
+    return tmpdir
+
+
+class AsyncWriter(object):
+    """
+    Thread, which writes the queued files in order.
+
+    :param queue_size: number of files in the queue, before write waits
+    :param batch_size: maximum number of files written in one batch
+
+    :attribute failed: list of (file name, error message) of the files, which failed
+    """
+
+    def __init__(self, queue_size=QUEUE_SIZE, batch_size=BATCH_SIZE):
+        self.failed = []
+        self._reported = 0
+        self._closed = False
+        self._pipeline = Pipeline([Stage('write', self._run, 1, batch_size, queue_size)],
+                                  size=lambda item: item[0], source='queued')
+
+    def __str__(self):
+        lines = ['AsyncWriter statistics:', '    %s' % self._pipeline.source]
+        lines.extend('    %s' % stage.stats for stage in self._pipeline.stages)
+        for filename, msg in self.failed:
+            lines.append('    %s failed: %s' % (filename, msg))
+        return '\n'.join(lines)
+
+    def write(self, obj, filename, format=None, callback=None):
+        """
+        Queues obj, a Stream, Inventory or Catalog, to be written to filename with
+        obj.write(filename, format=format).
+
+        :param callback: function, called with the list of the written files in the writing
+                         thread, e.g. to record them
+        returns: filename
+        """
+        nbytes = stream_nbytes(obj) if isinstance(obj, Stream) else 0
+        return self.submit(filename, lambda path: obj.write(path, format=format), callback, nbytes)
+
+    def submit(self, filename, func, callback=None, nbytes=0):
+        """
+        Queues func(path), which writes filename to path, see atomic_write.
+        """
+        self._put(nbytes, filename, (filename, func, callback))
+        return filename
+
+    def call(self, func, *args, **kwargs):
+        """
+        Queues func(*args, **kwargs), it is called in the writing thread after the files,
+        which are queued before it.
+        """
+        self._put(0, getattr(func, '__name__', 'call'), partial(func, *args, **kwargs))
+
+    def flush(self):
+        """
+        Waits until all queued files are written.
+
+        returns: list of (file name, error message) of the files, which failed since the last
+                 flush
+        """
+        if not self._closed:
+            self._pipeline.join()
+        failed = self.failed[self._reported:]
+        self._reported = len(self.failed)
+        return failed
+
+    def close(self):
+        """
+        Writes all queued files and stops the thread, returns the failed files as flush.
+        """
+        if not self._closed:
+            self._pipeline.close()
+            self._closed = True
+        return self.flush()
+
+    def _put(self, nbytes, name, job):
+        if self._closed:
+            msg = 'AsyncWriter is closed'
+            raise IOError(msg)
+        self._pipeline.put((nbytes, name, job))
+
+    def _run(self, items):
+        # Consecutive files are written as one batch, calls run in between in queue order.
+        files = []
+        for nbytes, name, job in items:
+            if isinstance(job, tuple):
+                files.append(job)
+                continue
+            self._write_batch(files)
+            files = []
+            try:
+                job()
+            except Exception as e:
+                self.failed.append((name, '%s: %s' % (type(e).__name__, e)))
+        self._write_batch(files)
+
+    def _write_batch(self, files):
+        """
+        Writes files, a list of (filename, func, callback), to one temporary directory per
+        target directory and moves them, when all are written. A file, whose name is already
+        written in the batch, starts a new batch, so the later one replaces the earlier.
+        """
+        tmpdirs = {}
+        written = []
+        try:
+            for filename, func, callback in files:
+                dirname = os.path.dirname(os.path.abspath(filename))
+                if dirname not in tmpdirs:
+                    tmpdirs[dirname] = _tmpdir(dirname)
+                tmpdir = tmpdirs[dirname]
+
+                before = set(os.listdir(tmpdir))
+                if os.path.basename(filename) in before:
+                    self._move(written)
+                    written = []
+                    before = set(os.listdir(tmpdir))
+                try:
+                    func(os.path.join(tmpdir, os.path.basename(filename)))
+                except Exception as e:
+                    self.failed.append((filename, '%s: %s' % (type(e).__name__, e)))
+                    for name in set(os.listdir(tmpdir)) - before:
+                        os.remove(os.path.join(tmpdir, name))
+                    continue
+                names = sorted(set(os.listdir(tmpdir)) - before)
+                written.append((filename, callback, tmpdir, names))
+            self._move(written)
+        finally:
+            for tmpdir in tmpdirs.values():
+                shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def _move(self, written):
+        for filename, callback, tmpdir, names in written:
+            try:
+                dirname = os.path.dirname(tmpdir)
+                filenames = []
+                for name in names:
+                    os.replace(os.path.join(tmpdir, name), os.path.join(dirname, name))
+                    filenames.append(os.path.join(os.path.dirname(filename), name))
+                if callback:
+                    callback(filenames)
+            except Exception as e:
+                self.failed.append((filename, '%s: %s' % (type(e).__name__, e)))